@@ -1,12 +1,24 @@
 """
-Walk through the IPHAS raw data directory and create a CSV table which links
-the images, confidence maps and field numbers
+Walk through the IPHAS raw data directory and create a catalogue which links
+the images, confidence maps and field numbers (pipeline/catalogue.py)
+
+The directories are listed concurrently, and the listing of every directory
+is kept in 'iphas-images-dirs.json' together with its mtime. With the
+--incremental option, only the directories whose mtime changed since the
+previous run are listed again, e.g.
+python 1-imgtable.py --incremental
 """
 import os
 import re
+import sys
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import pyfits
-import numpy as np
+# The catalogue is shared with the tile pipeline
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'pipeline'))
+import catalogue
 
 def is_local():
     """Are we running locally or on the cluster?"""
@@ -26,128 +38,185 @@ if is_local():
 else:
     datadir = '/car-data/gb/iphas/'
 
-# Initialize output table
-out = open('iphas-images.csv', 'w')
-out.write('run,field,filter,image,confmap\n')
+# IPHAS metadata (to figure out field ids)
+metadata_file = '/home/gb/dev/iphas-qc/data/iphas-observations.fits'
+
+# Output catalogue, and the directory listings it was made from
+table_file = 'iphas-images.npy'
+state_file = 'iphas-images-dirs.json'
+
+# Number of directories listed concurrently
+workers = 16
+
+# Re-use the listings of the directories which did not change
+incremental = '--incremental' in sys.argv[1:]
 
 # Confidence maps can have various different filenames
-CONF_NAMES = {'ha': ['Ha_conf.fits', 'Ha_conf.fit', 
+CONF_NAMES = {'ha': ['Ha_conf.fits', 'Ha_conf.fit',
                     'Halpha_conf.fit',
-                    'ha_conf.fits', 'ha_conf.fit', 
+                    'ha_conf.fits', 'ha_conf.fit',
                     'h_conf.fits', 'h_conf.fit',
-                    'Halpha:197_iphas_aug2003_cpm.fit', 
+                    'Halpha:197_iphas_aug2003_cpm.fit',
                     'Halpha:197_iphas_sep2003_cpm.fit',
-                    'Halpha:197_iphas_oct2003_cpm.fit', 
-                    'Halpha:197_iphas_nov2003_cpm.fit', 
-                    'Halpha:197_nov2003b_cpm.fit', 
+                    'Halpha:197_iphas_oct2003_cpm.fit',
+                    'Halpha:197_iphas_nov2003_cpm.fit',
+                    'Halpha:197_nov2003b_cpm.fit',
                     'Halpha:197_dec2003_cpm.fit',
-                    'Halpha:197_jun2004_cpm.fit', 
+                    'Halpha:197_jun2004_cpm.fit',
                     'Halpha:197_iphas_jul2004a_cpm.fit',
-                    'Halpha:197_iphas_jul2004_cpm.fit', 
+                    'Halpha:197_iphas_jul2004_cpm.fit',
                     'Halpha:197_iphas_aug2004a_cpm.fit',
-                    'Halpha:197_iphas_aug2004b_cpm.fit', 
-                    'Halpha:197_iphas_dec2004b_cpm.fit'], 
-                'r': ['r_conf.fit', 'r_conf.fits', 
-                    'r:214_iphas_aug2003_cpm.fit', 
-                    'r:214_dec2003_cpm.fit', 
-                    'r:214_iphas_nov2003_cpm.fit', 
-                    'r:214_nov2003b_cpm.fit', 
+                    'Halpha:197_iphas_aug2004b_cpm.fit',
+                    'Halpha:197_iphas_dec2004b_cpm.fit'],
+                'r': ['r_conf.fit', 'r_conf.fits',
+                    'r:214_iphas_aug2003_cpm.fit',
+                    'r:214_dec2003_cpm.fit',
+                    'r:214_iphas_nov2003_cpm.fit',
+                    'r:214_nov2003b_cpm.fit',
                     'r:214_iphas_sep2003_cpm.fit',
-                    'r:214_iphas_aug2004a_cpm.fit', 
+                    'r:214_iphas_aug2004a_cpm.fit',
                     'r:214_iphas_aug2004b_cpm.fit',
-                    'r:214_iphas_jul2004a_cpm.fit', 
+                    'r:214_iphas_jul2004a_cpm.fit',
                     'r:214_iphas_jul2004_cpm.fit',
                     'r:214_jun2004_cpm.fit'],
-                'i': ['i_conf.fit', 'i_conf.fits', 
-                    'i:215_iphas_aug2003_cpm.fit', 
-                    'i:215_dec2003_cpm.fit', 
-                    'i:215_iphas_nov2003_cpm.fit', 
-                    'i:215_nov2003b_cpm.fit', 
+                'i': ['i_conf.fit', 'i_conf.fits',
+                    'i:215_iphas_aug2003_cpm.fit',
+                    'i:215_dec2003_cpm.fit',
+                    'i:215_iphas_nov2003_cpm.fit',
+                    'i:215_nov2003b_cpm.fit',
                     'i:215_iphas_sep2003_cpm.fit',
-                    'i:215_iphas_aug2004a_cpm.fit', 
+                    'i:215_iphas_aug2004a_cpm.fit',
                     'i:215_iphas_aug2004b_cpm.fit',
-                    'i:215_iphas_jul2004a_cpm.fit', 
+                    'i:215_iphas_jul2004a_cpm.fit',
                     'i:215_iphas_jul2004_cpm.fit',
                     'i:215_jun2004_cpm.fit']}
+ALL_CONF_NAMES = set([name for names in CONF_NAMES.values() for name in names])
 
+# Some directories do not contain confidence maps
+CONF_ELSEWHERE = {'iphas_nov2006c': 'iphas_nov2006b',
+                  'iphas_jul2008': 'iphas_aug2008',
+                  'iphas_oct2009': 'iphas_nov2009',
+                  'run10': 'run11',
+                  'run13': 'run12'}
 
+# The raw data dir contains 'special' sub-directories with exposures to ignore
+directories_to_ignore = ['junk', 'badones', 'crap', '9thoct', \
+                         'Uband', 'gband', 'slow']
 
-# Dict to hold the confidence maps for each filter/directory
-confmaps = {'r' : {}, 'i' : {}, 'ha' : {}}
-
-def get_confmap(mydir, band):
+# Images should be named "rnnnnnn.fit"
+IMAGE_PATTERN = re.compile('^r\d+.fit')
+
+
+
+def list_dir(path, previous):
+    """
+    Returns the listing of a directory, relative to datadir:
+    {'mtime':, 'subdirs': [], 'images': [], 'confs': []}
+    The previous listing is returned if the mtime did not change.
+    """
+    mtime = os.stat(datadir+path).st_mtime
+    if previous is not None and previous['mtime'] == mtime:
+        return previous
+    listing = {'mtime': mtime, 'subdirs': [], 'images': [], 'confs': []}
+    for name in sorted(os.listdir(datadir+path)):
+        if IMAGE_PATTERN.match(name):
+            listing['images'].append(name)
+        elif name in ALL_CONF_NAMES:
+            listing['confs'].append(name)
+        elif (not name.endswith(('.fit', '.fits', '.fz'))
+              and os.path.isdir(os.path.join(datadir+path, name))):
+            listing['subdirs'].append(os.path.join(path, name))
+    return listing
+
+
+def scan(previous):
+    """
+    Lists all directories below datadir, one level of the tree at a time.
+
+    Returns a dict {path relative to datadir: listing}.
+    """
+    state = {}
+    pool = ThreadPool(workers)
+    try:
+        level = ['']
+        while level:
+            listings = pool.map(lambda path: list_dir(path, previous.get(path)),
+                                level, chunksize=1)
+            state.update(zip(level, listings))
+            level = [sub for listing in listings for sub in listing['subdirs']]
+    finally:
+        pool.close()
+        pool.join()
+    return state
+
+
+def fieldid_index():
+    """Returns a dict run number -> (fieldid, filter) built from the metadata"""
+    metadata = pyfits.getdata(metadata_file, 1)
+    ids = metadata.field('id')
+    index = {}
+    # The first row with a given run wins, and 'r' takes precedence over
+    # 'i', which takes precedence over 'ha'
+    for myfilter in ['ha', 'i', 'r']:
+        runs = metadata.field('run_'+myfilter)
+        for n in range(len(runs)-1, -1, -1):
+            index[int(runs[n])] = (ids[n], myfilter)
+    return index
+
+
+def get_confmap(state, mydir, band):
     """Return the name of the confidence map in directory 'mydir'"""
     assert( band in ['r', 'i', 'ha'] )
-
-    # The result from previous function calls are stored in 'confmaps'
-    if mydir not in confmaps[band].keys():
-
-        # Some directories do not contain confidence maps
-        if mydir == datadir+'iphas_nov2006c':
-            candidatedir = datadir+'iphas_nov2006b'
-        elif mydir == datadir+'iphas_jul2008':
-            candidatedir = datadir+'iphas_aug2008'
-        elif mydir == datadir+'iphas_oct2009':
-            candidatedir = datadir+'iphas_nov2009'       
-        elif mydir == datadir+'run10':
-            candidatedir = datadir+'run11'
-        elif mydir == datadir+'run13':
-            candidatedir = datadir+'run12'
-        else:
-            candidatedir = mydir
-
-        # Try all possible names
-        for name in CONF_NAMES[band]: 
-            candidate = candidatedir+'/'+name
-            if os.path.exists(candidate):
-                confmaps[band][mydir] = candidate # Success!
-                continue
-
-    # Return confidence map name if we found one, raise exception otherwise
-    try:
-        return confmaps[band][mydir]
-    except KeyError:
-        raise Exception('No confidence map found in directory %s' % mydir)
+    candidatedir = mydir
+    name = os.path.basename(mydir)
+    if name in CONF_ELSEWHERE:
+        candidatedir = os.path.join(os.path.dirname(mydir), CONF_ELSEWHERE[name])
+    present = set(state.get(candidatedir, {'confs': []})['confs'])
+    # If several names are present the last one in CONF_NAMES is used
+    found = [name for name in CONF_NAMES[band] if name in present]
+    if len(found) == 0:
+        raise Exception('No confidence map found in directory %s' % (datadir+mydir))
+    return os.path.join(candidatedir, found[-1])
 
 
-# Load file containing and IPHAS metadata (to figure out field ids)
-metadata = pyfits.getdata('/home/gb/dev/iphas-qc/data/iphas-observations.fits', 1)
 
-def get_fieldid(myrun):
-    """Retrieve an IPHAS field identifier of the form 'fieldnumber_month_filter'"""
-    run_int = int(myrun[1:]) # Numeric run number
-    # Check the iphas-observations.fits file for columns "run_r", "run_i", "run_ha"
-    for myfilter in ['r', 'i', 'ha']:
-        a = np.argwhere( metadata.field('run_'+myfilter) == run_int )
-        if len(a) > 0:
-            # If the run number matches, return field identifier+filter
-            return metadata.field('id')[a[0]][0]+","+myfilter
-    # No match: return empty string
-    return ","
+""" MAIN """
+# Listings of the previous run
+# (the field ids are looked up again every time, such that changes to
+# the metadata are always picked up)
+previous = {}
+if incremental and os.path.exists(state_file):
+    previous = json.load(open(state_file, 'r'))
 
+state = scan(previous)
+relisted = len([path for path in state if state[path] is not previous.get(path)])
+logging.info('%d directories, %d listed again' % (len(state), relisted))
 
+index = fieldid_index()
 
-""" MAIN """
-# The raw data dir contains 'special' sub-directories with exposures to ignore
-directories_to_ignore = ['junk', 'badones', 'crap', '9thoct', \
-                         'Uband', 'gband', 'slow']
-
-for mydir in os.walk(datadir):
+rows = {'run': [], 'field': [], 'filter': [], 'fname': [], 'confmap': []}
+for mydir in sorted(state):
     # We're ignoring certain directories
-    if mydir[0].split('/')[-1] in directories_to_ignore:
+    if os.path.basename(mydir) in directories_to_ignore:
         continue
-
-    # Consider each file
-    for filename in mydir[2]:
-        # Images should be named "rnnnnnn.fit"
-        if re.match('^r\d+.fit', filename):
-            logging.debug("%s/%s" % (mydir[0], filename))
-            image_path = os.path.join(mydir[0], filename)
-            conf_path = get_confmap(mydir[0], 'i')
-            # Run number is the first part of the filename
-            myrun = filename.split('.')[0]
-            # Write the details of this image
-            out.write("%s,%s,%s,%s\n" % \
-                     (myrun, get_fieldid(myrun), image_path[len(datadir):], conf_path[len(datadir):])) 
-
-out.close()
\ No newline at end of file
+    if len(state[mydir]['images']) == 0:
+        continue
+    conf_path = get_confmap(state, mydir, 'i')
+    for filename in state[mydir]['images']:
+        logging.debug("%s/%s" % (mydir, filename))
+        # Run number is the first part of the filename
+        myrun = filename.split('.')[0]
+        # Record the details of this image
+        field, myfilter = index.get(int(myrun[1:]), ('', ''))
+        rows['run'].append(int(myrun[1:]))
+        rows['field'].append(field)
+        rows['filter'].append(myfilter)
+        rows['fname'].append(os.path.join(mydir, filename))
+        rows['confmap'].append(conf_path)
+catalogue.Catalogue.from_columns(**rows).save(table_file)
+
+# Record the listings for the next incremental run
+f = open(state_file+'.tmp', 'w')
+json.dump(state, f)
+f.close()
+os.rename(state_file+'.tmp', state_file)
@@ -1,12 +1,18 @@
 """
-Execute a list of commands using MPI
-e.g. mpirun -np 4 python do-mosaic-mpi.py
+Mosaic the CCDs of all exposures using MPI, through executor.MPIBackend
+e.g. mpirun -np 4 python 2-mosaic-mpi.py
 """
 from mpi4py import MPI
 import logging
-import subprocess
-import shlex
 import os
+import sys
+import numpy as np
+# The shared executor lives in the tile pipeline directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'pipeline'))
+import catalogue
+import executor
+import staging
 
 def is_local():
     """Are we running locally or on the cluster?"""
@@ -33,96 +39,199 @@ else:
     out_dir = '/car-data/gb/iphas-mosaic'
 # Mosaicking command
 mosaic_cmd = '/home/gb/bin/casutools/bin/mosaic'
-# fpack command (-D deletes original file, -Y suppresses warning)
-fpack_cmd = '/home/gb/bin/cfitsio3310/bin/fpack -D -Y'
-
-# Define the messages we'll be passing through MPI
-GIVE_ME_WORK = 801  # Worker waiting for instructions
-FINISHED = 850      # All work is done
+# The locations can be overridden from the environment (e.g. by benchmark.py)
+in_dir = os.environ.get('IPHAS_IN_DIR', in_dir)
+out_dir = os.environ.get('IPHAS_OUT_DIR', out_dir)
+mosaic_cmd = os.environ.get('IPHAS_MOSAIC_CMD', mosaic_cmd)
+
+# Time limit for a single command (seconds)
+cmd_timeout = 3600
+# Resources used by the commands of this rank
+profile = executor.Profile('mpi-profile-%d.json' % comm.rank)
+
+# Scheduling
+max_batch = 8          # Largest number of images sent in one message
+task_timeout = 2*3600  # Seconds before the tasks of a silent worker are re-queued
+max_attempts = 3       # Number of times a failing image is tried
+# Images to mosaic, written by 1-imgtable.py
+catalogue_file = 'iphas-images.npy'
+# Images which have been mosaicked successfully (allows resubmission)
+ledger_file = 'iphas-mosaic-ledger.csv'
+
+# Node-local scratch to which the inputs of a batch are prefetched
+stage_dir = '/tmp/iphas-stage-%d' % comm.rank
+stage_budget = 4*1024**3  # bytes
+
+
+
+def output_filenames(msg):
+    """Returns the filenames of the compressed image and confidence map"""
+    return ["%s/%s_%s_mosaic.fit.fz" % (out_dir, msg['field'], msg['filter']),
+            "%s/%s_%s_conf.fit.fz" % (out_dir, msg['field'], msg['filter'])]
+
+
+def is_valid_fits(filename):
+    """Does the file look like a complete FITS file?"""
+    try:
+        size = os.path.getsize(filename)
+        f = open(filename, 'rb')
+        start = f.read(9)
+        f.close()
+    except (IOError, OSError):
+        return False
+    return size > 0 and size % 2880 == 0 and start == b'SIMPLE  ='
+
+
+def read_ledger():
+    """Returns the set of images recorded as done in the ledger"""
+    done = set()
+    if os.path.exists(ledger_file):
+        for line in open(ledger_file, 'r'):
+            cols = line.strip().split(',')
+            if len(cols) >= 1 and cols[0]:
+                done.add(cols[0])
+    return done
+
+
+def read_tasks():
+    """Returns the list of (task_id, msg) still to be done"""
+    done = read_ledger()
+    images = catalogue.Catalogue.load(catalogue_file)
+    tasks = []
+    skipped = 0
+    # Ignore calibration and non-iphas fields
+    for i in np.nonzero(images['field'] != '')[0]:
+        msg = {'field': str(images['field'][i]), 'filter': str(images['filter'][i]),
+               'img': str(images['fname'][i]), 'conf': str(images['confmap'][i])}
+        # Skip images completed by a previous job
+        if msg['img'] in done and all([is_valid_fits(f) 
+                                       for f in output_filenames(msg)]):
+            skipped += 1
+            continue
+        tasks.append(msg)
+    logging.info('%d images to mosaic, %d already done' % (len(tasks), skipped))
+    return tasks
 
 
+def cmd_exec(cmd):
+    """Execute a shell command"""
+    return executor.execute(cmd, logging, cmd_timeout, profile,
+                            rank=comm.rank)
 
-def mpi_run():
-    """Figure out whether we are master or worker"""
-    if comm.rank==0:
-        mpi_master()
-    else:
-        mpi_worker()
-    return
-
-def mpi_master():
-    logging.info("Running on %d cores" % comm.size)
-
-    images = open('iphas-images.csv', 'r')
-    rows = images.readlines()
-    # Ignore the first line of the CSV table (=header)
-    for i, row in enumerate(rows[1:]):
-        cols = row.strip().split(',')
-        # Ignore calibration and non-iphas fields
-        if cols[1] == "":
-            continue
 
-        # Wait for a worker to report for duty
-        rank_done = comm.recv(source=MPI.ANY_SOURCE, tag=GIVE_ME_WORK)
-        # Send the worker the details of the next image
-        msg = {'field':cols[1], 'filter':cols[2], 'img':cols[3], 'conf':cols[4]}
-        comm.send(msg, dest=rank_done)
-        logging.info('Image %d/%d sent to worker %s' % (i, len(rows), rank_done))
+def input_filenames(msg):
+    """Returns the full paths of the input image and confidence map"""
+    return ["%s/%s" % (in_dir, msg['img']), "%s/%s" % (in_dir, msg['conf'])]
 
 
-    # Tell all workers we're finished
-    for worker in range(1, comm.size):
-        comm.send(FINISHED, dest=worker)
+def mosaic_image(msg, in_img, in_conf):
+    """Mosaic the four CCDs of one exposure; returns True on success"""
+    # Full paths of output images and confidence maps
+    out_img, out_conf = output_filenames(msg)
     
-    return
 
+    commands = []
+    for filename in [out_img, out_conf]:
+        if os.path.exists(filename):
+            commands.append( "rm %s" % filename )
+    # Casutools/mosaic command; cfitsio compresses the outputs as they
+    # are written (like fpack's defaults) when given the [compress] suffix
+    commands.append( "%s %s %s '%s[compress]' '%s[compress]' --skyflag=0 --conflim=70  --verbose" \
+            % (mosaic_cmd, in_img, in_conf, out_img, out_conf) )
+
+    # Execute!
+    for cmd in commands:
+        if not cmd_exec(cmd):
+            return False
+    return all([is_valid_fits(f) for f in output_filenames(msg)])
+
+
+class BatchStager(object):
+    """
+    Prefetches the inputs of a batch of images onto node-local scratch;
+    the images of the batch are then mosaicked in order by run().
+
+    Consecutive exposures of a run share their confidence map, which is
+    staged once and kept until the last image of the batch using it is done.
+    """
+
+    def __init__(self):
+        self._prefetch = None
+
+    def start(self, batch):
+        """Starts copying the inputs of a batch (called by MPIBackend)"""
+        self._remaining = len(batch)
+        sources = []
+        self._uses = {}    # source -> number of images still to use it
+        self._files = {}   # source -> staged copy (None if staging failed)
+        for msg in batch:
+            for f in input_filenames(msg):
+                if f not in self._uses:
+                    sources.append(f)
+                    self._uses[f] = 0
+                self._uses[f] += 1
+        self._prefetch = staging.Prefetcher(sources, stage_dir,
+                                            max_bytes=stage_budget, lookahead=4)
+        self._staged = iter(self._prefetch)
+
+    def run(self, msg):
+        """Mosaics the next image of the batch; returns True on success"""
+        if self._prefetch is None:
+            self.start([msg])  # Single process: no batches
+        inputs = input_filenames(msg)
+        try:
+            # The files are staged in order of first use
+            for f in inputs:
+                while f not in self._files:
+                    source, staged = next(self._staged)
+                    self._files[source] = staged
+            in_img, in_conf = [self._files[f] for f in inputs]
+            if in_img is None or in_conf is None:
+                return False
+            return mosaic_image(msg, in_img, in_conf)
+        finally:
+            for f in inputs:
+                self._uses[f] -= 1
+                if self._uses[f] == 0 and f in self._files:
+                    self._prefetch.release(self._files.pop(f))
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._prefetch.close()
+                self._prefetch.report()
+                self._prefetch = None
 
-def cmd_exec(cmd):
-    """Execute a shell command"""
-    logging.debug(cmd)
-    p = subprocess.Popen(shlex.split(cmd), 
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout = p.stdout.read().strip()
-    stderr = p.stderr.read().strip()
-    if stderr:
-        logging.error("STDERR={%s} STDOUT={%s} CMD={%s}" % (stderr, stdout, cmd))
-        return False
-    logging.debug( stdout )
-    return True
-
-
-def mpi_worker():
-    while True:
-        # Ask for work
-        comm.send(comm.rank, dest=0, tag=GIVE_ME_WORK)
-        msg = comm.recv(source=0)
-        if msg == FINISHED:
-            return
-
-        # Perform work
-        logging.debug("Message rcvd: \"%s\"" % msg)
-
-        # Full paths of input/output images and confidence maps
-        in_img = "%s/%s" % (in_dir, msg['img'])
-        in_conf = "%s/%s" % (in_dir, msg['conf'])
-        out_img = "%s/%s_%s_mosaic.fit" % (out_dir, msg['field'], msg['filter'])
-        out_conf = "%s/%s_%s_conf.fit" % (out_dir, msg['field'], msg['filter'])
-        
-
-        commands = []
-        # Casutools/mosaic command
-        commands.append( "%s %s %s %s %s --skyflag=0 --conflim=70  --verbose" \
-                % (mosaic_cmd, in_img, in_conf, out_img, out_conf) )
-        # Compression using fpack
-        for filename in [out_img, out_conf]:
-            if os.path.exists(filename+".fz"):
-                commands.append( "rm %s.fz" % filename )
-            commands.append( "%s %s" % (fpack_cmd, filename) )
-
-        # Execute!
-        for cmd in commands:
-            cmd_exec(cmd)
+
+def mpi_run():
+    """Mosaic all images: rank 0 hands out the work, the others do it"""
+    stager = BatchStager()
+    backend = executor.MPIBackend(comm, max_batch=max_batch,
+                                  task_timeout=task_timeout,
+                                  max_attempts=max_attempts,
+                                  on_batch=stager.start)
+    tasks, ledger = [], None
+    if comm.rank == 0:
+        logging.info("Running on %d cores" % comm.size)
+        tasks = read_tasks()
+        ledger = open(ledger_file, 'a')
+
+    def record(index, success, result):
+        if success:
+            ledger.write('%s,%s\n' % (tasks[index]['img'],
+                                      ','.join(output_filenames(tasks[index]))))
+            ledger.flush()
+
+    results = backend.map(stager.run, tasks, callback=record)
+    if comm.rank == 0:
+        ledger.close()
+        failed = [tasks[i]['img'] for i, (success, result) in enumerate(results)
+                  if not success]
+        logging.info('%d images done, %d failed' % (len(tasks) - len(failed), len(failed)))
+        for img in failed:
+            logging.error('FAILED: %s' % img)
+    else:
+        profile.log_summary()
+    backend.close()
 
 
 """ MAIN """
-mpi_run()
\ No newline at end of file
+mpi_run()
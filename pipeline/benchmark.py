@@ -0,0 +1,421 @@
+"""
+Benchmark of the mosaicking pipeline on synthetic IPHAS-like data.
+
+Generates 4-CCD exposures resembling those of the INT Wide Field Camera
+(scaled down in size), with confidence maps and TAN WCS, on a small tile
+grid. It then runs the stages of Mosaic and the single-exposure MPI
+worker, and records the wall time, peak RSS and bytes read/written per
+stage to a JSON file, e.g.
+
+python benchmark.py /tmp/bench results.json
+
+The Montage (and for the MPI worker, CASUtools) binaries are found
+through the MONTAGE_BIN and CASUTOOLS_BIN environment variables.
+"""
+
+import json
+import logging
+import os
+import platform
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import types
+import numpy as np
+import pyfits
+
+import catalogue
+import coverage
+import mosaic
+
+
+# Scaled-down Wide Field Camera: four 2048x4096 CCDs at 0.33 arcsec/px
+CCD_SHAPE = (512, 256)  # (naxis2, naxis1)
+PIXEL_SCALE = 0.33 * 2048 / CCD_SHAPE[1]  # arcsec/px, same sky coverage
+# Centres of the CCDs relative to the optical axis (pixels), CCD 4 is rotated
+CCD_LAYOUT = [(-1.05, 0., False), (0., 0., False), (1.05, 0., False),
+              (0., 0.78, True)]
+
+# Tile grid: 2x2 tiles of 0.5 degree in the Galactic plane
+GRID = (120.0, 121.0, -0.5, 0.5, 4., 2, 2, 0.05)
+BAND = 'r'
+
+
+class ResourceMeter(object):
+    """
+    Measures wall time, peak RSS and bytes read/written while it is active.
+
+    The peak RSS of this process is sampled in a background thread; the
+    resources of external tools are taken from the records of the Mosaic
+    profile carrying the same stage name.
+
+    :param profile:
+    executor.Profile whose records to include (optional.)
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile
+        self.results = {}
+
+    @staticmethod
+    def _io():
+        """
+        Returns the I/O counters of this process from /proc (if available).
+
+        """
+        counters = {}
+        try:
+            for line in open('/proc/self/io', 'r'):
+                key, value = line.split(':')
+                counters[key.strip()] = int(value)
+        except IOError:
+            pass
+        return counters
+
+    @staticmethod
+    def _rss():
+        """
+        Returns the resident set size of this process (kilobytes).
+
+        """
+        try:
+            for line in open('/proc/self/status', 'r'):
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        except IOError:
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def measure(self, stage, function, *args):
+        """
+        Calls function(*args) and records its resources under 'stage'.
+
+        """
+        peak = [self._rss()]
+        done = threading.Event()
+        def sample():
+            while not done.wait(0.05):
+                peak[0] = max(peak[0], self._rss())
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+
+        io_start = self._io()
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        nrecords = len(self.profile.records) if self.profile else 0
+        start = time.time()
+        try:
+            result = function(*args)
+        finally:
+            wall = time.time() - start
+            done.set()
+            sampler.join()
+            io_end = self._io()
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            records = self.profile.records[nrecords:] if self.profile else []
+            self.results[stage] = {
+                'wall': wall,
+                'peak_rss_kb': max(peak[0], self._rss()),
+                'tools_peak_rss_kb': max([r['maxrss'] for r in records] + [0]),
+                'tool_calls': len(records),
+                'cpu_tools': (children.ru_utime + children.ru_stime
+                              - children_start.ru_utime - children_start.ru_stime),
+                # Bytes passed through read()/write() by this process
+                'bytes_read': io_end.get('rchar', 0) - io_start.get('rchar', 0),
+                'bytes_written': io_end.get('wchar', 0) - io_start.get('wchar', 0),
+                # Bytes which reached the storage, including external tools
+                'storage_read': (io_end.get('read_bytes', 0) - io_start.get('read_bytes', 0)
+                                 + (children.ru_inblock - children_start.ru_inblock) * 512),
+                'storage_written': (io_end.get('write_bytes', 0) - io_start.get('write_bytes', 0)
+                                    + (children.ru_oublock - children_start.ru_oublock) * 512)}
+            logging.info('Benchmark %s: %.2fs, peak RSS %.0fMB' % (
+                            stage, wall, self.results[stage]['peak_rss_kb'] / 1024.))
+        return result
+
+
+def tan_pix2world(crval1, crval2, crpix1, crpix2, cd, x, y):
+    """
+    Converts pixel coordinates of a TAN projection to (ra, dec) in degrees.
+
+    :param cd:
+    2x2 CD matrix (degrees/px).
+    """
+    dx, dy = np.asarray(x, dtype=float) - crpix1, np.asarray(y, dtype=float) - crpix2
+    xi = np.radians(cd[0][0] * dx + cd[0][1] * dy)
+    eta = np.radians(cd[1][0] * dx + cd[1][1] * dy)
+    ra0, dec0 = np.radians(crval1), np.radians(crval2)
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denom))
+    return np.degrees(ra) % 360., np.degrees(dec)
+
+
+def _ccd_wcs(ra, dec, ccd):
+    """
+    Returns the WCS cards of one CCD of an exposure centred on (ra, dec).
+
+    """
+    ox, oy, rotated = CCD_LAYOUT[ccd]
+    ny, nx = CCD_SHAPE[::-1] if rotated else CCD_SHAPE
+    scale = PIXEL_SCALE / 3600.
+    # The optical axis, in the pixel coordinates of this CCD
+    crpix1 = nx / 2. + 0.5 - ox * CCD_SHAPE[1]
+    crpix2 = ny / 2. + 0.5 - oy * CCD_SHAPE[0]
+    return {'NAXIS1': nx, 'NAXIS2': ny,
+            'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+            'CRVAL1': ra, 'CRVAL2': dec, 'CRPIX1': crpix1, 'CRPIX2': crpix2,
+            'CD1_1': -scale, 'CD1_2': 0., 'CD2_1': 0., 'CD2_2': scale,
+            'EQUINOX': 2000.0}
+
+
+def make_exposure(filename, ra, dec, level, rng, conf=False):
+    """
+    Writes a synthetic 4-CCD exposure (or confidence map) centred on (ra, dec).
+
+    Images have a sky level of 'level' plus noise and a few stars; confidence
+    maps are 100 with a few bad columns.
+    """
+    hdus = [pyfits.PrimaryHDU()]
+    for ccd in range(4):
+        wcs = _ccd_wcs(ra, dec, ccd)
+        shape = (wcs['NAXIS2'], wcs['NAXIS1'])
+        if conf:
+            data = np.full(shape, 100, dtype=np.int16)
+            data[:, rng.randint(0, shape[1], 3)] = 0
+        else:
+            data = (level + rng.normal(0., 5., shape)).astype(np.float32)
+            for i in range(20):
+                y, x = rng.randint(3, shape[0] - 3), rng.randint(3, shape[1] - 3)
+                data[y-2:y+3, x-2:x+3] += rng.uniform(50, 500)
+        hdu = pyfits.ImageHDU(data)
+        for key in ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1',
+                    'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'EQUINOX']:
+            hdu.header.update(key, wcs[key])
+        hdus.append(hdu)
+    pyfits.HDUList(hdus).writeto(filename, clobber=True)
+
+
+def make_survey(datadir, confdir, grid, exposures=12, seed=1):
+    """
+    Writes synthetic exposures covering a tile grid, their master
+    confidence map and the image table of the band.
+
+    Returns (tbl, messages): the image table and the work messages of the
+    exposures as used by 2-mosaic-mpi.py.
+    """
+    rng = np.random.RandomState(seed)
+    for path in (datadir + '/run1', confdir):
+        if not os.path.exists(path):
+            os.makedirs(path)
+    make_exposure('%s/masterconf-%s-masked.fits' % (confdir, BAND), 0., 0., 0.,
+                  rng, conf=True)
+    shutil.copy('%s/masterconf-%s-masked.fits' % (confdir, BAND),
+                '%s/run1/r_conf.fit' % datadir)
+
+    lon, lat = grid.footprints()
+    l = rng.uniform(lon.min(), lon.max(), exposures)
+    b = rng.uniform(lat.min(), lat.max(), exposures)
+    ras, decs = coverage.galactic_to_equatorial(l, b)
+    rows = dict((name, []) for name in
+                ['fname', 'hdu', 'naxis1', 'naxis2', 'ctype1', 'ctype2',
+                 'crval1', 'crval2', 'crpix1', 'crpix2', 'cdelt1', 'cdelt2',
+                 'crota2', 'equinox', 'ra', 'dec', 'ra1', 'dec1', 'ra2',
+                 'dec2', 'ra3', 'dec3', 'ra4', 'dec4', 'field', 'filter',
+                 'confmap', 'run'])
+    messages = []
+    for i, (ra, dec) in enumerate(zip(ras, decs)):
+        run = 100000 + i
+        fname = 'run1/r%d.fit' % run
+        make_exposure('%s/%s' % (datadir, fname), ra, dec,
+                      rng.uniform(-50, 50), rng)
+        messages.append( (i, {'field': '%04d' % i, 'filter': BAND,
+                              'img': fname, 'conf': 'run1/r_conf.fit'}) )
+        for ccd in range(4):
+            wcs = _ccd_wcs(ra, dec, ccd)
+            cd = [[wcs['CD1_1'], wcs['CD1_2']], [wcs['CD2_1'], wcs['CD2_2']]]
+            nx, ny = wcs['NAXIS1'], wcs['NAXIS2']
+            cra, cdec = tan_pix2world(ra, dec, wcs['CRPIX1'], wcs['CRPIX2'], cd,
+                                      [0.5, nx + 0.5, nx + 0.5, 0.5, (nx + 1) / 2.],
+                                      [0.5, 0.5, ny + 0.5, ny + 0.5, (ny + 1) / 2.])
+            values = {'fname': fname, 'hdu': ccd + 1, 'naxis1': nx, 'naxis2': ny,
+                      'ctype1': 'RA---TAN', 'ctype2': 'DEC--TAN',
+                      'crval1': ra, 'crval2': dec,
+                      'crpix1': wcs['CRPIX1'], 'crpix2': wcs['CRPIX2'],
+                      'cdelt1': wcs['CD1_1'], 'cdelt2': wcs['CD2_2'],
+                      'crota2': 0., 'equinox': 2000., 'ra': cra[4], 'dec': cdec[4],
+                      'field': '%04d' % i, 'filter': BAND,
+                      'confmap': 'run1/r_conf.fit', 'run': run}
+            for k in range(4):
+                values['ra%d' % (k + 1)] = cra[k]
+                values['dec%d' % (k + 1)] = cdec[k]
+            for name in rows:
+                rows[name].append(values[name])
+
+    tbl = '%s/iphas-images-best-%s.tbl' % (datadir, BAND)
+    catalogue.Catalogue.from_columns(**rows).write_tbl(tbl)
+    return tbl, messages
+
+
+def run_mosaic(workdir, datadir, confdir, tbl, grid, tile, backend, meter):
+    """
+    Runs the stages of Mosaic on one tile, measuring each of them.
+
+    """
+    name = 'bench%03d' % tile
+    pattern = workdir + '/bench%03d.hdr'
+    header = pattern % tile
+    grid.save(pattern, [tile])
+    grid.expanded(0.4).save(pattern + '.expanded', [tile])
+
+    m = mosaic.Mosaic(name, BAND, header, datadir, workdir)
+    m._path['confmap'] = confdir
+    m._path['montage'] = os.environ.get('MONTAGE_BIN', m._path['montage'])
+    m._path['casutools'] = os.environ.get('CASUTOOLS_BIN', m._path['casutools'])
+    m._imgtable_all[BAND] = tbl
+    m.use_mosaic = False
+    m.resume = False
+    m.workers = 4
+    if backend == 'numpy':
+        m.overlaps_backend = 'numpy'
+        m.coadd_backend = 'numpy'
+        m.bgmodel_backend = 'scipy'
+    meter.profile = m.profile
+    # The co-addition is part of the background stage; it is measured separately
+    m._coadd_native = lambda f=m._coadd_native: meter.measure('coadd', f)
+    m._coadd_montage = lambda output, f=m._coadd_montage: meter.measure('coadd', f, output)
+
+    meter.measure('setup', m.run_stage, 'setup', m.setup_workdir)
+    meter.measure('select', m.run_stage, 'select', m.select_images)
+    for stage, function in [('copy', m.copy_images),
+                            ('project', m.compute_projections),
+                            ('overlaps', m.compute_overlaps),
+                            ('background', m.compute_background)]:
+        meter.measure(stage, m.run_stage, stage, function)
+
+
+class _StandInComm(object):
+    """
+    Stands in for MPI.COMM_WORLD as seen by a single worker (rank 1): it
+    hands out one batch of (index, task) pairs, then the FINISHED message.
+    """
+    rank = 1
+    size = 2
+
+    def __init__(self, batch, finished=850):
+        self._messages = [batch, finished]
+        self.sent = []
+
+    def send(self, obj, dest=0, tag=None):
+        self.sent.append( (tag, obj) )
+
+    def recv(self, source=0, tag=None, status=None):
+        return self._messages.pop(0)
+
+
+def run_mpi_worker(datadir, outdir, messages, meter):
+    """
+    Runs the worker of 2-mosaic-mpi.py on all exposures without MPI.
+
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', '1-mosaic-runs', '2-mosaic-mpi.py')
+    comm = _StandInComm(messages)
+    mpi = types.ModuleType('MPI')
+    mpi.COMM_WORLD = comm
+    mpi.ANY_SOURCE = -1
+    mpi.Status = object
+    mpi.Get_processor_name = platform.node
+    package = types.ModuleType('mpi4py')
+    package.MPI = mpi
+    modules = dict((key, sys.modules.get(key)) for key in ['mpi4py', 'mpi4py.MPI'])
+    sys.modules['mpi4py'], sys.modules['mpi4py.MPI'] = package, mpi
+    os.environ['IPHAS_IN_DIR'] = datadir
+    os.environ['IPHAS_OUT_DIR'] = outdir
+    if 'CASUTOOLS_BIN' in os.environ:
+        os.environ['IPHAS_MOSAIC_CMD'] = os.environ['CASUTOOLS_BIN'] + '/mosaic'
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    try:
+        meter.measure('mpi_worker', runpy.run_path, script, None, '__main__')
+    finally:
+        for key, module in modules.items():
+            if module is None:
+                del sys.modules[key]
+            else:
+                sys.modules[key] = module
+    # The last request for work carries the results of the batch
+    results = comm.sent[-1][1]['results']
+    meter.results['mpi_worker']['images'] = len(results)
+    meter.results['mpi_worker']['failed'] = len([r for r in results if not r[1]])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                    cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(workdir, output, exposures=12, backend='numpy', tile=0, mpi=True):
+    """
+    Generates the synthetic survey in 'workdir', runs the benchmark and
+    writes the results to the JSON file 'output'.
+
+    """
+    datadir, confdir = workdir + '/data', workdir + '/confmap'
+    scratch = workdir + '/scratch'
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    os.makedirs(scratch)
+    grid = mosaic.TileGrid(*GRID)
+
+    meter = ResourceMeter()
+    tbl, messages = meter.measure('generate', make_survey, datadir, confdir,
+                                  grid, exposures)
+    errors = []
+    try:
+        run_mosaic(scratch, datadir, confdir, tbl, grid, tile, backend, meter)
+    except Exception as e:
+        # The stages measured so far are still reported
+        logging.exception('Mosaic benchmark failed')
+        errors.append('mosaic: %s' % e)
+    if mpi:
+        cwd = os.getcwd()
+        os.chdir(scratch)
+        try:
+            run_mpi_worker(datadir, scratch + '/mpi-out', messages, meter)
+        finally:
+            os.chdir(cwd)
+
+    result = {'commit': _git_commit(),
+              'host': platform.node(),
+              'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'exposures': exposures,
+              'ccd_shape': CCD_SHAPE,
+              'backend': backend,
+              'stages': meter.results,
+              'errors': errors}
+    out = open(output, 'w')
+    json.dump(result, out, indent=2, sort_keys=True)
+    out.close()
+    return result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+        format="%(asctime)s/%(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S" )
+    if len(sys.argv) < 3:
+        print('Usage: python benchmark.py workdir results.json '
+              '[exposures] [numpy|montage] [--no-mpi]')
+        sys.exit(1)
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    main(args[0], args[1],
+         exposures=int(args[2]) if len(args) > 2 else 12,
+         backend=args[3] if len(args) > 3 else 'numpy',
+         mpi='--no-mpi' not in sys.argv)
@@ -0,0 +1,198 @@
+"""
+Global background model solved as a sparse linear least-squares system,
+as an alternative to the iterative mBgModel.
+
+A strip of tiles, or the full survey, can be solved jointly by adding the
+tables of several tiles to one BackgroundModel (level-only mode): images
+are identified by filename, so an exposure which appears in several tiles
+receives a single offset.
+"""
+
+import logging
+import time
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+from scipy.sparse.csgraph import connected_components
+
+from montage import read_tbl, write_tbl
+
+
+class BackgroundModel(object):
+    """
+    Solves for the background corrections which minimise the differences
+    between all overlapping pairs of images.
+
+    :param level_only:
+    Fit a constant offset per image (like mBgModel -l) instead of a plane.
+    """
+
+    def __init__(self, level_only=True):
+        self.level_only = level_only
+        self._index = {}  # Image filename -> unknown number
+        self._pairs = []  # (plus, minus, level, a, b, weight, width, height)
+        self._tiles = 0
+        self.solution = None
+        self.stats = {}
+
+    def _unknown(self, fname):
+        if fname not in self._index:
+            self._index[fname] = len(self._index)
+        return self._index[fname]
+
+    def add_tile(self, projtbl, fittbl):
+        """
+        Adds the images and overlap fits of a tile to the system.
+
+        :param projtbl:
+        Table of projected images written by mImgtbl.
+
+        :param fittbl:
+        Table of difference fits written by mFitExec (or overlaps.py).
+        """
+        if self._tiles > 0 and not self.level_only:
+            raise Exception('Joint solutions of several tiles require level_only, '
+                            'because plane coefficients depend on the tile frame')
+        self._tiles += 1
+        header, proj = read_tbl(projtbl)
+        fnames = dict(zip(proj['cntr'], proj['fname']))
+        for fname in proj['fname']:
+            self._unknown(fname)
+        header, fit = read_tbl(fittbl)
+        for i in range(len(fit['plus'])):
+            a, b, c = fit['a'][i], fit['b'][i], fit['c'][i]
+            # The difference evaluated at the centre of the overlap
+            level = a * fit['xcenter'][i] + b * fit['ycenter'][i] + c
+            self._pairs.append( (self._unknown(fnames[fit['plus'][i]]),
+                                 self._unknown(fnames[fit['minus'][i]]),
+                                 level, a, b, np.sqrt(fit['npixel'][i]),
+                                 fit['xcenter'][i], fit['ycenter'][i],
+                                 max(1., fit['boxwidth'][i]),
+                                 max(1., fit['boxheight'][i])) )
+
+    def _system(self):
+        """
+        Returns the sparse design matrix, right-hand side and weights.
+
+        Every pair contributes one equation for the level at the centre of
+        the overlap and, in plane mode, two for the slopes (scaled by the
+        size of the overlap to give them the units of a level difference).
+        Each connected group of images gets gauge equations which set its
+        mean correction to zero, as only differences are constrained.
+        """
+        n = len(self._index)
+        npar = 1 if self.level_only else 3
+        rows, cols, vals, rhs, weights = [], [], [], [], []
+
+        def equation(terms, value, weight):
+            r = len(rhs)
+            for col, val in terms:
+                rows.append(r)
+                cols.append(col)
+                vals.append(val)
+            rhs.append(value)
+            weights.append(weight)
+
+        for p, m, level, a, b, w, xc, yc, width, height in self._pairs:
+            if self.level_only:
+                equation([(p, 1.), (m, -1.)], level, w)
+            else:
+                # Unknowns are ordered (a, b, c) for each image
+                equation([(3*p, xc), (3*p+1, yc), (3*p+2, 1.),
+                          (3*m, -xc), (3*m+1, -yc), (3*m+2, -1.)], level, w)
+                equation([(3*p, width), (3*m, -width)], a * width, w)
+                equation([(3*p+1, height), (3*m+1, -height)], b * height, w)
+        npairs = len(rhs)
+
+        # Gauge: the mean correction of each connected group is zero
+        adjacency = sparse.coo_matrix(
+                        (np.ones(len(self._pairs)),
+                         ([q[0] for q in self._pairs], [q[1] for q in self._pairs])),
+                        shape=(n, n))
+        ncomp, labels = connected_components(adjacency, directed=False)
+        for k in range(ncomp):
+            members = np.nonzero(labels == k)[0]
+            for par in range(npar):
+                equation([(npar*i + par, 1.) for i in members], 0., 1.)
+
+        A = sparse.csr_matrix((vals, (rows, cols)), shape=(len(rhs), n*npar))
+        return A, np.array(rhs), np.array(weights), npairs, ncomp
+
+    def solve(self, log=logging):
+        """
+        Solves the weighted least-squares problem directly.
+
+        Returns a dict of statistics: number of images, pairs and connected
+        groups, the weighted RMS of the pair differences before and after
+        the correction, the largest remaining difference and the residual
+        norm of the linear solve.
+        """
+        start = time.time()
+        A, y, w, npairs, ncomp = self._system()
+        Aw = sparse.diags(w).dot(A)
+        yw = w * y
+        # Normal equations: symmetric, positive definite thanks to the gauge
+        N = Aw.T.dot(Aw).tocsc()
+        x = splinalg.spsolve(N, Aw.T.dot(yw))
+        self.solution = x
+
+        before = yw[:npairs]
+        after = (Aw.dot(x) - yw)[:npairs]
+        level_rows = np.arange(npairs) if self.level_only else np.arange(0, npairs, 3)
+        residual = A.dot(x) - y
+        self.stats = {'images': len(self._index),
+                      'pairs': len(self._pairs),
+                      'groups': ncomp,
+                      'rms_before': float(np.sqrt(np.mean(before**2))) if npairs else 0.,
+                      'rms_after': float(np.sqrt(np.mean(after**2))) if npairs else 0.,
+                      'max_level_residual': float(np.abs(residual[level_rows]).max())
+                                            if npairs else 0.,
+                      'solver_residual': float(np.linalg.norm(N.dot(x) - Aw.T.dot(yw))),
+                      'seconds': time.time() - start}
+        log.info(('Background model: %(images)d images, %(pairs)d pairs, '
+                  + '%(groups)d groups, weighted rms %(rms_before).4g -> '
+                  + '%(rms_after).4g, max level residual %(max_level_residual).4g, '
+                  + 'solver residual %(solver_residual).2g (%(seconds).1fs)')
+                 % self.stats)
+        return self.stats
+
+    def correction(self, fname):
+        """
+        Returns the (a, b, c) plane to subtract from an image.
+
+        """
+        i = self._index[fname]
+        if self.level_only:
+            return (0., 0., self.solution[i])
+        return tuple(self.solution[3*i:3*i+3])
+
+    def write_corrections(self, projtbl, corrtbl):
+        """
+        Writes the corrections of a tile's images in the format of mBgModel.
+
+        Every image in 'projtbl' receives a correction (zero if it does not
+        overlap any other image), such that mBgExec keeps all of them.
+        """
+        header, proj = read_tbl(projtbl)
+        planes = [self.correction(fname) for fname in proj['fname']]
+        write_tbl(corrtbl, [('id', 'int', '%d', proj['cntr']),
+                            ('a', 'double', '%.10e', [p[0] for p in planes]),
+                            ('b', 'double', '%.10e', [p[1] for p in planes]),
+                            ('c', 'double', '%.10e', [p[2] for p in planes])])
+
+
+def solve_joint(tiles, level_only=True, log=logging):
+    """
+    Solves the background of several tiles in one system.
+
+    :param tiles:
+    List of (projtbl, fittbl, corrtbl) filenames; the corrections of each
+    tile are written to its corrtbl.
+    """
+    model = BackgroundModel(level_only)
+    for projtbl, fittbl, corrtbl in tiles:
+        model.add_tile(projtbl, fittbl)
+    stats = model.solve(log)
+    for projtbl, fittbl, corrtbl in tiles:
+        model.write_corrections(projtbl, corrtbl)
+    return stats
@@ -0,0 +1,261 @@
+"""
+Caches of intermediate products which can be shared between tiles.
+
+"""
+
+import os
+import json
+import hashlib
+import threading
+import pyfits
+import numpy as np
+
+from mosaic import md5sum
+from montage import read_template, write_template, montage_names
+
+
+class ProjectionCache(object):
+    """
+    Content-addressed store of mProject results shared between tiles.
+
+    Images are projected into a canonical frame which has the same pixel
+    grid as the target header, but extends around the full circle in
+    longitude. All the tiles in a row of a TileGrid share this
+    frame, such that a projection can be re-used by any neighbouring tile
+    by shifting CRPIX1 and cropping the columns outside the tile.
+
+    This only holds for tiles centred on the equator (CRVAL2=0): elsewhere
+    the CAR frame is oblique, and changing CRVAL1 rotates it rather than
+    shifting it (see coverage.car_pix2world). Projections for such tiles
+    are therefore made in, and shared only with, the exact target frame.
+
+    :param directory:
+    Where to keep the cache (e.g. on the scratch filesystem.)
+
+    :param max_bytes:
+    Size cap; the least recently used entries are evicted beyond this.
+    """
+
+    # Longitude at which the canonical frame is anchored
+    CANONICAL_CRVAL1 = 180.0
+
+    def __init__(self, directory, max_bytes=50*1024**3):
+        self._dir = directory
+        self._max_bytes = max_bytes
+        if not os.path.exists(self._dir + '/hashes'):
+            os.makedirs(self._dir + '/hashes')
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def file_hash(self, filename):
+        """
+        Returns the MD5 of a file, memoised on disk by inode, size and mtime.
+
+        Hard links to the same file share the memo.
+        """
+        st = os.stat(filename)
+        memo = '%s/hashes/%s' % (self._dir, hashlib.md5(
+                    ('%d %d %d %r' % (st.st_dev, st.st_ino,
+                                      st.st_size, st.st_mtime)).encode()
+                    ).hexdigest())
+        if os.path.exists(memo):
+            return open(memo, 'r').read().strip()
+        digest = md5sum(filename)
+        tmp = '%s.%d.%d' % (memo, os.getpid(), threading.current_thread().ident)
+        output = open(tmp, 'w')
+        output.write(digest)
+        output.close()
+        os.rename(tmp, memo)
+        return digest
+
+    def canonical_frame(self, header):
+        """
+        Returns the canonical template cards for a target template header.
+
+        The frame keeps the target's pixel phase, such that pixels in both
+        frames differ by an integer offset. Oblique frames (CRVAL2 not zero)
+        are returned unchanged.
+        """
+        cards = dict(read_template(header))
+        if float(cards['CRVAL2']) != 0:
+            return read_template(header)
+        cdelt1 = float(cards['CDELT1'])
+        crval1 = float(cards['CRVAL1'])
+        # Pixel coordinate of CANONICAL_CRVAL1 in the target frame
+        pix = float(cards['CRPIX1']) + (self.CANONICAL_CRVAL1 - crval1) / cdelt1
+        phase = round(pix - np.floor(pix), 6) % 1.0
+        halfwidth = int(np.ceil(180. / abs(cdelt1)))
+        canonical = []
+        for key, value in read_template(header):
+            if key == 'NAXIS1':
+                value = '%d' % (2 * halfwidth + 1)
+            elif key == 'CRVAL1':
+                value = '%.7f' % self.CANONICAL_CRVAL1
+            elif key == 'CRPIX1':
+                value = '%.7f' % (halfwidth + 1 + phase)
+            canonical.append( (key, value) )
+        return canonical
+
+    def write_canonical_frame(self, header, filename):
+        """
+        Writes the canonical template header for 'header' to 'filename'.
+
+        """
+        write_template(filename, self.canonical_frame(header))
+
+    def key(self, image, weightmap, conf_threshold, hdu, header, extra=None):
+        """
+        Returns the cache key of the projection of one HDU of an image.
+
+        :param image:
+        Input image (its contents are hashed.)
+
+        :param weightmap:
+        Weight map passed to mProject -w (its contents are hashed.)
+
+        :param conf_threshold:
+        Weight threshold passed to mProject -t.
+
+        :param hdu:
+        HDU number.
+
+        :param header:
+        Target template header (only the WCS of its canonical frame counts.)
+
+        :param extra:
+        Any other JSON-serialisable value which affects the result.
+        """
+        ingredients = [self.file_hash(image), self.file_hash(weightmap),
+                       conf_threshold, hdu,
+                       self.canonical_frame(header), extra]
+        return hashlib.md5(json.dumps(ingredients, sort_keys=True).encode()
+                           ).hexdigest()
+
+    def _entry(self, key):
+        return ('%s/%s.fits' % (self._dir, key),
+                '%s/%s_area.fits' % (self._dir, key))
+
+    def fetch(self, key, header, output, count=True):
+        """
+        Writes a cached projection, cropped to 'header', to 'output'.
+
+        :param output:
+        Filename as passed to mProject; the area map is written alongside.
+
+        :param count:
+        Whether to include this lookup in the hit/miss statistics.
+
+        Returns False on a cache miss.
+        """
+        image, area = self._entry(key)
+        try:
+            for src, dst in zip((image, area), montage_names(output)):
+                self._crop(src, header, dst)
+            os.utime(image, None)  # Mark as recently used
+        except (IOError, OSError):
+            # Missing, or evicted by another process in the meantime
+            if count:
+                with self._lock:
+                    self.misses += 1
+            return False
+        if count:
+            with self._lock:
+                self.hits += 1
+        return True
+
+    def _crop(self, filename, header, output):
+        """
+        Moves a canonical-frame image into the frame of 'header'.
+
+        """
+        target = dict(read_template(header))
+        naxis1 = int(target['NAXIS1'])
+        crpix1 = float(target['CRPIX1'])
+        canonical = dict(self.canonical_frame(header))
+        # Integer offset between canonical and target pixel coordinates
+        # (zero if the canonical frame is the target frame itself)
+        offset = (float(canonical['CRPIX1']) - crpix1
+                  - (float(canonical['CRVAL1']) - float(target['CRVAL1']))
+                  / float(target['CDELT1']))
+        offset = int(round(offset))
+
+        hdulist = pyfits.open(filename)
+        hdr = hdulist[0].header
+        data = hdulist[0].data
+        # Target pixel coordinate of the first column of the cached image
+        first = float(canonical['CRPIX1']) - hdr['CRPIX1'] + 1 - offset
+        first = int(round(first))
+        j0 = max(0, 1 - first)
+        j1 = min(data.shape[1], naxis1 - first + 1)
+        j1 = max(j0, j1)
+        hdr = hdr.copy()
+        hdr.update('CRVAL1', float(target['CRVAL1']))
+        hdr.update('CRPIX1', crpix1 - (first + j0 - 1))
+        tmp = '%s.tmp.fits' % output
+        pyfits.PrimaryHDU(np.ascontiguousarray(data[:, j0:j1]), hdr
+                          ).writeto(tmp, clobber=True)
+        hdulist.close()
+        os.rename(tmp, output)
+
+    def store(self, key, output):
+        """
+        Moves the result of mProject (image and area) into the cache.
+
+        :param output:
+        Filename which was passed to mProject.
+        """
+        image, area = self._entry(key)
+        src_image, src_area = montage_names(output)
+        # The image is moved last: its presence marks a complete entry
+        os.rename(src_area, area)
+        os.rename(src_image, image)
+        self.evict()
+
+    def scratch_name(self, key):
+        """
+        Returns a unique temporary filename for projecting 'key' into the cache.
+
+        """
+        return '%s/%s.tmp%d-%d.fits' % (self._dir, key, os.getpid(),
+                                        threading.current_thread().ident)
+
+    def evict(self):
+        """
+        Deletes the least recently used entries beyond the size cap.
+
+        """
+        entries = []
+        total = 0
+        for filename in os.listdir(self._dir):
+            if not filename.endswith('.fits') or filename.endswith('_area.fits') \
+                    or '.tmp' in filename:
+                continue
+            key = filename[:-5]
+            image, area = self._entry(key)
+            try:
+                size = os.path.getsize(image) + os.path.getsize(area)
+                entries.append( (os.path.getmtime(image), size, key) )
+            except OSError:
+                continue
+            total += size
+        for mtime, size, key in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            for filename in self._entry(key):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self):
+        """
+        Returns a one-line summary of the hit/miss statistics.
+
+        """
+        lookups = self.hits + self.misses
+        return 'Projection cache: %d hits, %d misses (%.0f%% hit rate)' % (
+                    self.hits, self.misses,
+                    100. * self.hits / lookups if lookups else 0.)
+
@@ -0,0 +1,217 @@
+"""
+Columnar catalogue of the survey images, stored as a NumPy structured
+array which can be memory-mapped.
+
+The catalogue replaces the text tables which were parsed by hand in
+several places; Montage image tables (.tbl) are exported from it only
+where a Montage tool needs one.
+"""
+
+import os
+import re
+import numpy as np
+
+from montage import read_tbl, write_tbl
+
+
+# (name, dtype, IPAC type, format) of the columns; the columns with an IPAC
+# type are those of the image tables written by mImgtbl, in their order
+COLUMNS = [('cntr', np.int64, 'int', '%d'),
+           ('ctype1', 'U16', 'char', '%s'),
+           ('ctype2', 'U16', 'char', '%s'),
+           ('naxis1', np.int32, 'int', '%d'),
+           ('naxis2', np.int32, 'int', '%d'),
+           ('crval1', np.float64, 'double', '%.10f'),
+           ('crval2', np.float64, 'double', '%.10f'),
+           ('crpix1', np.float64, 'double', '%.5f'),
+           ('crpix2', np.float64, 'double', '%.5f'),
+           ('cdelt1', np.float64, 'double', '%.10e'),
+           ('cdelt2', np.float64, 'double', '%.10e'),
+           ('crota2', np.float64, 'double', '%.7f'),
+           ('equinox', np.float64, 'double', '%.1f'),
+           ('ra', np.float64, 'double', '%.10f'),
+           ('dec', np.float64, 'double', '%.10f'),
+           ('ra1', np.float64, 'double', '%.10f'),
+           ('dec1', np.float64, 'double', '%.10f'),
+           ('ra2', np.float64, 'double', '%.10f'),
+           ('dec2', np.float64, 'double', '%.10f'),
+           ('ra3', np.float64, 'double', '%.10f'),
+           ('dec3', np.float64, 'double', '%.10f'),
+           ('ra4', np.float64, 'double', '%.10f'),
+           ('dec4', np.float64, 'double', '%.10f'),
+           ('size', np.int64, 'int', '%d'),
+           ('hdu', np.int16, 'int', '%d'),
+           ('fname', 'U256', 'char', '%s'),
+           # Survey metadata, not part of the Montage tables
+           ('run', np.int64, None, None),
+           ('field', 'U32', None, None),
+           ('filter', 'U4', None, None),
+           ('confmap', 'U256', None, None),
+           ('qcflags', np.int32, None, None)]
+
+DTYPE = np.dtype([(name, dtype) for name, dtype, kind, fmt in COLUMNS])
+
+# Values of the columns which are not known
+DEFAULTS = {'int': -1, 'double': np.nan, 'char': ''}
+
+
+def _run_number(fname):
+    """
+    Returns the run number encoded in an IPHAS filename (rNNNNNN.fit).
+
+    """
+    match = re.match(r'^r(\d+)', os.path.basename(fname))
+    if match is None:
+        return -1
+    return int(match.group(1))
+
+
+class Catalogue(object):
+    """
+    Table of survey images: one row per image (or per HDU of an image).
+
+    Columns are accessed as catalogue['fname']; indexing with a list of
+    rows or a boolean mask returns a new Catalogue.
+
+    :param data:
+    NumPy structured array with dtype DTYPE.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        return Catalogue(self.data[key])
+
+    @classmethod
+    def empty(cls, n):
+        """
+        Returns a catalogue of 'n' rows with unknown values.
+
+        """
+        data = np.zeros(n, dtype=DTYPE)
+        for name, dtype, kind, fmt in COLUMNS:
+            if kind is not None:
+                data[name] = DEFAULTS[kind]
+        data['cntr'] = np.arange(n)
+        data['run'] = -1
+        return cls(data)
+
+    @classmethod
+    def from_columns(cls, **columns):
+        """
+        Creates a catalogue from arrays of values for some of the columns.
+
+        """
+        n = len(list(columns.values())[0]) if columns else 0
+        catalogue = cls.empty(n)
+        for name, values in columns.items():
+            catalogue.data[name] = values
+        if 'run' not in columns:
+            catalogue.data['run'] = [_run_number(f) for f in catalogue.data['fname']]
+        return catalogue
+
+    @classmethod
+    def read_tbl(cls, filename):
+        """
+        Reads an image table written by mImgtbl (or mCoverageCheck).
+
+        """
+        header, cols = read_tbl(filename)
+        names = [name for name, dtype, kind, fmt in COLUMNS]
+        return cls.from_columns(**dict((name, values) for name, values
+                                       in cols.items() if name in names))
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """
+        Reads a catalogue written by save(), memory-mapped by default.
+
+        """
+        return cls(np.load(filename, mmap_mode='r' if mmap else None))
+
+    def save(self, filename):
+        """
+        Writes the catalogue to a binary NumPy file.
+
+        """
+        # Write to a temporary file first, the catalogue may be shared by many jobs
+        tmp = '%s.tmp%d.npy' % (filename, os.getpid())
+        np.save(tmp, np.asarray(self.data))
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load_or_convert(cls, tbl, filename=None):
+        """
+        Loads the catalogue of an image table, converting the table if the
+        catalogue is missing or older.
+
+        :param filename:
+        Catalogue filename (default: '<tbl>.npy').
+        """
+        if filename is None:
+            filename = tbl + '.npy'
+        if (os.path.exists(filename)
+                and os.path.getmtime(filename) >= os.path.getmtime(tbl)):
+            return cls.load(filename)
+        catalogue = cls.read_tbl(tbl)
+        catalogue.save(filename)
+        return catalogue
+
+    def changed(self, previous):
+        """
+        Compares the catalogue with an earlier version of it, matching the
+        rows by filename and HDU.
+
+        Returns (rows, previous_rows): the rows of this catalogue which are
+        new or differ in any column from 'previous', and the rows of
+        'previous' which are gone or differ.
+        """
+        # Multi-HDU images appear once per HDU, hence the filename alone
+        # does not identify a row
+        index = dict(zip(zip(previous.data['fname'], previous.data['hdu']),
+                         range(len(previous))))
+        i, j = [], []
+        for row, key in enumerate(zip(self.data['fname'], self.data['hdu'])):
+            if key in index:
+                i.append(row)
+                j.append(index[key])
+        i, j = np.array(i, dtype=int), np.array(j, dtype=int)
+        differ = np.zeros(len(i), dtype=bool)
+        for name, dtype, kind, fmt in COLUMNS:
+            # Row numbers change whenever a row is inserted
+            if name == 'cntr':
+                continue
+            a, b = self.data[name][i], previous.data[name][j]
+            same = a == b
+            if a.dtype.kind == 'f':
+                same |= np.isnan(a) & np.isnan(b)
+            differ |= ~same
+        return (np.setdiff1d(np.arange(len(self)), i[~differ]),
+                np.setdiff1d(np.arange(len(previous)), j[~differ]))
+
+    def corners(self):
+        """
+        Returns the (ra, dec) of the corners as arrays of shape (n, 4).
+
+        """
+        ra = np.array([self.data['ra%d' % i] for i in range(1, 5)]).T
+        dec = np.array([self.data['dec%d' % i] for i in range(1, 5)]).T
+        return ra.reshape(-1, 4), dec.reshape(-1, 4)
+
+    def write_tbl(self, filename, rows=None):
+        """
+        Exports (a subset of) the catalogue as a Montage image table.
+
+        :param rows:
+        Row numbers or boolean mask to export (default: all rows.)
+        """
+        data = self.data if rows is None else self.data[rows]
+        write_tbl(filename, [(name, kind, fmt, data[name])
+                             for name, dtype, kind, fmt in COLUMNS
+                             if kind is not None])
@@ -0,0 +1,229 @@
+"""
+In-process co-addition of reprojected images, as an alternative to mAdd.
+
+"""
+
+import logging
+import numpy as np
+import pyfits
+
+from montage import read_template, read_tbl, montage_names
+
+
+def template_to_header(template):
+    """
+    Converts a Montage template header into a pyfits header for a
+    double-precision image.
+
+    """
+    hdr = pyfits.Header()
+    hdr.update('SIMPLE', True)
+    hdr.update('BITPIX', -64)
+    for key, value in read_template(template):
+        if key in ['SIMPLE', 'BITPIX', 'END']:
+            continue
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        hdr.update(key, value)
+    return hdr
+
+
+class CoaddOutput(object):
+    """
+    Describes one co-added image to produce.
+
+    :param filename:
+    Output FITS file; the area map is written to '<filename>_area.fits'.
+
+    :param template:
+    Montage template header defining the output frame.
+
+    :param corrections:
+    Optional {image filename: (a, b, c)} background planes to subtract, as
+    computed by mBgModel. Images without a correction are left out, as
+    they would be by mBgExec.
+    """
+
+    def __init__(self, filename, template, corrections=None):
+        self.filename = filename
+        self.header = template_to_header(template)
+        self.corrections = corrections
+        self.naxis1 = int(self.header['NAXIS1'])
+        self.naxis2 = int(self.header['NAXIS2'])
+        self.crpix1 = float(self.header['CRPIX1'])
+        self.crpix2 = float(self.header['CRPIX2'])
+
+
+def _offset(crpix_a, crpix_b):
+    """
+    Integer pixel offset between two frames on the same grid.
+
+    """
+    offset = crpix_a - crpix_b
+    if abs(offset - round(offset)) > 1e-3:
+        raise Exception('Frames are not aligned on the same pixel grid '
+                        '(CRPIX offset %s)' % offset)
+    return int(round(offset))
+
+
+def coadd(images, outputs, max_bytes=512*1024**2, log=logging, previews=None):
+    """
+    Area-weighted mean co-addition of projected images, like 'mAdd -a mean -e'.
+
+    The outputs are produced in row blocks, such that the memory required
+    is bounded by 'max_bytes' regardless of the size of the mosaic. Each
+    input is read only once, even when several outputs are produced.
+
+    :param images:
+    List of (filename, crpix1, crpix2, naxis1, naxis2) tuples of the
+    projected images; the area maps are expected alongside (mProject naming).
+
+    :param outputs:
+    List of CoaddOutput objects, all on the same pixel grid.
+
+    :param previews:
+    Optional list of quicklook.Preview objects (or None), one per output,
+    which are fed the co-added rows as they are written.
+    """
+    if previews is None:
+        previews = [None] * len(outputs)
+    ref = outputs[0]
+    # Pixel ranges in the frame of the first output (0-based, end exclusive)
+    def span(crpix1, crpix2, naxis1, naxis2):
+        x0 = _offset(ref.crpix1, crpix1)
+        y0 = _offset(ref.crpix2, crpix2)
+        return (x0, x0 + naxis1, y0, y0 + naxis2)
+    out_spans = [span(o.crpix1, o.crpix2, o.naxis1, o.naxis2) for o in outputs]
+    img_spans = [span(*img[1:]) for img in images]
+
+    y_start = min(s[2] for s in out_spans)
+    y_stop = max(s[3] for s in out_spans)
+    # Two float64 accumulators per output pixel, plus a block of input
+    width = sum(o.naxis1 for o in outputs) + max([s[1] - s[0] for s in img_spans] + [0])
+    block = int(max(1, max_bytes // (width * 8 * 4)))
+    log.debug('Co-adding %d images into %d outputs, %d rows per block'
+              % (len(images), len(outputs), block))
+
+    streams = [(pyfits.StreamingHDU(o.filename, o.header),
+                pyfits.StreamingHDU(montage_names(o.filename)[1], o.header))
+               for o in outputs]
+
+    for y0 in range(y_start, y_stop, block):
+        y1 = min(y0 + block, y_stop)
+        acc = []
+        for (ox0, ox1, oy0, oy1) in out_spans:
+            rows = max(0, min(y1, oy1) - max(y0, oy0))
+            acc.append( (np.zeros((rows, ox1 - ox0)), np.zeros((rows, ox1 - ox0))) )
+
+        for (filename, crpix1, crpix2, naxis1, naxis2), (ix0, ix1, iy0, iy1) \
+                in zip(images, img_spans):
+            r0, r1 = max(y0, iy0), min(y1, iy1)
+            if r0 >= r1:
+                continue
+            targets = [k for k, s in enumerate(out_spans)
+                       if max(r0, s[2]) < min(r1, s[3])
+                       and max(ix0, s[0]) < min(ix1, s[1])]
+            if not targets:
+                continue
+            # Only the rows required for this block are read from disk
+            image_file, area_file = montage_names(filename)
+            fimg = pyfits.open(image_file, memmap=True)
+            farea = pyfits.open(area_file, memmap=True)
+            data = np.array(fimg[0].data[r0 - iy0:r1 - iy0], dtype=np.float64)
+            area = np.array(farea[0].data[r0 - iy0:r1 - iy0], dtype=np.float64)
+            fimg.close()
+            farea.close()
+            valid = np.isfinite(data) & (area > 0)
+            area[~valid] = 0.
+            data[~valid] = 0.
+
+            for k in targets:
+                o = outputs[k]
+                ox0, ox1, oy0, oy1 = out_spans[k]
+                flux = data
+                if o.corrections is not None:
+                    if filename not in o.corrections:
+                        continue
+                    # Plane in pixel coordinates relative to the reference pixel
+                    a, b, c = o.corrections[filename]
+                    x = np.arange(1, naxis1 + 1) - crpix1
+                    y = np.arange(r0 - iy0 + 1, r1 - iy0 + 1) - crpix2
+                    flux = data - (a * x[np.newaxis, :] + b * y[:, np.newaxis] + c)
+                # Overlap between this image and output, in both frames
+                rr0, rr1 = max(r0, oy0), min(r1, oy1)
+                cc0, cc1 = max(ix0, ox0), min(ix1, ox1)
+                src = (slice(rr0 - r0, rr1 - r0), slice(cc0 - ix0, cc1 - ix0))
+                dst = (slice(rr0 - max(y0, oy0), rr1 - max(y0, oy0)),
+                       slice(cc0 - ox0, cc1 - ox0))
+                acc[k][0][dst] += flux[src] * area[src]
+                acc[k][1][dst] += area[src]
+
+        for (fa, a), (stream_img, stream_area), preview \
+                in zip(acc, streams, previews):
+            if a.shape[0] == 0:
+                continue
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(a > 0, fa / a, np.nan)
+            stream_img.write(mean)
+            stream_area.write(a)
+            if preview is not None:
+                preview.add(mean)
+
+    for stream_img, stream_area in streams:
+        stream_img.close()
+        stream_area.close()
+
+
+def read_images(tbl, imgdir):
+    """
+    Returns the list of images in a table written by mImgtbl, as expected
+    by coadd().
+
+    """
+    header, cols = read_tbl(tbl)
+    images = []
+    seen = set()
+    for i in range(len(cols['fname'])):
+        filename = '%s/%s' % (imgdir, cols['fname'][i])
+        if filename in seen:
+            continue
+        seen.add(filename)
+        images.append( (filename,
+                        float(cols['crpix1'][i]), float(cols['crpix2'][i]),
+                        int(cols['naxis1'][i]), int(cols['naxis2'][i])) )
+    return images
+
+
+def compare(filename_a, filename_b, max_bytes=256*1024**2):
+    """
+    Compares two images bit by bit, e.g. to validate coadd() against mAdd.
+
+    Returns a dict with the number of pixels, the number of pixels whose
+    bits differ, the number with a different NaN mask and the maximum
+    absolute difference between finite pixels.
+    """
+    fa = pyfits.open(filename_a, memmap=True)
+    fb = pyfits.open(filename_b, memmap=True)
+    a, b = fa[0].data, fb[0].data
+    if a.shape != b.shape:
+        raise Exception('Shapes differ: %s vs %s' % (a.shape, b.shape))
+    result = {'pixels': a.size, 'bits_differ': 0, 'nan_differ': 0,
+              'max_abs_diff': 0.}
+    block = int(max(1, max_bytes // (a.shape[1] * 8 * 2)))
+    for y0 in range(0, a.shape[0], block):
+        ba = np.array(a[y0:y0+block], dtype=np.float64)
+        bb = np.array(b[y0:y0+block], dtype=np.float64)
+        result['bits_differ'] += int((ba.view(np.uint64) != bb.view(np.uint64)).sum())
+        na, nb = np.isnan(ba), np.isnan(bb)
+        result['nan_differ'] += int((na != nb).sum())
+        both = ~na & ~nb
+        if both.any():
+            result['max_abs_diff'] = max(result['max_abs_diff'],
+                                         float(np.abs(ba[both] - bb[both]).max()))
+    fa.close()
+    fb.close()
+    return result
@@ -0,0 +1,313 @@
+"""
+In-memory spatial index of the survey images, replacing mCoverageCheck.
+
+"""
+
+import logging
+import os
+import numpy as np
+
+from catalogue import Catalogue
+from montage import read_template
+
+
+# Rotation matrix from equatorial (J2000) to Galactic cartesian coordinates
+_EQ2GAL = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+                    [+0.4941094278755837, -0.4448296299600112, +0.7469822444972189],
+                    [-0.8676661490190047, -0.1980763734312015, +0.4559837761750669]])
+
+
+def _to_xyz(lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.array([np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)])
+
+
+def _from_xyz(xyz):
+    lon = np.degrees(np.arctan2(xyz[1], xyz[0])) % 360.
+    lat = np.degrees(np.arcsin(np.clip(xyz[2], -1, 1)))
+    return lon, lat
+
+
+def equatorial_to_galactic(ra, dec):
+    """
+    Converts J2000 (ra, dec) arrays to Galactic (l, b), in degrees.
+
+    """
+    xyz = _to_xyz(np.ravel(ra), np.ravel(dec))
+    l, b = _from_xyz(np.dot(_EQ2GAL, xyz))
+    return l.reshape(np.shape(ra)), b.reshape(np.shape(dec))
+
+
+def galactic_to_equatorial(l, b):
+    """
+    Converts Galactic (l, b) arrays to J2000 (ra, dec), in degrees.
+
+    """
+    xyz = _to_xyz(np.ravel(l), np.ravel(b))
+    ra, dec = _from_xyz(np.dot(_EQ2GAL.T, xyz))
+    return ra.reshape(np.shape(l)), dec.reshape(np.shape(b))
+
+
+def car_pix2world(cards, p1, p2):
+    """
+    Converts pixel coordinates of a CAR template header to world coordinates.
+
+    Implements the spherical rotation of the FITS WCS standard for the
+    plate carree projection with identity PC matrix and default LONPOLE.
+
+    :param cards:
+    Dict of template header keywords (see montage.read_template); the
+    values may also be arrays which broadcast against the pixel coordinates,
+    to convert the pixels of many headers at once.
+    """
+    def value(key):
+        return np.asarray(cards[key], dtype=float)
+    phi = value('CDELT1') * (np.asarray(p1, dtype=float) - value('CRPIX1'))
+    theta = value('CDELT2') * (np.asarray(p2, dtype=float) - value('CRPIX2'))
+    lon0, lat0 = value('CRVAL1'), value('CRVAL2')
+    # Native longitude and celestial coordinates of the celestial pole
+    north = lat0 >= 0
+    phi_p = np.where(north, 0., 180.)
+    lon_p = np.where(north, lon0 - 180., lon0)
+    lat_p = np.where(north, 90. - lat0, 90. + lat0)
+    phi, theta, lat_p = np.radians(phi), np.radians(theta), np.radians(lat_p)
+    dphi = phi - np.radians(phi_p)
+    lat = np.arcsin(np.clip(np.sin(theta) * np.sin(lat_p)
+                    + np.cos(theta) * np.cos(lat_p) * np.cos(dphi), -1, 1))
+    lon = lon_p + np.degrees(np.arctan2(-np.cos(theta) * np.sin(dphi),
+                                        np.sin(theta) * np.cos(lat_p)
+                                        - np.cos(theta) * np.sin(lat_p) * np.cos(dphi)))
+    return lon % 360., np.degrees(lat)
+
+
+def car_world2pix(cards, lon, lat):
+    """
+    Converts world coordinates to pixel coordinates of a CAR template
+    header; the inverse of car_pix2world.
+
+    """
+    def value(key):
+        return np.asarray(cards[key], dtype=float)
+    lon0, lat0 = value('CRVAL1'), value('CRVAL2')
+    north = lat0 >= 0
+    phi_p = np.where(north, 0., 180.)
+    lon_p = np.where(north, lon0 - 180., lon0)
+    lat_p = np.radians(np.where(north, 90. - lat0, 90. + lat0))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    dlon = np.radians(np.asarray(lon, dtype=float) - lon_p)
+    theta = np.arcsin(np.clip(np.sin(lat) * np.sin(lat_p)
+                      + np.cos(lat) * np.cos(lat_p) * np.cos(dlon), -1, 1))
+    phi = phi_p + np.degrees(np.arctan2(-np.cos(lat) * np.sin(dlon),
+                                        np.sin(lat) * np.cos(lat_p)
+                                        - np.cos(lat) * np.sin(lat_p) * np.cos(dlon)))
+    # Native longitudes are within [-180, 180) around the reference point
+    phi = (phi + 180.) % 360. - 180.
+    return (phi / value('CDELT1') + value('CRPIX1'),
+            np.degrees(theta) / value('CDELT2') + value('CRPIX2'))
+
+
+def header_footprint(header, samples=16):
+    """
+    Returns the outline of a template header as (lon, lat) arrays.
+
+    :param samples:
+    Number of points along each edge.
+    """
+    cards = dict(read_template(header))
+    n1, n2 = float(cards['NAXIS1']), float(cards['NAXIS2'])
+    t = np.linspace(0, 1, samples, endpoint=False)
+    # Walk around the pixel edges of the image
+    p1 = np.concatenate([0.5 + t*n1, np.repeat(n1+0.5, samples),
+                         n1+0.5 - t*n1, np.repeat(0.5, samples)])
+    p2 = np.concatenate([np.repeat(0.5, samples), 0.5 + t*n2,
+                         np.repeat(n2+0.5, samples), n2+0.5 - t*n2])
+    lon, lat = car_pix2world(cards, p1, p2)
+    if cards['CTYPE1'].startswith('RA'):
+        lon, lat = equatorial_to_galactic(lon, lat)
+    return lon, lat
+
+
+def _unwrap(lon, centre):
+    """
+    Returns longitudes relative to 'centre', in the range [-180, 180).
+
+    """
+    return (lon - centre + 180.) % 360. - 180.
+
+
+def _overlaps(poly_x, poly_y, quads_x, quads_y):
+    """
+    Separating axis test between one convex polygon and many quadrilaterals.
+
+    :param poly_x:
+    :param poly_y:
+    Vertices of the polygon, shape (m,).
+
+    :param quads_x:
+    :param quads_y:
+    Vertices of the quadrilaterals, shape (n, 4).
+
+    Returns a boolean array of shape (n,).
+    """
+    result = np.ones(quads_x.shape[0], dtype=bool)
+
+    def separated(ax, ay, px, py, qx, qy):
+        # Project both shapes on the axis (ax, ay) and test for a gap
+        p = px * ax + py * ay
+        q = qx * ax + qy * ay
+        return (p.max(axis=-1) < q.min(axis=-1)) | (q.max(axis=-1) < p.min(axis=-1))
+
+    # Axes normal to the polygon edges
+    ex = np.roll(poly_x, -1) - poly_x
+    ey = np.roll(poly_y, -1) - poly_y
+    for ax, ay in zip(-ey, ex):
+        result &= ~separated(ax, ay, poly_x[np.newaxis, :], poly_y[np.newaxis, :],
+                             quads_x, quads_y)
+    # Axes normal to the edges of each quadrilateral
+    ex = np.roll(quads_x, -1, axis=1) - quads_x
+    ey = np.roll(quads_y, -1, axis=1) - quads_y
+    for k in range(4):
+        ax, ay = -ey[:, k:k+1], ex[:, k:k+1]
+        result &= ~separated(ax, ay, poly_x[np.newaxis, :], poly_y[np.newaxis, :],
+                             quads_x, quads_y)
+    return result
+
+
+class CoverageIndex(object):
+    """
+    Grid-bucketed index of the corners of all images in a survey table.
+    Queries return row numbers of the table (and of its Catalogue).
+
+    Images are bucketed on the Galactic (l, b) cell containing their centre;
+    a query only tests the images in the cells around a header, using an
+    exact polygon overlap test on their corners.
+
+    :param cell:
+    Size of the index cells (degrees).
+    """
+
+    def __init__(self, cell=1.0):
+        self.cell = cell
+        self._arrays = None
+
+    @classmethod
+    def build(cls, tbl, cell=1.0):
+        """
+        Builds the index from an image table written by mImgtbl.
+
+        """
+        index = cls(cell)
+        catalogue = Catalogue.load_or_convert(tbl)
+        ra, dec = catalogue.corners()
+        l, b = equatorial_to_galactic(ra, dec)
+        # Image centres from the mean of the corner unit vectors
+        cl, cb = _from_xyz(_to_xyz(l, b).mean(axis=2))
+        cx = np.floor(cl / cell).astype(np.int64)
+        cy = np.floor((cb + 90.) / cell).astype(np.int64)
+        ncx = int(np.ceil(360. / cell))
+        cellid = cy * ncx + cx
+        order = np.argsort(cellid, kind='mergesort')
+        # Largest distance between an image centre and its corners
+        margin = max(np.abs(_unwrap(l, cl[:, np.newaxis])).max(),
+                     np.abs(b - cb[:, np.newaxis]).max()) if len(cl) else 0.
+        st = os.stat(tbl)
+        index._arrays = {'l': l[order], 'b': b[order],
+                         'cellid': cellid[order],
+                         'row': order,
+                         'fname': np.asarray(catalogue['fname']),
+                         'margin': np.float64(margin),
+                         'cell': np.float64(cell),
+                         'source': np.array([os.path.abspath(tbl)]),
+                         'source_stat': np.array([st.st_size, st.st_mtime])}
+        return index
+
+    def save(self, filename):
+        """
+        Writes the index to a binary NumPy file.
+
+        """
+        # Write to a temporary file first, the index may be shared by many jobs
+        tmp = '%s.tmp%d.npz' % (filename, os.getpid())
+        np.savez(tmp, **self._arrays)
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads an index written by save().
+
+        """
+        data = np.load(filename)
+        index = cls(float(data['cell']))
+        index._arrays = dict((key, data[key]) for key in data.files)
+        return index
+
+    @classmethod
+    def load_or_build(cls, tbl, filename=None, cell=1.0):
+        """
+        Loads the index of a table, (re)building it if it is missing or stale.
+
+        :param filename:
+        Location of the index (default: the table's filename + '.idx.npz').
+        """
+        if filename is None:
+            filename = tbl + '.idx.npz'
+        if os.path.exists(filename):
+            index = cls.load(filename)
+            st = os.stat(tbl)
+            if ('row' in index._arrays
+                and list(index._arrays['source_stat']) == [st.st_size, st.st_mtime]):
+                return index
+        logging.info('Building coverage index %s' % filename)
+        index = cls.build(tbl, cell)
+        index.save(filename)
+        return index
+
+    def query(self, header):
+        """
+        Returns the row numbers of the images which overlap a template header.
+
+        """
+        a = self._arrays
+        lon, lat = header_footprint(header)
+        centre = _from_xyz(_to_xyz(lon, lat).mean(axis=1))[0]
+        x = _unwrap(lon, centre)
+        margin = float(a['margin'])
+        ncx = int(np.ceil(360. / self.cell))
+
+        # Cells which may hold the centres of overlapping images
+        ix = np.arange(np.floor((x.min() - margin + centre) / self.cell),
+                       np.floor((x.max() + margin + centre) / self.cell) + 1
+                       ).astype(np.int64) % ncx
+        iy = np.arange(np.floor((lat.min() - margin + 90.) / self.cell),
+                       np.floor((lat.max() + margin + 90.) / self.cell) + 1
+                       ).astype(np.int64)
+        cells = (iy[:, np.newaxis] * ncx + ix[np.newaxis, :]).ravel()
+        cells = np.unique(cells)
+        start = np.searchsorted(a['cellid'], cells, side='left')
+        stop = np.searchsorted(a['cellid'], cells, side='right')
+        candidates = np.concatenate([np.arange(i, j) for i, j in zip(start, stop)]
+                                    + [np.zeros(0, dtype=np.int64)])
+
+        hit = _overlaps(x, lat,
+                        _unwrap(a['l'][candidates], centre),
+                        a['b'][candidates])
+        return np.sort(a['row'][candidates[hit]])
+
+    def images(self, header):
+        """
+        Returns the set of image filenames which overlap a template header.
+
+        """
+        return set(self._arrays['fname'][self.query(header)])
+
+    def write_subset(self, rows, output):
+        """
+        Writes the given rows of the source table to 'output'.
+
+        The result has the same columns as the output of mCoverageCheck.
+        """
+        source = str(self._arrays['source'][0])
+        Catalogue.load_or_convert(source).write_tbl(output, rows)
@@ -1,4 +1,10 @@
 import mosaic
+import cache
+import catalogue
+import executor
+import pyramid
+import scheduler
+import scratch
 import logging
 import os
 import sys
@@ -10,6 +16,16 @@ logging.basicConfig(level=logging.DEBUG,
 
 """ CONFIGURATION """
 
+# Options: --backend=local|mpi|pbs selects how the tile/band jobs are run,
+# --task=N runs job N of a PBS job array written by --backend=pbs,
+# --pyramid only updates the pyramids from the finished tiles,
+# --delta only re-mosaics the tiles affected by new or changed exposures
+OPTIONS = dict(arg[2:].split('=', 1) for arg in sys.argv[1:]
+               if arg.startswith('--') and '=' in arg)
+ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+BACKEND = OPTIONS.get('backend', 'local')
+DELTA = '--delta' in sys.argv[1:]
+
 # Machine-dependent settings
 hostname = os.uname()[1]
 if hostname == 'uhppc11.herts.ac.uk':
@@ -18,9 +34,9 @@ if hostname == 'uhppc11.herts.ac.uk':
 elif hostname == 'stri-cluster.herts.ac.uk':
     SCRATCHDIR = '/tmp/scratch'
     IMAGEDIR = '/media/0133d764-0bfe-4007-a9cc-a7b1f61c4d1d/iphas'
-elif len(sys.argv)==3:
-    SCRATCHDIR = sys.argv[2]
-    IMAGEDIR = sys.argv[1]
+elif len(ARGS)==2:
+    SCRATCHDIR = ARGS[1]
+    IMAGEDIR = ARGS[0]
 else:
     raise Exception('Script not configured for this machine.')
 
@@ -38,31 +54,169 @@ TILES_X = 64
 TILES_Y = 4
 TILES_OVERLAP = 0.05 # Fraction
 
+# Number of images to reproject concurrently
+WORKERS = 8
+# Co-add the tiles in strips of this many rows, such that mAdd fits in
+# the memory of a core at high resolution (None: whole tiles)
+STRIP_ROWS = None
+# Reproject with 'mProject' or in-process with 'numpy' (bilinear interpolation)
+PROJECTION_BACKEND = 'mProject'
+
+# Filters to mosaic
+BANDS = ['ha', 'r', 'i']
+
+# Resources needed by a single tile/band job
+MEMORY_PER_JOB = 2*1024**3 # bytes
+SCRATCH_PER_JOB = 20*1024**3 # bytes
+# Scratch space left free, and the quota of all tiles together (None: no quota)
+SCRATCH_MIN_FREE = 50*1024**3 # bytes
+SCRATCH_QUOTA = None # bytes
+# Maximum number of tile/band jobs to run concurrently
+JOBS = 4
+# Cache of reprojected images (None: off). Projections are only shared
+# between neighbouring tiles in rows centred on the equator (see
+# cache.ProjectionCache), which this grid has none of; otherwise every
+# miss writes the projection twice, hence the cache is off by default
+PROJECTION_CACHE_SIZE = None # bytes
+# Tile headers (the expanded ones have the suffix .expanded)
+HEADER = '/tmp/tile%03d-normal.hdr'
+# Job array written by --backend=pbs
+PBS_JOBFILE = 'iphas-mosaic.pbs'
+PBS_TASKFILE = 'iphas-mosaic-jobs.json'
+# Multi-resolution pyramid of the finished tiles of each band
+PYRAMIDDIR = SCRATCHDIR + '/pyramid-%s'
+# Survey image tables, and the versions the tiles were last built from
+IMGTABLE = '/home/gb/dev/iphas-mosaic/imgtable/iphas-images-best-%s.tbl'
+BUILT_CATALOGUE = SCRATCHDIR + '/built-%s.npy'
+
 
 
 def create_mosaic(tile, band):
     # Mosaic name
     name = "tile%03d-%s-normal" % (tile, band)
 
-    # Create the header
-    hdr_filename = '/tmp/%s.hdr' % name
-    hdr = mosaic.FitsHeader(GLON1, GLON2,
-                            GLAT1, GLAT2,
-                            RESOLUTION,
-                            TILES_X, TILES_Y, TILES_OVERLAP)
-    hdr.save(hdr_filename, tile)
-    # Montage performs better with an expanded header for the bgmodel
-    hdr._tiles_overlap = 0.4
-    hdr.save(hdr_filename+'.expanded', tile)
+    # The headers of all tiles are written beforehand
+    hdr_filename = HEADER % tile
 
     # Go!
     m = mosaic.Mosaic(name, band, hdr_filename, IMAGEDIR, SCRATCHDIR)
-    #m.mosaic()
-    m.compute_overlaps()
-    m.compute_background()
+    m.workers = WORKERS
+    m.strip_rows = STRIP_ROWS
+    m.projection_backend = PROJECTION_BACKEND
+    if PROJECTION_CACHE_SIZE is not None:
+        m.projection_cache = cache.ProjectionCache(SCRATCHDIR+'/projcache',
+                                                   PROJECTION_CACHE_SIZE)
+    # Keep the projections and overlap fits of unchanged exposures
+    m.delta = DELTA
+    # Delete the intermediates of a tile as soon as they have been consumed
+    m.cleanup = True
+    m.scratch_manager = scratch.ScratchManager(SCRATCHDIR, SCRATCH_QUOTA,
+                                               SCRATCH_MIN_FREE)
+    m.mosaic()
+
+
+def save_headers(tiles=None):
+    """
+    Writes the normal and expanded headers of some tiles (default: all),
+    unless they exist already; processes on the same node may race to do so.
+    """
+    for g, suffix in [(grid, ''), (grid_expanded, '.expanded')]:
+        for tile, hdr in sorted(g.headers(tiles).items()):
+            filename = HEADER % tile + suffix
+            if os.path.exists(filename) and open(filename, 'r').read() == hdr:
+                continue
+            # Renaming is atomic: no process ever reads a partial header
+            tmp = '%s.tmp%d' % (filename, os.getpid())
+            output = open(tmp, 'w')
+            output.write(hdr)
+            output.close()
+            os.rename(tmp, filename)
+
+
+def make_scheduler():
+    """Returns the TileScheduler of the local runs and the job order"""
+    return scheduler.TileScheduler(grid, BANDS, create_mosaic, SCRATCHDIR,
+                                   workers=JOBS,
+                                   memory_per_job=MEMORY_PER_JOB,
+                                   scratch_per_job=SCRATCH_PER_JOB,
+                                   scratch_manager=scratch.ScratchManager(
+                                       SCRATCHDIR, SCRATCH_QUOTA, SCRATCH_MIN_FREE))
+
+
+def update_pyramids():
+    """Brings the pyramids up to date with the finished tiles"""
+    for band in BANDS:
+        pattern = '%s/tile%%03d-%s-normal.fits' % (SCRATCHDIR, band)
+        pyramid.Pyramid(grid, pattern, PYRAMIDDIR % band).update()
+
+
+def run_local(tiles_of_band):
+    """
+    Mosaics the tiles returned by tiles_of_band(band, catalogue); the image
+    table of a band is recorded as built once all its tiles succeeded.
+    """
+    current = dict((band, catalogue.Catalogue.load_or_convert(IMGTABLE % band))
+                   for band in BANDS)
+    tiles = dict((band, tiles_of_band(band, current[band])) for band in BANDS)
+    for band in BANDS:
+        logging.info('%d tiles to mosaic in band %s' % (len(tiles[band]), band))
+    save_headers()
+    sched = make_scheduler()
+    sched.run(tiles)
+    failed = set([band for tile, band, message in sched.failed])
+    for band in BANDS:
+        if band not in failed:
+            current[band].save(BUILT_CATALOGUE % band)
+
+
+def affected(band, current):
+    """Returns the tiles which overlap exposures changed since they were built"""
+    if not os.path.exists(BUILT_CATALOGUE % band):
+        return list(grid.tile)
+    previous = catalogue.Catalogue.load(BUILT_CATALOGUE % band)
+    return mosaic.affected_tiles(grid_expanded, current, previous)
+
+
+def run_job(job):
+    """Runs a (tile, band) job submitted to an executor backend"""
+    # The job may run on a node where the headers were never written
+    save_headers([job[0]])
+    create_mosaic(*job)
+    return True
 
 
 #m._clean_workdir()
 #m.coadd()
 
-create_mosaic(150, 'ha')
+grid = mosaic.TileGrid(GLON1, GLON2,
+                       GLAT1, GLAT2,
+                       RESOLUTION,
+                       TILES_X, TILES_Y, TILES_OVERLAP)
+# Montage performs better with an expanded header for the bgmodel
+grid_expanded = grid.expanded(0.4)
+if 'task' in OPTIONS:
+    success, result = executor.run_task(run_job, PBS_TASKFILE, OPTIONS['task'])
+    sys.exit(0 if success else 1)
+elif '--pyramid' in sys.argv[1:]:
+    update_pyramids()
+elif BACKEND == 'local':
+    if DELTA:
+        run_local(affected)
+    else:
+        run_local(lambda band, current: list(grid.tile))
+    update_pyramids()
+elif BACKEND == 'mpi':
+    # Rank 0 hands out the jobs in the scheduler's order
+    backend = executor.MPIBackend()
+    tasks = []
+    if backend.comm.rank == 0:
+        tasks = make_scheduler().order()
+    backend.map(run_job, tasks)
+    backend.close()
+elif BACKEND == 'pbs':
+    command = 'python %s %s --task=$PBS_ARRAYID' % (os.path.abspath(__file__),
+                                                    ' '.join(ARGS))
+    backend = executor.PBSArrayBackend(PBS_JOBFILE, PBS_TASKFILE, command)
+    backend.map(run_job, make_scheduler().order())
+else:
+    raise Exception('Unknown backend: %s' % BACKEND)
@@ -0,0 +1,587 @@
+"""
+Execution of external tools (Montage, CASUtools, cfitsio) with profiling.
+
+"""
+
+import errno
+import logging
+import os
+import json
+import time
+import signal
+import shlex
+import subprocess
+import threading
+from collections import deque
+
+
+class Profile(object):
+    """
+    Machine-readable record of the resources used by external tools.
+
+    Each call is appended as one JSON object per line to 'filename',
+    such that the record survives a crash of the pipeline.
+
+    :param filename:
+    File to append the records to (None: keep them in memory only.)
+    """
+
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self.records = []
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self._filename is not None:
+                output = open(self._filename, 'a')
+                output.write(json.dumps(record, sort_keys=True) + '\n')
+                output.close()
+
+    def summary(self, key='tool'):
+        """
+        Returns {key: {'calls', 'wall', 'cpu', 'maxrss'}} totals.
+
+        :param key:
+        Record field to group by (e.g. 'tool' or 'stage').
+        """
+        totals = {}
+        with self._lock:
+            for r in self.records:
+                t = totals.setdefault(r.get(key), {'calls': 0, 'wall': 0.,
+                                                   'cpu': 0., 'maxrss': 0})
+                t['calls'] += 1
+                t['wall'] += r['wall']
+                t['cpu'] += r['cpu']
+                t['maxrss'] = max(t['maxrss'], r['maxrss'])
+        return totals
+
+    def log_summary(self, log=logging, key='tool'):
+        """
+        Logs the totals, most expensive first.
+
+        """
+        totals = self.summary(key)
+        for name in sorted(totals, key=lambda n: -totals[n]['wall']):
+            t = totals[name]
+            log.info('Profile %s=%s: %d calls, wall=%.1fs cpu=%.1fs maxrss=%.0fMB'
+                     % (key, name, t['calls'], t['wall'], t['cpu'],
+                        t['maxrss'] / 1024.))
+
+
+def _stream(pipe, log, level, tail):
+    """
+    Copies the lines of a pipe into the log, keeping the last few.
+
+    """
+    for line in iter(pipe.readline, b''):
+        line = line.decode('utf-8', 'replace').rstrip()
+        if line:
+            log.log(level, line)
+            tail.append(line)
+    pipe.close()
+
+
+def execute(cmd, log=logging, timeout=None, profile=None, **extra):
+    """
+    Executes a shell command and logs its output while it runs.
+
+    Both pipes are read concurrently, so a tool which writes a lot to
+    stderr cannot block. The command fails if it returns a non-zero exit
+    code, exceeds the timeout, or reports stat="ERROR" (Montage tools
+    exit with zero even when they fail).
+
+    :param cmd:
+    Command line.
+
+    :param log:
+    Logger which receives the command and its output.
+
+    :param timeout: (seconds)
+    The command is killed when it runs longer than this.
+
+    :param profile:
+    Profile object to record wall time, CPU time and peak RSS to.
+
+    :param extra:
+    Additional fields to store in the profile record (e.g. stage='project').
+
+    Returns True on success.
+    """
+    log.debug(cmd)
+    args = shlex.split(cmd)
+    start = time.time()
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         close_fds=True)
+
+    stdout, stderr = deque(maxlen=20), deque(maxlen=20)
+    readers = [threading.Thread(target=_stream,
+                                args=(p.stdout, log, logging.DEBUG, stdout)),
+               threading.Thread(target=_stream,
+                                args=(p.stderr, log, logging.WARNING, stderr))]
+    for t in readers:
+        t.daemon = True
+        t.start()
+
+    timed_out = threading.Event()
+    def kill():
+        timed_out.set()
+        try:
+            os.kill(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    # wait4 provides the resource usage of this child only
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if timer is not None:
+        timer.cancel()
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    for t in readers:
+        t.join()
+
+    montage_error = any('stat="ERROR"' in line for line in stdout)
+    success = p.returncode == 0 and not montage_error and not timed_out.is_set()
+
+    if profile is not None:
+        record = {'tool': os.path.basename(args[0]),
+                  'cmd': cmd,
+                  'start': start,
+                  'wall': time.time() - start,
+                  'cpu': rusage.ru_utime + rusage.ru_stime,
+                  'maxrss': rusage.ru_maxrss,  # kilobytes
+                  'read_bytes': rusage.ru_inblock * 512,  # from storage
+                  'write_bytes': rusage.ru_oublock * 512,
+                  'returncode': p.returncode,
+                  'success': success}
+        record.update(extra)
+        profile.add(record)
+
+    if not success:
+        if timed_out.is_set():
+            reason = 'TIMEOUT after %ss' % timeout
+        elif montage_error:
+            reason = 'MONTAGE ERROR'
+        else:
+            reason = 'EXIT=%s' % p.returncode
+        log.error("%s STDERR={%s} STDOUT={%s} CMD={%s}" % (
+                    reason, '\n'.join(stderr), '\n'.join(stdout), cmd))
+    return success
+
+
+def _call(function, task):
+    """
+    Calls function(task) and returns (success, result).
+
+    A task fails if it raises an exception (the result is then the error
+    message) or returns False.
+    """
+    try:
+        result = function(task)
+    except Exception as e:
+        logging.exception('Task %r raised %s' % (task, e))
+        return (False, str(e))
+    return (result is not False, result)
+
+
+class Backend(object):
+    """
+    Interface of the execution backends: runs a function on a list of tasks.
+
+    The same code can thus run serially, on the cores of a workstation, on
+    an MPI allocation or as a PBS job array by choosing the backend.
+    """
+
+    def map(self, function, tasks, callback=None):
+        """
+        Calls function(task) for every task.
+
+        :param function:
+        Function of one task; a task fails if it raises or returns False.
+
+        :param tasks:
+        List of tasks.
+
+        :param callback:
+        Called as callback(index, success, result) when a task completes.
+
+        Returns a list of (success, result) tuples in the order of the tasks;
+        tasks which were not run yield (False, None).
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases the resources of the backend.
+
+        """
+        pass
+
+
+class SerialBackend(Backend):
+    """
+    Runs the tasks one after the other in this process.
+
+    :param stop_on_failure:
+    Skip the remaining tasks after the first failure.
+    """
+
+    def __init__(self, stop_on_failure=False):
+        self.stop_on_failure = stop_on_failure
+
+    def map(self, function, tasks, callback=None):
+        results = [(False, None)] * len(tasks)
+        for i, task in enumerate(tasks):
+            results[i] = _call(function, task)
+            if callback is not None:
+                callback(i, *results[i])
+            if self.stop_on_failure and not results[i][0]:
+                break
+        return results
+
+
+class ThreadBackend(Backend):
+    """
+    Runs the tasks concurrently in a pool of threads, which suits tasks
+    that spend their time waiting for external processes.
+
+    :param workers:
+    Number of threads.
+
+    :param stop_on_failure:
+    Tasks which did not start before a failure are skipped.
+    """
+
+    def __init__(self, workers, stop_on_failure=False):
+        self.workers = workers
+        self.stop_on_failure = stop_on_failure
+
+    def map(self, function, tasks, callback=None):
+        workers = max(1, min(self.workers, len(tasks)))
+        if workers == 1:
+            return SerialBackend(self.stop_on_failure).map(function, tasks, callback)
+        from multiprocessing.pool import ThreadPool
+        failed = threading.Event()
+        lock = threading.Lock()
+
+        def run(args):
+            i, task = args
+            if self.stop_on_failure and failed.is_set():
+                return (False, None)
+            result = _call(function, task)
+            if not result[0]:
+                failed.set()
+            if callback is not None:
+                with lock:
+                    callback(i, *result)
+            return result
+
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(run, list(enumerate(tasks)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _process_task(args):
+    function, task = args
+    return _call(function, task)
+
+
+class ProcessBackend(Backend):
+    """
+    Runs the tasks in a pool of local processes; the function and tasks
+    must be picklable (e.g. a module-level function.)
+
+    :param workers:
+    Number of processes (default: number of cores.)
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def map(self, function, tasks, callback=None):
+        import multiprocessing
+        pool = multiprocessing.Pool(self.workers, maxtasksperchild=1)
+        results = [(False, None)] * len(tasks)
+        try:
+            iterator = pool.imap(_process_task, [(function, t) for t in tasks])
+            for i, result in enumerate(iterator):
+                results[i] = result
+                if callback is not None:
+                    callback(i, *result)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+class MPIBackend(Backend):
+    """
+    Master/worker execution with mpi4py: rank 0 hands out the tasks, all
+    other ranks run them. Every rank calls map() with the same function;
+    only the tasks given to rank 0 count, and map() returns None on the
+    workers once the master has finished.
+
+    Tasks are sent in batches which shrink towards the end of the run.
+    The tasks of a worker which stays silent beyond its deadline are
+    re-queued, as are failed tasks, up to 'max_attempts' times.
+
+    :param comm:
+    MPI communicator (default: MPI.COMM_WORLD.)
+
+    :param max_batch:
+    Largest number of tasks sent in one message.
+
+    :param task_timeout: (seconds)
+    Time allowed per task before the batch of a worker is re-queued.
+
+    :param max_attempts:
+    Number of times a task is tried.
+
+    :param on_batch:
+    Called on a worker as on_batch(tasks) before it runs a batch (e.g. to
+    prefetch the inputs.)
+    """
+
+    GIVE_ME_WORK = 801  # Worker waiting for instructions (carries its results)
+    WORK = 802          # Batch of tasks sent to a worker
+    FINISHED = 850      # All work is done
+
+    def __init__(self, comm=None, max_batch=8, task_timeout=None,
+                 max_attempts=1, on_batch=None):
+        if comm is None:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        self.max_batch = max_batch
+        self.task_timeout = task_timeout
+        self.max_attempts = max_attempts
+        self.on_batch = on_batch
+        self.lost = set()  # Ranks which timed out
+
+    def map(self, function, tasks, callback=None):
+        if self.comm.size == 1:
+            return SerialBackend().map(function, tasks, callback)
+        if self.comm.rank == 0:
+            return self._master(tasks, callback)
+        self._worker(function)
+        return None
+
+    def _master(self, tasks, callback):
+        from mpi4py import MPI
+        comm = self.comm
+        queue = deque(enumerate(tasks))
+        results = [(False, None)] * len(tasks)
+        workers = comm.size - 1
+        attempts = {}   # index -> number of times sent
+        inflight = {}   # rank -> (batch, deadline)
+        timedout = {}   # rank -> batch of a rank which timed out
+        finished = set()  # indices of the tasks with a final result
+        idle = []       # ranks waiting for work
+        completed = [0]
+        status = MPI.Status()
+
+        def dispatch(rank):
+            # Guided scheduling: large batches first, single tasks at the end
+            size = max(1, min(self.max_batch, len(queue) // (2 * workers)))
+            batch = [queue.popleft() for i in range(min(size, len(queue)))]
+            for index, task in batch:
+                attempts[index] = attempts.get(index, 0) + 1
+            deadline = None
+            if self.task_timeout is not None:
+                deadline = time.time() + self.task_timeout * len(batch)
+            inflight[rank] = (batch, deadline)
+            comm.send(batch, dest=rank, tag=self.WORK)
+            logging.info('%d task(s) sent to worker %d (%d queued, %d/%d done)'
+                         % (len(batch), rank, len(queue), completed[0], len(tasks)))
+
+        def retry(index, task, reason):
+            if attempts[index] < self.max_attempts:
+                logging.warning('Re-queueing task %d (%s)' % (index, reason))
+                queue.append( (index, task) )
+                return True
+            logging.error('Giving up on task %d (%s)' % (index, reason))
+            return False
+
+        def finish(index, success, result):
+            results[index] = (success, result)
+            finished.add(index)
+            completed[0] += 1
+            if callback is not None:
+                callback(index, success, result)
+
+        while queue or inflight:
+            if comm.Iprobe(source=MPI.ANY_SOURCE, tag=self.GIVE_ME_WORK, status=status):
+                rank = status.Get_source()
+                report = comm.recv(source=rank, tag=self.GIVE_ME_WORK)
+                if rank in inflight and not report['results']:
+                    # Every batch yields results: an empty report is a
+                    # request left over from an earlier map()
+                    logging.warning('Stale request from worker %d ignored' % rank)
+                    continue
+                if rank in self.lost:
+                    logging.warning('Worker %d is back after a timeout' % rank)
+                    self.lost.discard(rank)
+                batch = dict(inflight.pop(rank, ([], 0))[0])
+                late = timedout.pop(rank, {})
+                for index, success, result in report['results']:
+                    if index in finished:
+                        continue  # Completed by another worker meanwhile
+                    if index in late:
+                        # A late success saves running the re-queued copy;
+                        # a late failure leaves the copy to decide
+                        if success:
+                            logging.warning('Late result of task %d from worker %d'
+                                            % (index, rank))
+                            for item in [item for item in queue if item[0] == index]:
+                                queue.remove(item)
+                            finish(index, success, result)
+                        continue
+                    task = batch.pop(index, None)
+                    if task is None:
+                        continue
+                    if success or not retry(index, task, 'failed on worker %d' % rank):
+                        finish(index, success, result)
+                if queue:
+                    dispatch(rank)
+                else:
+                    idle.append(rank)
+                continue
+
+            # Re-queue the work of ranks which have gone silent
+            now = time.time()
+            for rank, (batch, deadline) in list(inflight.items()):
+                if deadline is not None and now > deadline:
+                    logging.error('Worker %d timed out' % rank)
+                    del inflight[rank]
+                    self.lost.add(rank)
+                    # Kept, such that late results are still accepted
+                    timedout[rank] = dict(batch)
+                    for index, task in batch:
+                        if not retry(index, task, 'worker %d timed out' % rank):
+                            finish(index, False, 'TIMEOUT')
+            if queue and not inflight and len(self.lost) == workers:
+                logging.error('No workers left, giving up on %d task(s)'
+                              % len(queue))
+                for index, task in queue:
+                    if index not in finished:
+                        finish(index, False, 'LOST')
+                break
+            while queue and idle:
+                dispatch(idle.pop(0))
+            time.sleep(0.1)
+
+        # Tell the workers that this map is finished; the requests of the
+        # workers which got no work are received first, such that they are
+        # not mistaken for requests in the next map()
+        for worker in range(1, comm.size):
+            if worker not in self.lost:
+                if worker not in idle:
+                    comm.recv(source=worker, tag=self.GIVE_ME_WORK)
+                comm.send(self.FINISHED, dest=worker, tag=self.WORK)
+        return results
+
+    def _worker(self, function):
+        results = []
+        while True:
+            # Ask for work, reporting the outcome of the previous batch
+            self.comm.send({'rank': self.comm.rank, 'results': results},
+                           dest=0, tag=self.GIVE_ME_WORK)
+            batch = self.comm.recv(source=0, tag=self.WORK)
+            if batch == self.FINISHED:
+                return
+            logging.debug('Batch received: %r' % (batch,))
+            if self.on_batch is not None:
+                self.on_batch([task for index, task in batch])
+            results = []
+            for index, task in batch:
+                success, result = _call(function, task)
+                results.append( (index, success, result) )
+
+    def close(self):
+        """
+        Aborts the job if workers hung: they would otherwise block
+        MPI_Finalize until the walltime.
+
+        """
+        if self.comm.rank == 0 and self.lost:
+            logging.error('Aborting hung workers: %s' % sorted(self.lost))
+            self.comm.Abort(1)
+
+
+class PBSArrayBackend(Backend):
+    """
+    Generates a PBS job array with one array element per task, instead of
+    running the tasks. The tasks are written to a JSON file; each element
+    runs 'command' with $PBS_ARRAYID, which is expected to call run_task().
+
+    :param jobfile:
+    PBS script to write (submit with qsub.)
+
+    :param taskfile:
+    JSON file to write the tasks to.
+
+    :param command:
+    Command run by every element, e.g. 'python do-mosaic.py --task=$PBS_ARRAYID'.
+
+    :param directives:
+    List of additional PBS directives, e.g. ['-l walltime=24:00:00'].
+
+    :param setup:
+    List of shell lines to run before the command (e.g. export PATH=...)
+    """
+
+    def __init__(self, jobfile, taskfile, command, name='iphas-mosaic',
+                 directives=[], setup=[]):
+        self.jobfile = jobfile
+        self.taskfile = taskfile
+        self.command = command
+        self.name = name
+        self.directives = directives
+        self.setup = setup
+
+    def map(self, function, tasks, callback=None):
+        tmp = '%s.tmp%d' % (self.taskfile, os.getpid())
+        output = open(tmp, 'w')
+        json.dump(list(tasks), output)
+        output.close()
+        os.rename(tmp, self.taskfile)
+
+        lines = ['#!/bin/sh -f',
+                 '#PBS -N %s' % self.name,
+                 '#PBS -t 0-%d' % (len(tasks) - 1),
+                 '#PBS -k oe']
+        lines += ['#PBS %s' % d for d in self.directives]
+        lines += list(self.setup)
+        lines += ['cd $PBS_O_WORKDIR', self.command]
+        output = open(self.jobfile, 'w')
+        output.write('\n'.join(lines) + '\n')
+        output.close()
+        logging.info('Wrote a job array of %d tasks: qsub %s'
+                     % (len(tasks), self.jobfile))
+        return [(False, None)] * len(tasks)
+
+
+def run_task(function, taskfile, index):
+    """
+    Runs one task of a job array written by PBSArrayBackend.
+
+    Returns (success, result).
+    """
+    tasks = json.load(open(taskfile, 'r'))
+    return _call(function, tasks[int(index)])
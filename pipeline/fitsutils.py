@@ -0,0 +1,190 @@
+"""
+Low-level helpers to inspect and patch FITS files without rewriting them.
+
+"""
+
+import os
+import pyfits
+
+
+BLOCK = 2880  # Size of a FITS block (bytes)
+CARD = 80  # Size of a header card (bytes)
+
+
+def _card_value(card):
+    """
+    Returns (value, comment) of a header card as strings.
+
+    """
+    field = card[10:]
+    if field.lstrip().startswith("'"):
+        # String value: quotes inside the string are doubled
+        start = field.index("'") + 1
+        i = start
+        while True:
+            i = field.find("'", i)
+            if i < 0 or field[i+1:i+2] != "'":
+                break
+            i += 2
+        value = field[start:i].replace("''", "'").rstrip()
+        rest = field[i+1:]
+    else:
+        value, sep, rest = field.partition('/')
+        value = value.strip()
+        rest = sep + rest
+    comment = rest.partition('/')[2].strip()
+    return value, comment
+
+
+def _format_card(key, value, comment):
+    """
+    Formats a string-valued card the way pyfits does.
+
+    """
+    card = "%-8s= %-20s" % (key, "'%-8s'" % value.replace("'", "''"))
+    if comment:
+        card += ' / ' + comment
+    return card[:CARD].ljust(CARD)
+
+
+def _header_cards(f):
+    """
+    Reads the header of the HDU at the current position of 'f'.
+
+    Returns (start, cards, nblocks) with the offset of the header, its
+    cards up to and including END, and the number of blocks it occupies.
+    """
+    start = f.tell()
+    cards = []
+    nblocks = 0
+    while True:
+        block = f.read(BLOCK)
+        if len(block) < BLOCK:
+            raise IOError('Truncated FITS header at offset %d' % start)
+        nblocks += 1
+        block = block.decode('ascii')
+        for i in range(0, BLOCK, CARD):
+            cards.append(block[i:i+CARD])
+            if block[i:i+8] == 'END     ':
+                return start, cards, nblocks
+
+
+def _data_size(cards):
+    """
+    Returns the size of the data unit (padded to whole blocks) in bytes.
+
+    """
+    values = {}
+    for card in cards:
+        values[card[:8].strip()] = card
+    def keyword(key, default):
+        if key not in values:
+            return default
+        return int(_card_value(values[key])[0])
+    naxis = keyword('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for i in range(1, naxis + 1):
+        size *= keyword('NAXIS%d' % i, 0)
+    bits = abs(keyword('BITPIX', 8))
+    size = bits // 8 * keyword('GCOUNT', 1) * (keyword('PCOUNT', 0) + size)
+    return (size + BLOCK - 1) // BLOCK * BLOCK
+
+
+def is_tile_compressed(filename):
+    """
+    Is the image of a file tile-compressed, i.e. stored in the first
+    extension with ZIMAGE = T rather than in the primary HDU?
+
+    Only the headers of the first two HDUs are read.
+    """
+    f = open(filename, 'rb')
+    try:
+        start, cards, nblocks = _header_cards(f)
+        f.seek(_data_size(cards), os.SEEK_CUR)
+        try:
+            start, cards, nblocks = _header_cards(f)
+        except IOError:
+            return False  # No extension
+    finally:
+        f.close()
+    for card in cards:
+        if card[:8].rstrip() == 'ZIMAGE':
+            return _card_value(card)[0] == 'T'
+    return False
+
+
+def update_string_keyword(filename, key, value, hdu=0, equal=None):
+    """
+    Sets a string keyword by patching the header block in place.
+
+    Only the 80-byte card is rewritten, so the I/O is limited to reading
+    the headers up to 'hdu' and writing one card. Files which are already
+    compliant are not touched at all. If the keyword is missing and the
+    header has no free card left before the end of its last block, the
+    file is updated through pyfits instead.
+
+    :param filename:
+    FITS file to update.
+
+    :param key:
+    Keyword (at most 8 characters.)
+
+    :param value:
+    New string value.
+
+    :param hdu:
+    Number of the HDU whose header to patch.
+
+    :param equal:
+    Function deciding whether an existing value already complies
+    (default: string equality.)
+
+    Returns True if the file was modified.
+    """
+    if equal is None:
+        equal = lambda old, new: old == new
+    f = open(filename, 'r+b')
+    try:
+        for i in range(hdu + 1):
+            start, cards, nblocks = _header_cards(f)
+            if i < hdu:
+                f.seek(_data_size(cards), os.SEEK_CUR)
+
+        names = [card[:8].rstrip() for card in cards]
+        if key in names:
+            n = names.index(key)
+            old, comment = _card_value(cards[n])
+            if equal(old, value):
+                return False
+            f.seek(start + n * CARD)
+            f.write(_format_card(key, value, comment).encode('ascii'))
+            return True
+
+        # Insert before END if the padding of the last block has room
+        end = names.index('END')
+        if end + 1 < nblocks * BLOCK // CARD:
+            f.seek(start + end * CARD)
+            f.write((_format_card(key, value, '')
+                     + 'END'.ljust(CARD)).encode('ascii'))
+            return True
+    finally:
+        f.close()
+
+    # No room left in the header: fall back on a full update
+    hdulist = pyfits.open(filename, mode='update')
+    hdulist[hdu].header.update(key, value)
+    hdulist.close()
+    return True
+
+
+def same_number(old, new):
+    """
+    Are two keyword values the same number? (e.g. '2000.0' and '2000')
+
+    """
+    try:
+        return float(old) == float(new)
+    except ValueError:
+        return False
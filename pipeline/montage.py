@@ -0,0 +1,132 @@
+"""
+Functions to read and write the file formats used by the Montage toolkit.
+
+"""
+
+import numpy as np
+
+
+def read_template(filename):
+    """
+    Reads a Montage template header into a list of (keyword, value) tuples.
+
+    """
+    cards = []
+    for line in open(filename, 'r'):
+        if '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        value = value.split('/')[0].strip().strip("'").strip()
+        cards.append( (key.strip(), value) )
+    return cards
+
+
+def write_template(filename, cards):
+    """
+    Writes a list of (keyword, value) tuples as a Montage template header.
+
+    """
+    output = open(filename, 'w')
+    for key, value in cards:
+        if key.startswith('CTYPE'):
+            value = "'%s'" % value
+        output.write('%-8s= %s\n' % (key, value))
+    output.write('END\n')
+    output.close()
+
+
+def montage_names(filename):
+    """
+    Returns the (image, area) filenames which mProject writes for 'filename'.
+
+    """
+    if filename.endswith('.fits'):
+        filename = filename[:-5]
+    return (filename + '.fits', filename + '_area.fits')
+
+
+def _tbl_type(name):
+    """
+    Returns the NumPy type corresponding to an IPAC column type.
+
+    """
+    name = name.strip().lower()
+    if name in ['int', 'i', 'long', 'l']:
+        return np.int64
+    if name in ['double', 'd', 'real', 'r', 'float', 'f']:
+        return np.float64
+    return str
+
+
+def read_tbl(filename):
+    """
+    Reads an IPAC ASCII table, as written by mImgtbl, mOverlaps, mFitExec, ...
+
+    Returns (header, columns): 'header' is the number of bytes taken up by
+    the header lines, 'columns' is a dict mapping column names to NumPy
+    arrays. The byte offset of each row is added as column '_offset'.
+    """
+    f = open(filename, 'rb')
+    names, types, bounds = None, None, None
+    values, offsets = [], []
+    header = 0
+    position = 0
+    for line in f:
+        text = line.decode('ascii').rstrip('\r\n')
+        if text.startswith('\\') or text.startswith('|'):
+            if text.startswith('|'):
+                # Column boundaries are marked by the '|' characters
+                if names is None:
+                    bars = [i for i, c in enumerate(text) if c == '|']
+                    bounds = list(zip(bars[:-1], bars[1:]))
+                    names = [text[a+1:b].strip() for a, b in bounds]
+                elif types is None:
+                    types = [_tbl_type(text[a+1:b]) for a, b in bounds]
+            position += len(line)
+            header = position
+            continue
+        if text.strip():
+            # The last column may extend beyond the final '|'
+            row = [text[a+1:b+1].strip() for a, b in bounds[:-1]]
+            row.append(text[bounds[-1][0]+1:].strip())
+            values.append(row)
+            offsets.append(position)
+        position += len(line)
+    f.close()
+
+    if types is None:
+        types = [str] * len(names)
+    columns = {}
+    for i, (name, t) in enumerate(zip(names, types)):
+        columns[name] = np.array([row[i] for row in values]).astype(t) \
+                        if t is not str else np.array([row[i] for row in values])
+    columns['_offset'] = np.array(offsets, dtype=np.int64)
+    return header, columns
+
+
+def write_tbl(filename, columns):
+    """
+    Writes an IPAC ASCII table which Montage tools can read.
+
+    :param columns:
+    List of (name, type, format, values) tuples, e.g.
+    ('plus', 'int', '%d', [1, 2]) or ('a', 'double', '%.6e', [0.1, 0.2]).
+    """
+    cells = []
+    widths = []
+    for name, kind, fmt, values in columns:
+        text = [fmt % v for v in values]
+        cells.append(text)
+        widths.append(max([len(name), len(kind)] + [len(t) for t in text]) + 1)
+
+    out = open(filename, 'w')
+    out.write('|' + '|'.join([n.rjust(w) for (n, k, f, v), w
+                              in zip(columns, widths)]) + '|\n')
+    out.write('|' + '|'.join([k.rjust(w) for (n, k, f, v), w
+                              in zip(columns, widths)]) + '|\n')
+    nrows = len(cells[0]) if cells else 0
+    for i in range(nrows):
+        # Values are right-aligned below the closing '|' of their column
+        out.write(' ' + ' '.join([c[i].rjust(w) for c, w
+                                  in zip(cells, widths)]) + ' \n')
+    out.close()
@@ -5,12 +5,41 @@ Classes and functions implemented to mosaic the IPHAS survey.
 
 import logging
 import os
+import json
+import hashlib
 import sys
-import subprocess
-import shlex
 import pyfits
 import numpy as np
 
+import bgmodel
+import catalogue
+import coadd
+import coverage
+import executor
+import fitsutils
+import overlaps
+import quicklook
+import reproject
+import scratch
+import staging
+import strips
+from montage import read_tbl, write_tbl, montage_names
+
+
+def md5sum(filename, blocksize=2**20):
+    """
+    Returns the MD5 hex digest of a file's contents.
+
+    """
+    md5 = hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
 
 class Mosaic(object):
     """
@@ -49,6 +78,8 @@ class Mosaic(object):
         self._path['casutools'] = '/home/gb/bin/casutools/bin'
         self._path['iphas-meta'] = '/home/gb/dev/iphas-qc/data'
         self._path['imgtable'] = '/home/gb/dev/iphas-mosaic/imgtable'
+        # Node-local copies of the raw exposures, deleted once used
+        self._path['stage'] = self._path['work']+'/stage'
 
         self._setup_log()
 
@@ -64,9 +95,58 @@ class Mosaic(object):
         self._difftbl = '%s/diff-%s.tbl' % (self._path['work'], self._name)
         self._fittbl = '%s/fit-%s.tbl' % (self._path['work'], self._name)
         self._corrtbl = '%s/corr-%s.tbl' % (self._path['work'], self._name)
+        self._corrimgtbl = '%s/corrimg-%s.tbl' % (self._path['work'], self._name)
+        # Intermediates deleted by the cleanup
+        self._releasedfile = '%s/released-%s.json' % (self._path['work'], self._name)
+        # Inputs of every projection, and the overlap fits made from them
+        self._projstate = '%s/projections-%s.json' % (self._path['work'], self._name)
+        self._fitstate = '%s/fits-%s.json' % (self._path['work'], self._name)
+        # Co-added results
+        self._output_uncorrected = '%s/%s-uncorrected.fits' % (self._path['work'], self._name)
+        self._output_corrected_local = '%s/%s.fits' % (self._path['work'], self._name)
+        self._output_corrected = '%s/%s.fits' % (self._path['output'], self._name)
+
+        self._images = None
 
         self.use_mosaic = True
         self.conf_threshold = 90  # Confidence/weight map threshold
+        self.workers = 1  # Number of reprojection jobs to run concurrently
+        self.backend = None  # executor.Serial/ThreadBackend for the jobs of a stage (default: threads)
+        self.bgmodel_level_only = True  # mBgModel: fit offsets only, no slopes
+        self.bgmodel_iterations = 20000  # mBgModel: maximum number of iterations
+        # 'mBgModel', 'scipy' (direct sparse solve) or 'joint' (corr table
+        # written beforehand by bgmodel.solve_joint for a group of tiles)
+        self.bgmodel_backend = 'mBgModel'
+        self.resume = True  # Skip stages whose inputs did not change
+        self.delta = False  # Only reproject changed exposures and refit the overlaps they touch
+        self.projection_cache = None  # Optional cache.ProjectionCache
+        self.use_coverage_index = True  # False: select images using mCoverageCheck
+        self.coadd_backend = 'mAdd'  # 'mAdd' or 'numpy' (in-process co-addition)
+        self.coadd_memory = 512*1024**2  # Memory budget of the numpy co-addition (bytes)
+        self.coadd_validate = False  # Compare the numpy co-additions against mAdd
+        self.overlaps_backend = 'montage'  # 'montage' or 'numpy' (no diff images)
+        self.projection_backend = 'mProject'  # 'mProject' or 'numpy' (see reproject.py)
+        self.projection_method = 'bilinear'  # numpy projections: 'bilinear' or 'drizzle'
+        self.projection_threads = 1  # numpy projections: threads per image
+        self.projection_validate = False  # Compare the numpy projections against mProject
+        self.timeout = None  # Default time limit for external commands (seconds)
+        self.timeouts = {}  # Time limits for specific tools, e.g. {'mBgModel': 3600}
+        self.prefetch = 4  # Number of raw exposures staged ahead of processing
+        self.stage_budget = 4*1024**3  # Disk budget of the staged exposures (bytes)
+        self.compress_scratch = True  # Write the CASUtools mosaics tile-compressed
+        self.strip_rows = None  # Run mAdd on strips of this many rows (bounds its memory)
+        self.strip_overlap = 0  # Rows co-added twice by neighbouring strips, as a check (opt-in)
+        self.quicklook_format = 'jpg'  # 'jpg' (mJPEG without PIL), 'png' or 'mJPEG'
+        self.quicklook_factors = (4, 16, 64)  # Downsampling of the quicklook zoom levels
+        self.quicklook_stretch = ('20', '200', 'log')  # Range and stretch, as for mJPEG
+        self.cleanup = False  # Delete intermediates once the stages consuming them are done
+        self.keep = []  # Intermediates never deleted by the cleanup, e.g. ['proj']
+        self.scratch_manager = None  # Optional scratch.ScratchManager recording the usage per stage
+        self._stage = None
+
+        # Resources used by external tools, one JSON record per line
+        self.profile = executor.Profile('%s/profile-%s.json' % (
+                                    self._path['output'], self._name))
 
     def __del__(self):
         x = logging._handlers.copy()
@@ -97,21 +177,53 @@ class Mosaic(object):
         logfile.setFormatter(fmt)
         self.log.addHandler(logfile)
 
-    def execute(self, cmd):
+    def execute(self, cmd, timeout=None):
         """
-        Executes a shell command and logs any errors.
+        Executes a shell command, logs its output and profiles it.
 
+        :param timeout: (seconds)
+        Time limit (default: self.timeouts for the tool, or self.timeout).
         """
-        self.log.debug(cmd)
-        p = subprocess.Popen(shlex.split(cmd), 
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout = p.stdout.read().strip()
-        stderr = p.stderr.read().strip()
-        if stderr:
-            self.log.error("STDERR={%s} STDOUT={%s} CMD={%s}" % (stderr, stdout, cmd))
-            return False
-        self.log.debug( stdout )
-        return True
+        if timeout is None:
+            tool = os.path.basename(cmd.split()[0])
+            timeout = self.timeouts.get(tool, self.timeout)
+        return executor.execute(cmd, self.log, timeout, self.profile,
+                                tile=self._name, stage=self._stage)
+
+    def execute_jobs(self, jobs, workers=None):
+        """
+        Runs a list of jobs concurrently, stopping at the first failure.
+
+        :param jobs:
+        List of (description, function) tuples; each function is called
+        without arguments and must return True on success.
+
+        :param workers:
+        Maximum number of jobs to run at the same time (default: self.workers).
+
+        Returns True if all jobs succeeded.
+        """
+        if workers is None:
+            workers = self.workers
+        backend = self.backend
+        if backend is None:
+            # The jobs spend most of their time waiting for external
+            # processes, hence threads are sufficient to keep the cores busy
+            backend = executor.ThreadBackend(workers, stop_on_failure=True)
+
+        def run(args):
+            i, (description, function) = args
+            self.log.info('Job %d out of %d: %s' % (i+1, len(jobs), description))
+            return function()
+
+        def done(i, success, result):
+            if not success:
+                self.log.error('Job %d out of %d failed: %s%s' % (
+                                i+1, len(jobs), jobs[i][0],
+                                ' (%s)' % result if result else ''))
+
+        results = backend.map(run, list(enumerate(jobs)), callback=done)
+        return all(success for success, result in results)
 
     def create_dir(self, path):
         """
@@ -145,8 +257,10 @@ class Mosaic(object):
             self._path['work']) )
 
     def _clean_workdir(self):
-        self.execute('rm %s/diff/*' % self._path['work'])
-        self.execute('rm %s/corr/*' % self._path['work'])
+        # Not 'rm <dir>/*': commands are not run through a shell, so the
+        # wildcard would never be expanded
+        for path in ['diff', 'corr']:
+            scratch.clear(self._path['work'] + '/' + path)
         #self._setup_workdir()
 
     def get_conf(self, image_filename):
@@ -172,60 +286,101 @@ class Mosaic(object):
             return self.get_conf(image_filename)
 
     def select_images(self):
+        """
+        Identifies the images which overlap the tile.
+
+        """
+        if self.use_coverage_index:
+            # The index is built once and shared by all the tiles of a band
+            index = coverage.CoverageIndex.load_or_build(
+                                self._imgtable_all[self._band])
+            rows = index.query(self._header)
+            # The subset is exported for the record; the images are taken
+            # from the catalogue directly
+            survey = catalogue.Catalogue.load_or_convert(
+                                self._imgtable_all[self._band])
+            survey.write_tbl(self._imgtable, rows)
+            self._images = set(survey['fname'][rows])
+            self.log.info('Coverage index: %d rows selected' % len(rows))
+            return
+
         # Identify images in the field
         self.execute( "%s/mCoverageCheck %s %s -header %s" % (
                     self._path['montage'], 
                     self._imgtable_all[self._band], 
                     self._imgtable, 
                     self._header) )
+        self._read_imgtable()
+
+    def _read_imgtable(self):
+        """
+        Reads the set of selected images from the image table.
 
-        tbl = open(self._imgtable, 'r')
-        self._images = set() # Multi-HDU images appear multiple times
-        for line in tbl.readlines()[3:]:
-            self._images.add( line.strip().split(' ')[-1] )
-        tbl.close()
+        """
+        # Multi-HDU images appear multiple times
+        self._images = set(catalogue.Catalogue.read_tbl(self._imgtable)['fname'])
 
     def copy_images(self):
         """
         Finds the correct set of images and copies them to the working dir.
 
+        The raw exposures are prefetched from the image archive onto local
+        scratch in background threads while the previous one is processed.
+        Each distinct confidence map is staged once for the whole tile.
         """
-        # Copy
-        commands = []
-        for img in self._images:
-            img_filename = img.split('/')[-1]
-
-
-            if self.use_mosaic:
-                commands.append( '%s/mosaic %s/%s %s %s/orig/%s %s/conf/%s --verbose --skyflag=0' % ( 
-                                    self._path['casutools'],
-                                    self._path['images'], 
-                                    img,
-                                    self.get_conf(img_filename),
-                                    self._path['work'],
-                                    img_filename,
-                                    self._path['work'],
-                                    img_filename
-                                     ) )
-            else:
-                commands.append( 'cp %s/%s %s/orig/%s.fz' % (
-                                    self._path['images'], 
-                                    img, 
-                                    self._path['work'], 
-                                    img_filename) )
-
-                # IPHAS images are compressed with fpack by default;
-                # the files need to be decompressed first
-                commands.append( '%s/funpack -D %s/orig/%s.fz' % (
-                                    self._path['fpack'], 
-                                    self._path['work'], 
-                                    img_filename) )
-
-
-
-        for i, cmd in enumerate(commands):
-            self.log.info('Copying files: command %d out of %d' % (i+1, len(commands)))
-            self.execute(cmd)
+        images = sorted(self._images)
+        # Images which are no longer selected are not kept
+        for path in ['orig', 'conf']:
+            scratch.clear(self._path['work'] + '/' + path)
+        confmaps = {}  # confidence map -> staged copy
+        if self.use_mosaic:
+            if not os.path.exists(self._path['stage']):
+                os.makedirs(self._path['stage'])
+            for conf in sorted(set([self.get_conf(img.split('/')[-1])
+                                    for img in images])):
+                confmaps[conf] = '%s/conf%d_%s' % (self._path['stage'],
+                                                   len(confmaps),
+                                                   os.path.basename(conf))
+                staging.copy(conf, confmaps[conf])
+        prefetch = staging.Prefetcher(['%s/%s' % (self._path['images'], img)
+                                       for img in images],
+                                      self._path['stage'],
+                                      max_bytes=self.stage_budget,
+                                      lookahead=self.prefetch,
+                                      log=self.log)
+        try:
+            for i, (source, staged) in enumerate(prefetch):
+                img_filename = source.split('/')[-1]
+                self.log.info('Copying files: image %d out of %d' % (i+1, len(images)))
+                if staged is None:
+                    continue
+
+                if self.use_mosaic:
+                    # cfitsio writes tile-compressed outputs directly when
+                    # the filename carries the [compress] suffix
+                    suffix = '[compress]' if self.compress_scratch else ''
+                    self.execute( "%s/mosaic %s %s '%s/orig/%s%s' '%s/conf/%s%s' --verbose --skyflag=0" % (
+                                        self._path['casutools'],
+                                        staged,
+                                        confmaps[self.get_conf(img_filename)],
+                                        self._path['work'],
+                                        img_filename,
+                                        suffix,
+                                        self._path['work'],
+                                        img_filename,
+                                        suffix
+                                         ) )
+                else:
+                    # IPHAS images are compressed with fpack; mProject reads
+                    # the compressed HDUs directly, so they are not unpacked
+                    os.rename(staged, '%s/orig/%s' % (self._path['work'], img_filename))
+                prefetch.release(staged)
+        finally:
+            prefetch.close()
+            for staged in confmaps.values():
+                if os.path.exists(staged):
+                    os.remove(staged)
+        prefetch.report()
 
     def compute_projections(self):
         """
@@ -236,46 +391,37 @@ class Mosaic(object):
         assert( self._images != None )
         assert( len(self._images) > 0 )
 
-        commands = []
-
-        # Which HDU's need to be reprojected?
-        if self.use_mosaic:
-            hdulist = [0]
-        else:
-            hdulist = [1,2,3,4]
-
-        # Reproject all images in this loop
-        for i, img in enumerate(self._images):
-            self.log.info('Reprojecting image %d out of %d' % (
-                            i+1, len(self._images)))
-
+        # Each image/HDU pair is an independent reprojection job; in delta
+        # mode, projections whose inputs did not change are kept
+        previous = {}
+        if self.delta and os.path.exists(self._projstate):
+            previous = json.load(open(self._projstate, 'r'))
+        header_md5 = md5sum(self._header_expanded)
+        state = {}
+        jobs = []
+        for img in sorted(self._images):
             # Filename without path
             img_filename = img.split('/')[-1]
-            # Full filename with new path
-            img_orig = '%s/orig/%s' % (
-                            self._path['work'], 
-                            img_filename)
-
-            # Montage requires the equinox keyword to be '2000.0'
-            # but CASUtools sets the value 'J2000.0'
-            if self.use_mosaic:
-                myfits = pyfits.open(img_orig)
-                myfits[0].header.update('EQUINOX', '2000.0')
-                myfits.writeto(img_orig, clobber=True)
-
-            for hdu in hdulist:
-                cmd = '%s/mProject -w %s -t %s -h %d %s/orig/%s %s/proj/hdu%d_%s %s' % (
-                                self._path['montage'], 
-                                self.get_weightmap(img_filename), 
-                                self.conf_threshold,
-                                hdu, 
-                                self._path['work'], 
-                                img_filename, 
-                                self._path['work'], 
-                                hdu, 
-                                img_filename, 
-                                self._header_expanded )
-                self.execute(cmd)
+            for hdu in self._hdus(img_filename):
+                output = self._projection_filename(img_filename, hdu)
+                key = os.path.basename(montage_names(output)[0])
+                state[key] = self._projection_inputs(img, hdu, header_md5)
+                if (key in previous and previous[key] == state[key]
+                        and all([os.path.exists(f) for f in montage_names(output)])):
+                    continue
+                jobs.append( ('reproject %s (hdu %d)' % (img_filename, hdu),
+                              self._job_projection(img, hdu)) )
+        if self.delta:
+            self.log.info('Delta mode: re-using %d projections, computing %d'
+                          % (len(state) - len(jobs), len(jobs)))
+            self._remove_stale_projections(state)
+
+        success = self.execute_jobs(jobs)
+        if self.projection_cache is not None:
+            self.log.info(self.projection_cache.stats())
+        if not success:
+            raise Exception('Reprojection failed, see the log for details')
+        self._write_json(self._projstate, state)
 
         # Create a new image table for the re-projected images
         cmd = '%s/mImgtbl -c %s/proj %s' % (
@@ -284,23 +430,188 @@ class Mosaic(object):
                 self._projtbl)
         self.execute(cmd)
 
+        # The numpy backend co-adds the uncorrected and corrected mosaics
+        # in a single pass over the projections in compute_background
+        if self.coadd_backend == 'numpy':
+            return
+
         # Co-add without background correction
-        output_uncorrected = '%s/%s-uncorrected.fits' % (self._path['work'], self._name)
-        cmd = '%s/mAdd -d 1 -a mean -e -p %s/proj %s %s %s' % (
-                    self._path['montage'], 
-                    self._path['work'], 
-                    self._projtbl, 
-                    self._header_expanded, 
-                    output_uncorrected)
-        self.execute(cmd)
+        output_uncorrected = self._output_uncorrected
+        self._add(self._path['work']+'/proj', self._projtbl,
+                  self._header_expanded, output_uncorrected, '-d 1 -a mean -e')
 
-        # Produce a quicklook jpg
-        cmd = '%s/mJPEG -gray %s 20 200 log -out %s' % (
-                    self._path['montage'], 
-                    output_uncorrected,
-                    output_uncorrected + '.jpg')
-        self.execute(cmd)
+        # Produce a quicklook
+        self._quicklook(output_uncorrected)
+
+    def _hdus(self, img_filename):
+        """
+        Returns the HDUs of an image which need to be reprojected.
+
+        """
+        if not self.use_mosaic:
+            return [1,2,3,4]
+        # A compressed image is stored in the first extension; images
+        # copied before compress_scratch was set are not compressed
+        img_orig = '%s/orig/%s' % (self._path['work'], img_filename)
+        if os.path.exists(img_orig):
+            return [1] if fitsutils.is_tile_compressed(img_orig) else [0]
+        return [1] if self.compress_scratch else [0]
+
+    def _projection_filename(self, img_filename, hdu):
+        """
+        Returns the output filename given to mProject for one HDU of an image.
+
+        """
+        return '%s/proj/hdu%d_%s' % (self._path['work'], hdu, img_filename)
+
+    def _projection_inputs(self, img, hdu, header_md5):
+        """
+        Returns what the projection of one HDU of an image depends on: the
+        state of the original image and confidence map, and the parameters.
+
+        """
+        img_filename = img.split('/')[-1]
+        files = ['%s/%s' % (self._path['images'], img), self.get_conf(img_filename)]
+        state = self._file_state(files, checksum=False)
+        inputs = [state[f] for f in files] + [hdu, self.conf_threshold, header_md5,
+                                              self.use_mosaic, self.compress_scratch]
+        if self.projection_backend == 'numpy':
+            inputs.append(self.projection_method)
+        return inputs
+
+    def _projection_parameters(self):
+        """
+        Returns the settings other than the inputs which a projection depends on.
 
+        """
+        params = {'use_mosaic': self.use_mosaic,
+                  'compress_scratch': self.compress_scratch}
+        if self.projection_backend == 'numpy':
+            params['projection'] = self.projection_method
+        return params
+
+    def _validate_projection(self, cmd, output, reference):
+        """
+        Repeats a numpy projection with mProject and logs the differences.
+
+        :param cmd:
+        The mProject command writing 'reference'.
+        """
+        try:
+            if not self.execute(cmd):
+                self.log.warning('Projection validation: mProject failed on %s'
+                                 % os.path.basename(output))
+                return
+            diff = reproject.compare(output, reference)
+            self.log.info(('Projection validation %s (%s): %d pixels compared, '
+                           + '%d differ in coverage, relative flux difference '
+                           + 'median %g max %g, area ratio %.6f') % (
+                            os.path.basename(output), self.projection_method,
+                            diff['pixels'], diff['coverage_differs'],
+                            diff['median_rel_diff'], diff['max_rel_diff'],
+                            diff['area_ratio']))
+        finally:
+            for filename in montage_names(reference):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def _remove_stale_projections(self, state):
+        """
+        Deletes the projections of images which are no longer selected.
+
+        """
+        projdir = self._path['work'] + '/proj'
+        for filename in sorted(os.listdir(projdir)):
+            image = filename
+            if filename.endswith('_area.fits'):
+                image = filename[:-len('_area.fits')] + '.fits'
+            if image not in state:
+                self.log.info('Removing stale projection %s' % filename)
+                os.remove(os.path.join(projdir, filename))
+
+    def _write_json(self, filename, data):
+        # Write to a temporary file first, such that a crash never leaves
+        # a truncated file behind
+        output = open(filename+'.tmp', 'w')
+        json.dump(data, output, indent=1, sort_keys=True)
+        output.close()
+        os.rename(filename+'.tmp', filename)
+
+    def _job_projection(self, img, hdu):
+        """
+        Returns a function which reprojects one HDU of an image.
+
+        """
+        # Filename without path
+        img_filename = img.split('/')[-1]
+        output = self._projection_filename(img_filename, hdu)
+
+        def project(header, output):
+            # Full filename with new path
+            img_orig = '%s/orig/%s' % (
+                            self._path['work'],
+                            img_filename)
+
+            # Montage requires the equinox keyword to be '2000.0'
+            # but CASUtools sets the value 'J2000.0'; the card is patched
+            # in place rather than rewriting the whole image
+            if self.use_mosaic:
+                if fitsutils.update_string_keyword(img_orig, 'EQUINOX', '2000.0',
+                                                   hdu=hdu,
+                                                   equal=fitsutils.same_number):
+                    self.log.debug('EQUINOX set to 2000.0 in %s' % img_orig)
+
+            def mproject(output):
+                return '%s/mProject -w %s -t %s -h %d %s %s %s' % (
+                            self._path['montage'],
+                            self.get_weightmap(img_filename),
+                            self.conf_threshold,
+                            hdu,
+                            img_orig,
+                            output,
+                            header )
+            if self.projection_backend != 'numpy':
+                return self.execute(mproject(output))
+
+            reproject.reproject(img_orig, output, header, hdu,
+                                self.get_weightmap(img_filename),
+                                self.conf_threshold,
+                                method=self.projection_method,
+                                workers=self.projection_threads,
+                                log=self.log)
+            if self.projection_validate:
+                reference = output + '.mProject.fits'
+                self._validate_projection(mproject(reference), output, reference)
+            return True
+
+        def job():
+            cache = self.projection_cache
+            if cache is None:
+                return project(self._header_expanded, output)
+
+            # Projections are keyed on the original image and confidence
+            # map, because the files in orig/ and conf/ are derived from them
+            key = cache.key('%s/%s' % (self._path['images'], img),
+                            self.get_conf(img_filename),
+                            self.conf_threshold, hdu,
+                            self._header_expanded,
+                            extra=self._projection_parameters())
+            if cache.fetch(key, self._header_expanded, output):
+                self.log.debug('Projection cache hit: %s' % output)
+                return True
+
+            # Project into the canonical frame of the cache
+            tmp = cache.scratch_name(key)
+            canonical = tmp + '.hdr'
+            cache.write_canonical_frame(self._header_expanded, canonical)
+            try:
+                if not project(canonical, tmp):
+                    return False
+                cache.store(key, tmp)
+            finally:
+                os.remove(canonical)
+            return cache.fetch(key, self._header_expanded, output, count=False)
+        return job
 
     def compute_overlaps(self):
         """
@@ -309,6 +620,20 @@ class Mosaic(object):
         """
         assert( os.path.exists( self._path['work'] ) )
 
+        # In delta mode, the fits of pairs of unchanged projections are kept
+        reuse = {}
+        if self.delta:
+            reuse = self._reusable_fits()
+
+        if self.overlaps_backend == 'numpy':
+            # Fit the differences in memory instead of via diff/
+            overlaps.fit_overlaps(self._projtbl,
+                                  self._path['work'] + '/proj',
+                                  self._fittbl, self.workers, self.log,
+                                  reuse)
+            self._save_fits()
+            return
+
         # Where do the images overlap?
         cmd = '%s/mOverlaps %s %s' % (
                             self._path['montage'], 
@@ -316,11 +641,37 @@ class Mosaic(object):
                             self._difftbl)
         self.execute(cmd)
 
+        # Only the pairs without a valid fit are differenced and fitted
+        difftbl = self._difftbl
+        reused = []
+        if reuse:
+            header, diffs = read_tbl(self._difftbl)
+            reused = overlaps.reuse_fits(reuse, zip(diffs['plus'], diffs['minus']),
+                                         self._projtbl)
+            done = set()
+            for row in reused:
+                done.add( (row['plus'], row['minus']) )
+                done.add( (row['minus'], row['plus']) )
+            rows = [k for k in range(len(diffs['plus']))
+                    if (int(diffs['cntr1'][k]), int(diffs['cntr2'][k])) not in done]
+            self.log.info('Delta mode: re-using the fits of %d pairs, fitting %d'
+                          % (len(reused), len(rows)))
+            if len(rows) == 0:
+                overlaps.write_fits(self._fittbl, reused)
+                self._save_fits()
+                return
+            difftbl = self._difftbl + '.delta'
+            write_tbl(difftbl, [('cntr1', 'int', '%d', diffs['cntr1'][rows]),
+                                ('cntr2', 'int', '%d', diffs['cntr2'][rows]),
+                                ('plus', 'char', '%s', diffs['plus'][rows]),
+                                ('minus', 'char', '%s', diffs['minus'][rows]),
+                                ('diff', 'char', '%s', diffs['diff'][rows])])
+
         # Compute the difference between all overlapping pairs
         cmd = '%s/mDiffExec -p %s/proj %s %s %s/diff' % (
                     self._path['montage'], 
                     self._path['work'], 
-                    self._difftbl, 
+                    difftbl, 
                     self._header_expanded,
                     self._path['work'])
         self.execute(cmd)
@@ -328,11 +679,44 @@ class Mosaic(object):
         # Fit a plane through the mosaic
         cmd = '%s/mFitExec %s %s %s/diff' % (
                     self._path['montage'], 
-                    self._difftbl, 
+                    difftbl, 
                     self._fittbl, 
                     self._path['work'])
         self.execute(cmd)
 
+        if reused:
+            fits = overlaps.read_fits(self._fittbl, self._projtbl)
+            overlaps.write_fits(self._fittbl, reused + list(fits.values()))
+        self._save_fits()
+
+    def _reusable_fits(self):
+        """
+        Returns the overlap fits (see overlaps.read_fits) of the pairs of
+        images whose projections did not change since they were fitted.
+
+        """
+        if not os.path.exists(self._fitstate) or not os.path.exists(self._projstate):
+            return {}
+        previous = json.load(open(self._fitstate, 'r'))
+        current = json.load(open(self._projstate, 'r'))
+        unchanged = set([f for f in current
+                         if previous['projections'].get(f) == current[f]])
+        return dict(((plus, minus), row) for plus, minus, row in previous['fits']
+                    if plus in unchanged and minus in unchanged)
+
+    def _save_fits(self):
+        """
+        Records the overlap fits with the projections they were made from.
+
+        """
+        if not os.path.exists(self._projstate):
+            return
+        fits = overlaps.read_fits(self._fittbl, self._projtbl)
+        self._write_json(self._fitstate,
+                         {'projections': json.load(open(self._projstate, 'r')),
+                          'fits': [[plus, minus, row] for (plus, minus), row
+                                   in sorted(fits.items())]})
+
     def compute_background(self):
         # Copy all projected images to avoid non-overlapping ones to be missing
         """
@@ -341,13 +725,78 @@ class Mosaic(object):
         self.execute(cmd)
         """
         # Determine the set of corrections to apply
-        cmd = '%s/mBgModel -l -i 20000 %s %s %s' % (
-                self._path['montage'], 
-                self._projtbl, 
-                self._fittbl, 
-                self._corrtbl)
+        if self.bgmodel_backend == 'scipy':
+            model = bgmodel.BackgroundModel(self.bgmodel_level_only)
+            model.add_tile(self._projtbl, self._fittbl)
+            model.solve(self.log)
+            model.write_corrections(self._projtbl, self._corrtbl)
+        elif self.bgmodel_backend == 'joint':
+            if not os.path.exists(self._corrtbl):
+                raise Exception('No joint background solution found: %s'
+                                % self._corrtbl)
+        else:
+            cmd = '%s/mBgModel %s-i %d %s %s %s' % (
+                    self._path['montage'], 
+                    '-l ' if self.bgmodel_level_only else '',
+                    self.bgmodel_iterations,
+                    self._projtbl, 
+                    self._fittbl, 
+                    self._corrtbl)
+            self.execute(cmd)
+
+        preview = None
+        if self.coadd_backend == 'numpy':
+            preview = self._coadd_native()
+        else:
+            self._coadd_montage(self._output_corrected_local)
+
+        # Move the result to the requested output directory
+        output_corrected = self._output_corrected
+        cmd = 'cp %s %s' % (self._output_corrected_local, output_corrected)
         self.execute(cmd)
 
+        # Produce a quicklook
+        self._quicklook(output_corrected, preview)
+
+    def _quicklook(self, filename, preview=None):
+        """
+        Produces the quicklook previews of a co-added image.
+
+        :param preview:
+        quicklook.Preview fed during the co-addition, if any; otherwise the
+        image is read back from disk.
+        """
+        vmin, vmax, stretch = self.quicklook_stretch
+        fmt = self._quicklook_format()
+        if fmt == 'mJPEG':
+            cmd = '%s/mJPEG -gray %s %s %s %s -out %s' % (
+                        self._path['montage'],
+                        filename, vmin, vmax, stretch,
+                        filename + '.jpg')
+            self.execute(cmd)
+            return
+        if preview is None:
+            quicklook.render(filename, factors=self.quicklook_factors,
+                             vmin=vmin, vmax=vmax, stretch=stretch,
+                             fmt=fmt)
+        else:
+            preview.write(filename, vmin, vmax, stretch, fmt)
+
+    def _quicklook_format(self):
+        """
+        Returns the quicklook format to use; JPEG files are left to mJPEG
+        if PIL is not installed.
+
+        """
+        if self.quicklook_format == 'jpg' and not quicklook.jpeg_available():
+            return 'mJPEG'
+        return self.quicklook_format
+
+    def _coadd_montage(self, output):
+        """
+        Applies the background corrections and co-adds using mBgExec/mAdd.
+
+        """
         # Apply the corrections
         cmd = '%s/mBgExec -p %s/proj %s %s %s/corr' % (
                 self._path['montage'], 
@@ -358,7 +807,6 @@ class Mosaic(object):
         self.execute(cmd)
 
         # Create a new image table for the corrected images
-        self._corrimgtbl = '%s/corrimg-%s.tbl' % (self._path['work'], self._name)
         cmd = '%s/mImgtbl -c %s/corr %s' % (
                 self._path['montage'], 
                 self._path['work'], 
@@ -366,44 +814,408 @@ class Mosaic(object):
         self.execute(cmd)
 
         # Co-add the corrected images
-        output_corrected_local = '%s/%s.fits' % (
-                            self._path['work'], 
-                            self._name)
-        cmd = '%s/mAdd -a mean -e -p %s/corr %s %s %s' % (
-                self._path['montage'], 
-                self._path['work'], 
-                self._corrimgtbl, 
-                self._header, 
-                output_corrected_local)
-        self.execute(cmd)
+        self._add(self._path['work']+'/corr', self._corrimgtbl,
+                  self._header, output)
 
-        # Move the result to the requested output directory
-        output_corrected = '%s/%s.fits' % (
-                            self._path['output'], 
-                            self._name)
-        cmd = 'cp %s %s' % (output_corrected_local, output_corrected)
-        self.execute(cmd)
+    def _add(self, imgdir, tbl, header, output, options='-a mean -e'):
+        """
+        Co-adds images with mAdd, in strips of 'strip_rows' rows if set.
 
-        # Produce a quicklook jpg
-        cmd = '%s/mJPEG -gray %s 20 200 log -out %s' % (
-                    self._path['montage'], 
-                    output_corrected,
-                    output_corrected + '.jpg')
-        self.execute(cmd)
+        Every strip is co-added from the images which overlap it, such that
+        the memory used by mAdd is bounded by the size of a strip; the
+        strips are then stitched into 'output' (see strips.py).
+        """
+        tile_strips = []
+        if self.strip_rows is not None:
+            tile_strips = strips.split(header, self.strip_rows, self.strip_overlap)
+        if len(tile_strips) < 2:
+            cmd = '%s/mAdd %s -p %s %s %s %s' % (
+                    self._path['montage'], options, imgdir, tbl, header, output)
+            self.execute(cmd)
+            return
+
+        stripdir = self._path['work'] + '/strips'
+        self.create_dir(stripdir)
+        name = os.path.basename(output).rsplit('.', 1)[0]
+        try:
+            for strip in tile_strips:
+                prefix = '%s/%s-strip%03d' % (stripdir, name, strip.index)
+                strips.write_strip_template(header, strip, prefix + '.hdr')
+                if strips.write_strip_table(tbl, header, strip, prefix + '.tbl') == 0:
+                    continue
+                cmd = '%s/mAdd %s -p %s %s %s %s' % (
+                        self._path['montage'], options, imgdir,
+                        prefix + '.tbl', prefix + '.hdr', prefix + '.fits')
+                self.execute(cmd)
+                strip.filename = prefix + '.fits'
+            max_diff = strips.stitch(tile_strips, header, output, log=self.log)
+            self.log.info('Co-added %s in %d strips' % (os.path.basename(output),
+                                                        len(tile_strips)))
+            if self.strip_overlap > 0:
+                self.log.info('Max difference in the %d overlapping rows of the strips: %g'
+                              % (self.strip_overlap, max_diff))
+        finally:
+            strips.remove(tile_strips)
+
+    def _coadd_native(self):
+        """
+        Co-adds the uncorrected and corrected mosaics in a single pass.
+
+        Returns the quicklook.Preview of the corrected mosaic (or None).
+        """
+        projdir = self._path['work'] + '/proj'
+        images = coadd.read_images(self._projtbl, projdir)
+
+        # Background planes from mBgModel, indexed by projected image
+        header, proj = read_tbl(self._projtbl)
+        filenames = dict(zip(proj['cntr'],
+                             ['%s/%s' % (projdir, f) for f in proj['fname']]))
+        header, corr = read_tbl(self._corrtbl)
+        corrections = {}
+        for i, a, b, c in zip(corr['id'], corr['a'], corr['b'], corr['c']):
+            corrections[filenames[i]] = (a, b, c)
+
+        outputs = [coadd.CoaddOutput(self._output_uncorrected,
+                                     self._header_expanded),
+                   coadd.CoaddOutput(self._output_corrected_local,
+                                     self._header, corrections)]
+        # The quicklooks are built from the co-added rows as they are written
+        previews = [None, None]
+        if self._quicklook_format() != 'mJPEG':
+            previews = [quicklook.Preview(o.naxis1, self.quicklook_factors)
+                        for o in outputs]
+        coadd.coadd(images, outputs, self.coadd_memory, self.log, previews)
+
+        # Produce a quicklook
+        self._quicklook(self._output_uncorrected, previews[0])
+
+        if self.coadd_validate:
+            self._validate_coadd()
+        return previews[1]
+
+    def _validate_coadd(self):
+        """
+        Repeats the co-additions with mAdd and logs the differences.
+
+        """
+        reference_uncorrected = self._output_uncorrected + '.mAdd.fits'
+        self._add(self._path['work']+'/proj', self._projtbl,
+                  self._header_expanded, reference_uncorrected)
+        reference_corrected = self._output_corrected_local + '.mAdd.fits'
+        self._coadd_montage(reference_corrected)
+
+        for output, reference in [(self._output_uncorrected, reference_uncorrected),
+                                  (self._output_corrected_local, reference_corrected)]:
+            diff = coadd.compare(output, reference)
+            self.log.info(('Co-add validation %s: %d of %d pixels differ bitwise, '
+                           + '%d differ in coverage, max abs diff %g') % (
+                            os.path.basename(output), diff['bits_differ'],
+                            diff['pixels'], diff['nan_differ'],
+                            diff['max_abs_diff']))
+
+    def _stage_files(self, stage):
+        """
+        Returns the (inputs, parameters, outputs) of a pipeline stage.
+
+        Inputs and outputs are lists of files or directories; all the files
+        in a directory are considered.
+        """
+        work = self._path['work']
+        if stage == 'setup':
+            return ([self._header, self._header_expanded], {},
+                    [work+'/'+os.path.basename(self._header),
+                     work+'/'+os.path.basename(self._header_expanded)])
+        elif stage == 'select':
+            return ([self._imgtable_all[self._band], self._header], {},
+                    [self._imgtable])
+        elif stage == 'copy':
+            # The archive is not checksummed: the exposures are identified
+            # by the image table, and the confidence maps by their contents
+            images = [img.split('/')[-1] for img in sorted(self._images or [])]
+            confmaps = sorted(set([self.get_conf(img) for img in images]))
+            return ([self._imgtable] + (confmaps if self.use_mosaic else []),
+                    {'use_mosaic': self.use_mosaic,
+                     'compress_scratch': self.compress_scratch},
+                    [work+'/orig', work+'/conf'])
+        elif stage == 'project':
+            outputs = [work+'/proj', self._projtbl]
+            if self.coadd_backend != 'numpy':
+                outputs.append(self._output_uncorrected)
+            return ([self._imgtable, self._header_expanded, work+'/orig'],
+                    {'use_mosaic': self.use_mosaic,
+                     'compress_scratch': self.compress_scratch,
+                     'conf_threshold': self.conf_threshold,
+                     'coadd_backend': self.coadd_backend,
+                     'strip_rows': self.strip_rows,
+                     'projection_backend': self.projection_backend,
+                     'projection_method': self.projection_method},
+                    outputs)
+        elif stage == 'overlaps':
+            outputs = [self._fittbl]
+            if self.overlaps_backend != 'numpy':
+                outputs.extend([self._difftbl, work+'/diff'])
+            return ([self._projtbl, self._header_expanded, work+'/proj'],
+                    {'overlaps_backend': self.overlaps_backend},
+                    outputs)
+        elif stage == 'background':
+            outputs = [self._corrtbl, self._output_corrected_local,
+                       self._output_corrected]
+            if self.coadd_backend == 'numpy':
+                outputs.append(self._output_uncorrected)
+            else:
+                outputs.extend([self._corrimgtbl, work+'/corr'])
+            return ([self._projtbl, self._fittbl, self._header,
+                     self._header_expanded, work+'/proj'],
+                    {'bgmodel_level_only': self.bgmodel_level_only,
+                     'bgmodel_iterations': self.bgmodel_iterations,
+                     'bgmodel_backend': self.bgmodel_backend,
+                     'coadd_backend': self.coadd_backend,
+                     'strip_rows': self.strip_rows},
+                    outputs)
+        raise Exception('Unknown stage: %s' % stage)
+
+    def _file_state(self, paths, previous={}, checksum=True):
+        """
+        Returns {filename: [size, mtime, md5]} for a list of files/directories.
+
+        Checksums are only recomputed for files whose size or modification
+        time differ from those recorded in 'previous'. Missing files map to None.
+        """
+        state = {}
+        for path in paths:
+            if os.path.isdir(path):
+                filenames = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+            else:
+                filenames = [path]
+            for filename in filenames:
+                if not os.path.isfile(filename):
+                    state[filename] = None
+                    continue
+                st = os.stat(filename)
+                old = previous.get(filename)
+                if old and old[0] == st.st_size and old[1] == st.st_mtime:
+                    state[filename] = old
+                elif checksum:
+                    state[filename] = [st.st_size, st.st_mtime, md5sum(filename)]
+                else:
+                    state[filename] = [st.st_size, st.st_mtime, None]
+        return state
+
+    def _manifest_filename(self, stage):
+        return '%s/manifest-%s.json' % (self._path['work'], stage)
+
+    def _stage_is_current(self, stage):
+        """
+        Has the stage been completed with the present inputs and parameters?
+
+        """
+        filename = self._manifest_filename(stage)
+        if not os.path.exists(filename):
+            return False
+        manifest = json.load(open(filename, 'r'))
+        inputs, params, outputs = self._stage_files(stage)
+        if manifest['parameters'] != params:
+            self.log.info('Stage %s: parameters changed' % stage)
+            return False
+        # Inputs are compared by content, such that touching a file is harmless
+        state = self._file_state(inputs, manifest['inputs'])
+        content = lambda st: dict((f, v and v[0::2]) for f, v in st.items())
+        if content(self._unreleased(state)) \
+                != content(self._unreleased(manifest['inputs'])):
+            self.log.info('Stage %s: inputs changed' % stage)
+            return False
+        # Outputs must be present and untouched, unless deleted by the cleanup
+        state = self._file_state(outputs, manifest['outputs'], checksum=False)
+        if self._unreleased(state) != self._unreleased(manifest['outputs']):
+            self.log.info('Stage %s: outputs changed or missing' % stage)
+            return False
+        return True
+
+    def _checksum_memo(self):
+        """
+        Returns the input states recorded in all the stage manifests, such
+        that the checksums of files which did not change are not recomputed.
+
+        """
+        memo = {}
+        for stage in ['setup', 'select', 'copy', 'project', 'overlaps', 'background']:
+            filename = self._manifest_filename(stage)
+            if os.path.exists(filename):
+                memo.update(json.load(open(filename, 'r'))['inputs'])
+        return memo
+
+    def _stage_done(self, stage, memo={}):
+        """
+        Writes the completion manifest of a stage.
+
+        :param memo:
+        Earlier file states (see _checksum_memo).
+        """
+        inputs, params, outputs = self._stage_files(stage)
+        filename = self._manifest_filename(stage)
+        manifest = {'stage': stage,
+                    'parameters': params,
+                    'inputs': self._file_state(inputs, memo),
+                    'outputs': self._file_state(outputs, checksum=False)}
+        # Write to a temporary file first, such that a crash never leaves
+        # a truncated manifest behind
+        output = open(filename+'.tmp', 'w')
+        json.dump(manifest, output, indent=1, sort_keys=True)
+        output.close()
+        os.rename(filename+'.tmp', filename)
+
+    def run_stage(self, stage, function):
+        """
+        Runs a pipeline stage unless it has already been completed.
+
+        :param stage:
+        Name of the stage (one of 'setup', 'select', 'copy', 'project',
+        'overlaps', 'background').
+
+        :param function:
+        Method which carries out the stage.
+
+        Returns True if the stage was executed, False if it was skipped.
+        """
+        if self.resume and self._stage_is_current(stage):
+            self.log.info('Stage %s is up to date, skipping' % stage)
+            return False
+        # A stage which is re-run invalidates its old manifest, but the
+        # checksums it recorded remain valid for unchanged files
+        memo = self._checksum_memo()
+        if os.path.exists(self._manifest_filename(stage)):
+            os.remove(self._manifest_filename(stage))
+        self._restore(stage)
+        self.log.info('Stage %s: starting' % stage)
+        self._stage = stage
+        try:
+            function()
+        finally:
+            self._stage = None
+        self._stage_done(stage, memo)
+        self._release(stage)
+        return True
+
+    def _released(self):
+        """
+        Returns the list of intermediate directories deleted by the cleanup.
+
+        """
+        if not os.path.exists(self._releasedfile):
+            return []
+        return json.load(open(self._releasedfile, 'r'))
+
+    def _unreleased(self, state):
+        """
+        Drops the files in released directories from a manifest state, such
+        that the cleanup does not make the stages involved out of date.
+
+        """
+        released = [path + '/' for path in self._released()]
+        return dict((f, v) for f, v in state.items()
+                    if not any([f.startswith(path) for path in released]))
+
+    def _consumed(self, stage):
+        """
+        Returns the intermediate directories which are no longer needed once
+        a stage is done, minus those the resumption and caching policy keep.
+
+        """
+        work = self._path['work']
+        consumed = {'project': ['orig', 'conf'],
+                    'overlaps': ['diff'],
+                    'background': ['proj', 'corr']}.get(stage, [])
+        keep = list(self.keep)
+        if self.delta:
+            # Unchanged projections are re-used by the next run
+            keep.append('proj')
+        return [work + '/' + path for path in consumed if path not in keep]
+
+    def _release(self, stage):
+        """
+        Deletes the intermediates consumed by a stage (if 'cleanup' is set)
+        and records the scratch space used.
+
+        """
+        paths = self._consumed(stage) if self.cleanup else []
+        if paths:
+            # Recorded first: the cleanup may be interrupted half-way
+            released = self._released()
+            self._write_json(self._releasedfile,
+                             sorted(set(released) | set(paths)))
+        if self.scratch_manager is not None:
+            self.scratch_manager.release(self._path['work'], stage, paths)
+        else:
+            for path in paths:
+                scratch.clear(path)
+
+    def _restore(self, stage):
+        """
+        Re-creates the released intermediates a stage which has to run again
+        consumes, by re-running the steps which produced them.
+
+        """
+        inputs, params, outputs = self._stage_files(stage)
+        released = self._released()
+        missing = [path for path in inputs if path in released]
+        work = self._path['work']
+        if work+'/orig' in missing:
+            # copy_images() writes the confidence maps as well
+            missing.append(work+'/conf')
+        # The outputs of the stage are about to be written afresh
+        remaining = [path for path in released
+                     if path not in missing and path not in outputs]
+        if remaining == released:
+            return
+        self._write_json(self._releasedfile, remaining)
+        if work+'/orig' in missing:
+            self.log.info('Stage %s: copying the released original images again' % stage)
+            self.copy_images()
+            self._stage_done('copy', self._checksum_memo())
+        if work+'/proj' in missing:
+            self.log.info('Stage %s: reprojecting the released projections' % stage)
+            self.run_stage('project', self.compute_projections)
 
     def mosaic(self):
         """
-        Create the mosaic
+        Create the mosaic, resuming from the first stage whose inputs changed.
         """
-        self.setup_workdir()
-        self.select_images()
-        #self.copy_images()
-        self.compute_projections()
-        self.compute_overlaps()
-        self.compute_background()
+        self.run_stage('setup', self.setup_workdir)
+        if not self.run_stage('select', self.select_images):
+            self._read_imgtable()
+        self.run_stage('copy', self.copy_images)
+        self.run_stage('project', self.compute_projections)
+        self.run_stage('overlaps', self.compute_overlaps)
+        self.run_stage('background', self.compute_background)
+        self.profile.log_summary(self.log, 'stage')
+        self.profile.log_summary(self.log, 'tool')
         self.log.info('All is said and done.')
 
 
+def affected_tiles(grid, current, previous):
+    """
+    Returns the tiles of a grid which overlap exposures that were added,
+    removed or changed between two versions of an image catalogue.
+
+    :param grid:
+    TileGrid; use the expanded grid, as the projections and background
+    fits of a tile cover its expanded header.
+
+    :param current:
+    :param previous:
+    catalogue.Catalogue objects.
+    """
+    tiles = set()
+    for images, rows in zip([current, previous], current.changed(previous)):
+        if len(rows) == 0:
+            continue
+        ra, dec = images[rows].corners()
+        l, b = coverage.equatorial_to_galactic(ra, dec)
+        for k in range(len(rows)):
+            tiles.update(grid.overlapping(l[k], b[k]))
+    return sorted([int(tile) for tile in tiles])
+
+
 class FitsHeader(object):
     """
     Creates tiled FITS WCS headers for large-scale mosaics.
@@ -441,6 +1253,15 @@ class FitsHeader(object):
         self._ctype1 = ctype1
         self._ctype2 = ctype2
 
+    def grid(self):
+        """
+        Returns the TileGrid with the current parameters.
+
+        """
+        return TileGrid(self._x1, self._x2, self._y1, self._y2,
+                        self._resolution, self._tiles_x, self._tiles_y,
+                        self._tiles_overlap, self._ctype1, self._ctype2)
+
     def parse(self, tile=0):
         """
         Parses the FITS header for a given tile number.
@@ -449,41 +1270,98 @@ class FitsHeader(object):
         Tile number (starting at zero.)
 
         """
-        # Compute resolution in degrees/px
-        self._cdelt1 = -self._resolution/3600.
-        self._cdelt2 = self._resolution/3600.
+        return self.grid().header(tile)
+
+    def save(self, filename, tile=0):
+        """
+        Writes the header to a file.
+
+        :param filename:
+        Filename to write the header to.
+
+        :param tile:
+        Tile number (starting at zero.)
+        """
+        header = self.parse(tile)
+        output = open(filename, 'w')
+        output.write(header)
+        output.close()
 
-        # Compute the horizontal size of each tile
-        self._xsize = (self._x2 - self._x1) / float(self._tiles_x)
-        naxis1 = self._xsize / -self._cdelt1
-        self._naxis1 = (1.0 + 2*self._tiles_overlap) * naxis1
-        # Compute the vertical size of each tile
-        self._ysize = (self._y2 - self._y1) / float(self._tiles_y)
-        naxis2 = self._ysize / self._cdelt2
-        self._naxis2 = (1.0 + 2*self._tiles_overlap) * naxis2
 
-        # Log our findings for debugging
+
+class TileGrid(object):
+    """
+    Geometry of all the tiles of a FitsHeader grid, computed at once.
+
+    The reference values of the tiles are NumPy arrays indexed by tile
+    number, such that headers and footprints of any subset of tiles can be
+    obtained without writing files. Takes the same parameters as FitsHeader.
+    """
+
+    def __init__(self, x1, x2, y1, y2, resolution,
+            tiles_x, tiles_y, tiles_overlap=0.05,
+            ctype1='GLON-CAR', ctype2='GLAT-CAR'):
+        self._x1, self._x2 = x1, x2
+        self._y1, self._y2 = y1, y2
+        self._resolution = resolution
+        self.tiles_x = tiles_x
+        self.tiles_y = tiles_y
+        self.tiles_overlap = tiles_overlap
+        self.ctype1 = ctype1
+        self.ctype2 = ctype2
+
+        # Resolution in degrees/px
+        self.cdelt1 = -resolution/3600.
+        self.cdelt2 = resolution/3600.
+        # Size of each tile, including the overlap on both sides
+        self.xsize = (x2 - x1) / float(tiles_x)
+        self.ysize = (y2 - y1) / float(tiles_y)
+        self.naxis1 = (1.0 + 2*tiles_overlap) * self.xsize / -self.cdelt1
+        self.naxis2 = (1.0 + 2*tiles_overlap) * self.ysize / self.cdelt2
+        # Pixel coordinates at the center of the tiles
+        self.crpix1 = self.naxis1 / 2
+        self.crpix2 = self.naxis2 / 2
         logging.debug( ('Tile parameters: NAXIS1=%s (%s deg) NAXIS2=%s (%s deg)'
                        +' CDELT1=%s CDELT2=%s') % (
-                        self._naxis1, self._xsize, 
-                        self._naxis2, self._ysize,
-                        self._cdelt1, self._cdelt2))
-
-        # x and y number of the tile (starting at zero)
-        x = int(np.floor(tile / self._tiles_y))
-        y = (tile % self._tiles_y)
-
-        # Sky coordinates at the center of the tile
-        crval1 = self._x1 + (x+0.5) * self._xsize
-        crval2 = self._y1 + (y+0.5) * self._ysize
-        # Pixel coordinates at the center of the tile
-        crpix1 = self._naxis1 / 2
-        crpix2 = self._naxis2 / 2
-        # Log our findings for debugging
-        logging.debug('x=%s y=%s CRVAL1=%s CRVAL2=%s CRPIX1=%s CRPIX2=%s' % (
-                        x, y, crval1, crval2, crpix1, crpix2))
+                        self.naxis1, self.xsize,
+                        self.naxis2, self.ysize,
+                        self.cdelt1, self.cdelt2))
+
+        # x and y number of every tile (starting at zero)
+        self.tile = np.arange(tiles_x * tiles_y)
+        self.x = self.tile // tiles_y
+        self.y = self.tile % tiles_y
+        # Sky coordinates at the center of every tile
+        self.crval1 = x1 + (self.x + 0.5) * self.xsize
+        self.crval2 = y1 + (self.y + 0.5) * self.ysize
+
+    def __len__(self):
+        return len(self.tile)
+
+    def expanded(self, tiles_overlap=0.4):
+        """
+        Returns the same grid with a larger overlap between the tiles, as
+        recommended for the reprojection and background steps.
+
+        """
+        return TileGrid(self._x1, self._x2, self._y1, self._y2,
+                        self._resolution, self.tiles_x, self.tiles_y,
+                        tiles_overlap, self.ctype1, self.ctype2)
+
+    def _tiles(self, tiles):
+        if tiles is None:
+            return self.tile
+        return np.atleast_1d(np.asarray(tiles, dtype=int))
+
+    def header(self, tile=0):
+        """
+        Returns the Montage template header of a tile.
 
-        # Parse the header
+        """
+        logging.debug('x=%s y=%s CRVAL1=%s CRVAL2=%s CRPIX1=%s CRPIX2=%s' % (
+                        self.x[tile], self.y[tile],
+                        self.crval1[tile], self.crval2[tile],
+                        self.crpix1, self.crpix2))
         hdr = ("SIMPLE  = T\n"
                 +"BITPIX  = -32\n"
                 +"NAXIS   = 2\n"
@@ -503,25 +1381,72 @@ class FitsHeader(object):
                 +"PC2_1 = 0\n"
                 +"PC2_2 = 1\n"
                 +"END\n") % (
-                self._naxis1, self._naxis2,
-                self._ctype1, self._ctype2,
-                crval1, crval2, crpix1, crpix2, 
-                self._cdelt1, self._cdelt2)
-
+                self.naxis1, self.naxis2,
+                self.ctype1, self.ctype2,
+                self.crval1[tile], self.crval2[tile],
+                self.crpix1, self.crpix2,
+                self.cdelt1, self.cdelt2)
         return hdr
 
-    def save(self, filename, tile=0):
+    def headers(self, tiles=None):
         """
-        Writes the header to a file.
+        Returns a dict {tile: header} for a list of tiles (default: all).
 
-        :param filename:
-        Filename to write the header to.
+        """
+        return dict((int(t), self.header(t)) for t in self._tiles(tiles))
 
-        :param tile:
-        Tile number (starting at zero.)
+    def save(self, pattern, tiles=None):
         """
-        header = self.parse(tile)
-        output = open(filename, 'w')
-        output.write(header)
-        output.close()
+        Writes the headers of a list of tiles (default: all).
+
+        :param pattern:
+        Filename pattern, e.g. '/tmp/tile%03d.hdr'.
 
+        Returns the list of filenames written.
+        """
+        filenames = []
+        for tile, hdr in sorted(self.headers(tiles).items()):
+            filename = pattern % tile
+            output = open(filename, 'w')
+            output.write(hdr)
+            output.close()
+            filenames.append(filename)
+        return filenames
+
+    def footprints(self, tiles=None):
+        """
+        Returns the corners of the tiles as (lon, lat) arrays of shape (n, 4).
+
+        The corners are the outer pixel edges, in the coordinate system of
+        the grid, ordered around the tile.
+        """
+        tiles = self._tiles(tiles)
+        cards = {'CRVAL1': self.crval1[tiles][:, np.newaxis],
+                 'CRVAL2': self.crval2[tiles][:, np.newaxis],
+                 'CRPIX1': self.crpix1, 'CRPIX2': self.crpix2,
+                 'CDELT1': self.cdelt1, 'CDELT2': self.cdelt2}
+        n1, n2 = int(self.naxis1), int(self.naxis2)
+        p1 = np.array([0.5, n1 + 0.5, n1 + 0.5, 0.5])
+        p2 = np.array([0.5, 0.5, n2 + 0.5, n2 + 0.5])
+        return coverage.car_pix2world(cards, p1[np.newaxis, :], p2[np.newaxis, :])
+
+    def overlapping(self, lon, lat, tiles=None):
+        """
+        Returns the tiles whose footprint overlaps a convex polygon.
+
+        :param lon:
+        :param lat:
+        Vertices of the polygon (degrees), in the coordinate system of the grid.
+        """
+        tiles = self._tiles(tiles)
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        centre = lon[0]
+        tile_lon, tile_lat = self.footprints(tiles)
+        # Unwrap every tile around its own centre first, such that tiles
+        # opposite the polygon on the sky do not wrap around
+        tile_centre = self.crval1[tiles][:, np.newaxis]
+        tile_lon = (coverage._unwrap(tile_centre, centre)
+                    + coverage._unwrap(tile_lon, tile_centre))
+        hit = coverage._overlaps(coverage._unwrap(lon, centre), lat,
+                                 tile_lon, tile_lat)
+        return tiles[hit]
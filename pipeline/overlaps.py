@@ -0,0 +1,233 @@
+"""
+In-process background difference fitting, replacing mOverlaps, mDiffExec
+and mFitExec.
+
+"""
+
+import logging
+import os
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pyfits
+
+from montage import read_tbl, write_tbl, montage_names
+
+
+# Columns of the table written by mFitExec and read by mBgModel
+FIT_COLUMNS = [('plus', 'int', '%d'), ('minus', 'int', '%d'),
+               ('a', 'double', '%.6e'), ('b', 'double', '%.6e'),
+               ('c', 'double', '%.6e'),
+               ('crpix1', 'double', '%.2f'), ('crpix2', 'double', '%.2f'),
+               ('xmin', 'int', '%d'), ('xmax', 'int', '%d'),
+               ('ymin', 'int', '%d'), ('ymax', 'int', '%d'),
+               ('xcenter', 'double', '%.2f'), ('ycenter', 'double', '%.2f'),
+               ('npixel', 'double', '%.0f'), ('rms', 'double', '%.6e'),
+               ('boxx', 'double', '%.2f'), ('boxy', 'double', '%.2f'),
+               ('boxwidth', 'double', '%.2f'), ('boxheight', 'double', '%.2f'),
+               ('boxang', 'double', '%.1f')]
+
+
+def read_images(tbl, imgdir):
+    """
+    Reads the projected images from a table written by mImgtbl.
+
+    Returns a list of (cntr, filename, x0, y0, naxis1, naxis2, crpix1, crpix2)
+    tuples, where (x0, y0) is the integer position of the first pixel
+    relative to the reference pixel of the common frame.
+    """
+    header, cols = read_tbl(tbl)
+    images = []
+    for i in range(len(cols['cntr'])):
+        images.append( (int(cols['cntr'][i]),
+                        '%s/%s' % (imgdir, cols['fname'][i]),
+                        int(round(1 - cols['crpix1'][i])),
+                        int(round(1 - cols['crpix2'][i])),
+                        int(cols['naxis1'][i]), int(cols['naxis2'][i]),
+                        float(cols['crpix1'][i]), float(cols['crpix2'][i])) )
+    return images
+
+
+def find_overlaps(images):
+    """
+    Returns the (i, j) indices of all pairs of images whose pixel ranges
+    overlap, computed with a sweep along the first axis.
+
+    """
+    x0 = np.array([img[2] for img in images])
+    y0 = np.array([img[3] for img in images])
+    x1 = x0 + np.array([img[4] for img in images])
+    y1 = y0 + np.array([img[5] for img in images])
+    order = np.argsort(x0, kind='mergesort')
+    pairs = []
+    for n, i in enumerate(order):
+        # Candidates start before image i ends along x
+        later = order[n+1:]
+        later = later[x0[later] < x1[i]]
+        hit = later[(y0[later] < y1[i]) & (y1[later] > y0[i])]
+        for j in hit:
+            pairs.append( (min(i, j), max(i, j)) )
+    return sorted(pairs)
+
+
+def _read(filename, rows, cols):
+    """
+    Reads a section of a projected image and its area map.
+
+    """
+    image_file, area_file = montage_names(filename)
+    fimg = pyfits.open(image_file, memmap=True)
+    farea = pyfits.open(area_file, memmap=True)
+    data = np.array(fimg[0].data[rows, cols], dtype=np.float64)
+    area = np.array(farea[0].data[rows, cols], dtype=np.float64)
+    fimg.close()
+    farea.close()
+    return data, area
+
+
+def fit_pair(plus, minus, min_pixels=3):
+    """
+    Fits a plane a*x + b*y + c to the difference between two images.
+
+    Coordinates are pixels relative to the reference pixel of the common
+    frame, as in mFitplane. The bounding box columns describe the
+    axis-aligned box around the overlapping pixels.
+
+    Returns a dict with the columns of FIT_COLUMNS, or None if the
+    images share fewer than 'min_pixels' valid pixels.
+    """
+    xs, ys = max(plus[2], minus[2]), max(plus[3], minus[3])
+    xe = min(plus[2] + plus[4], minus[2] + minus[4])
+    ye = min(plus[3] + plus[5], minus[3] + minus[5])
+    if xs >= xe or ys >= ye:
+        return None
+
+    section = []
+    for img in (plus, minus):
+        section.append(_read(img[1], slice(ys - img[3], ye - img[3]),
+                                     slice(xs - img[2], xe - img[2])))
+    (dp, ap), (dm, am) = section
+    valid = np.isfinite(dp) & np.isfinite(dm) & (ap > 0) & (am > 0)
+    npixel = int(valid.sum())
+    if npixel < min_pixels:
+        return None
+
+    iy, ix = np.nonzero(valid)
+    # Pixel coordinates (1-based) in 'plus' relative to its reference pixel
+    x = ix + (xs - plus[2]) + 1 - plus[6]
+    y = iy + (ys - plus[3]) + 1 - plus[7]
+    d = (dp - dm)[valid]
+    # Least-squares plane via the normal equations
+    A = np.array([[np.dot(x, x), np.dot(x, y), x.sum()],
+                  [np.dot(x, y), np.dot(y, y), y.sum()],
+                  [x.sum(), y.sum(), float(npixel)]])
+    rhs = np.array([np.dot(x, d), np.dot(y, d), d.sum()])
+    try:
+        a, b, c = np.linalg.solve(A, rhs)
+    except np.linalg.LinAlgError:
+        # Degenerate geometry (e.g. a single row): fit the level only
+        a, b, c = 0., 0., d.mean()
+    rms = np.sqrt(np.mean((d - (a*x + b*y + c))**2))
+
+    return {'plus': plus[0], 'minus': minus[0], 'a': a, 'b': b, 'c': c,
+            'crpix1': plus[6] - (xs - plus[2]), 'crpix2': plus[7] - (ys - plus[3]),
+            'xmin': int(x.min()), 'xmax': int(x.max()),
+            'ymin': int(y.min()), 'ymax': int(y.max()),
+            'xcenter': (x.min() + x.max()) / 2., 'ycenter': (y.min() + y.max()) / 2.,
+            'npixel': npixel, 'rms': rms,
+            'boxx': (x.min() + x.max()) / 2., 'boxy': (y.min() + y.max()) / 2.,
+            'boxwidth': x.max() - x.min() + 1., 'boxheight': y.max() - y.min() + 1.,
+            'boxang': 0.}
+
+
+def read_fits(fittbl, projtbl):
+    """
+    Reads a table of difference fits, identifying the images by filename
+    rather than by their number in 'projtbl', which changes as soon as an
+    image is added or removed.
+
+    Returns {(plus filename, minus filename): row}, where the rows are dicts
+    with the columns of FIT_COLUMNS.
+    """
+    header, proj = read_tbl(projtbl)
+    fnames = dict(zip(proj['cntr'], proj['fname']))
+    header, fit = read_tbl(fittbl)
+    fits = {}
+    for i in range(len(fit['plus'])):
+        row = {}
+        for name, kind, fmt in FIT_COLUMNS:
+            row[name] = int(fit[name][i]) if kind == 'int' else float(fit[name][i])
+        fits[(str(fnames[row['plus']]), str(fnames[row['minus']]))] = row
+    return fits
+
+
+def reuse_fits(reuse, pairs, projtbl):
+    """
+    Returns the rows of 'reuse' (see read_fits) for a list of pairs of
+    image filenames, renumbered for 'projtbl'; pairs without a row are left out.
+
+    """
+    header, proj = read_tbl(projtbl)
+    cntr = dict(zip(proj['fname'], proj['cntr']))
+    rows = []
+    for plus, minus in pairs:
+        key = (plus, minus) if (plus, minus) in reuse else (minus, plus)
+        if key in reuse:
+            row = dict(reuse[key])
+            row['plus'], row['minus'] = int(cntr[key[0]]), int(cntr[key[1]])
+            rows.append(row)
+    return rows
+
+
+def write_fits(fittbl, rows):
+    """
+    Writes rows of difference fits in the format of mFitExec.
+
+    """
+    write_tbl(fittbl, [(name, kind, fmt, [row[name] for row in rows])
+                       for name, kind, fmt in FIT_COLUMNS])
+
+
+def fit_overlaps(projtbl, projdir, fittbl, workers=1, log=logging, reuse=None):
+    """
+    Writes the difference-plane fits of all overlapping pairs to 'fittbl'.
+
+    The difference images are never written to disk; pairs are processed
+    concurrently by 'workers' threads.
+
+    :param reuse:
+    Optional fits of pairs which are still valid (see read_fits); these
+    pairs are not fitted again.
+    """
+    images = read_images(projtbl, projdir)
+    pairs = find_overlaps(images)
+    reused = []
+    if reuse:
+        names = [os.path.basename(img[1]) for img in images]
+        reused = reuse_fits(reuse, [(names[i], names[j]) for i, j in pairs],
+                            projtbl)
+        done = set()
+        for row in reused:
+            done.add( (row['plus'], row['minus']) )
+            done.add( (row['minus'], row['plus']) )
+        pairs = [(i, j) for i, j in pairs
+                 if (images[i][0], images[j][0]) not in done]
+        log.info('Re-using the fits of %d overlapping pairs' % len(reused))
+    log.info('Fitting %d overlapping pairs of %d images' % (len(pairs), len(images)))
+
+    def fit(pair):
+        return fit_pair(images[pair[0]], images[pair[1]])
+
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            fits = pool.map(fit, pairs, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fits = [fit(pair) for pair in pairs]
+
+    fits = [f for f in fits if f is not None]
+    log.info('%d pairs share enough valid pixels' % len(fits))
+    write_fits(fittbl, reused + fits)
+    return len(reused) + len(fits)
@@ -0,0 +1,347 @@
+"""
+Multi-resolution pyramid of the Galactic plane, built from the finished
+tiles of a TileGrid.
+
+The tiles are resampled onto a single plate carree frame (CRVAL2 = 0) cut
+into square cells of 'cell' pixels. The highest order has the resolution
+of the tiles; every lower order halves the resolution, down to order 0 at
+which the whole grid fits in one cell. This is a quadtree like HiPS, but
+on a CAR rather than a HEALPix grid. Every cell is written as FITS and PNG
+files named '<root>/<order>/<row>/<col>.fits|png', with row 0 at the
+bottom and column 0 on the left (highest longitude).
+
+Where tiles overlap they are blended, with weights falling off linearly
+across the overlap towards the edges of each tile. The state of the tile
+files is kept in '<root>/pyramid.json', such that update() only
+recomputes the cells covered by tiles which changed, and their parents.
+"""
+
+import json
+import logging
+import math
+import os
+import numpy as np
+import pyfits
+
+import coverage
+import quicklook
+
+
+class Pyramid(object):
+    """
+    Quadtree of cells covering the tiles of a grid.
+
+    :param grid:
+    mosaic.TileGrid of the finished tiles (the normal, not expanded, one).
+
+    :param pattern:
+    Filename pattern of the finished tiles, e.g. '/scratch/tile%03d-r-normal.fits'.
+
+    :param root:
+    Directory of the pyramid.
+
+    :param cell:
+    Size of the cells (pixels).
+
+    :param vmin, vmax, stretch:
+    Range and stretch of the PNG cells (see quicklook.scale); fixed values
+    rather than percentiles keep neighbouring cells consistent.
+    """
+
+    def __init__(self, grid, pattern, root, cell=512,
+                 vmin='20', vmax='200', stretch='log', log=logging):
+        self.grid = grid
+        self.pattern = pattern
+        self.root = root
+        self.cell = cell
+        self.vmin, self.vmax, self.stretch = vmin, vmax, stretch
+        self.log = log
+
+        # Extent of the tiles including their overlaps, unwrapped around
+        # the centre of the grid
+        self.resolution = -grid.cdelt1  # deg/px at the highest order
+        lon, lat = self._outlines(grid.tile)
+        self.lon_ref = float(np.mean(grid.crval1))
+        lon = self.lon_ref + coverage._unwrap(lon, self.lon_ref)
+        self.lon0 = float(lon.max())  # Left edge
+        self.lat0 = float(lat.min())  # Bottom edge
+        self.width = int(math.ceil((self.lon0 - lon.min()) / self.resolution))
+        self.height = int(math.ceil((lat.max() - self.lat0) / self.resolution))
+        self.max_order = max(0, int(math.ceil(math.log(
+                            max(self.width, self.height) / float(cell), 2))))
+
+        # Distance from the tile edges over which tiles are blended (pixels)
+        self._ramp = (2 * grid.tiles_overlap * grid.xsize / -grid.cdelt1,
+                      2 * grid.tiles_overlap * grid.ysize / grid.cdelt2)
+
+    def _outlines(self, tiles, samples=16):
+        """
+        Returns points along the outer edges of tiles as (lon, lat) arrays
+        of shape (n, 4*samples).
+
+        """
+        n1, n2 = int(self.grid.naxis1), int(self.grid.naxis2)
+        t = np.linspace(0, 1, samples, endpoint=False)
+        p1 = np.concatenate([0.5 + t*n1, np.repeat(n1+0.5, samples),
+                             n1+0.5 - t*n1, np.repeat(0.5, samples)])
+        p2 = np.concatenate([np.repeat(0.5, samples), 0.5 + t*n2,
+                             np.repeat(n2+0.5, samples), n2+0.5 - t*n2])
+        return coverage.car_pix2world(self._tile_cards(tiles),
+                                      p1[np.newaxis, :], p2[np.newaxis, :])
+
+    def _tile_cards(self, tiles):
+        tiles = np.atleast_1d(tiles)
+        return {'CRVAL1': self.grid.crval1[tiles][:, np.newaxis],
+                'CRVAL2': self.grid.crval2[tiles][:, np.newaxis],
+                'CRPIX1': self.grid.crpix1, 'CRPIX2': self.grid.crpix2,
+                'CDELT1': self.grid.cdelt1, 'CDELT2': self.grid.cdelt2}
+
+    def shape(self, order):
+        """
+        Returns the number of (rows, columns) of cells at an order.
+
+        """
+        scale = 2 ** (self.max_order - order)
+        size = self.cell * scale
+        return ((self.height + size - 1) // size, (self.width + size - 1) // size)
+
+    def filename(self, order, row, col, ext='fits'):
+        return '%s/%d/%d/%d.%s' % (self.root, order, row, col, ext)
+
+    def cell_cards(self, order, row, col):
+        """
+        Returns the WCS of a cell as a dict of header keywords.
+
+        """
+        d = self.resolution * 2 ** (self.max_order - order)
+        return {'NAXIS1': self.cell, 'NAXIS2': self.cell,
+                'CTYPE1': self.grid.ctype1, 'CTYPE2': self.grid.ctype2,
+                'CRVAL1': self.lon_ref % 360., 'CRVAL2': 0.,
+                'CRPIX1': (self.lon0 - self.lon_ref) / d + 0.5 - col * self.cell,
+                'CRPIX2': -self.lat0 / d + 0.5 - row * self.cell,
+                'CDELT1': -d, 'CDELT2': d}
+
+    def _cell_world(self, order, row, col, edges=False):
+        """
+        Returns the (lon, lat) of the pixel centres of a cell, or of its
+        four corners if 'edges' is set.
+
+        """
+        cards = self.cell_cards(order, row, col)
+        if edges:
+            p = np.array([0.5, self.cell + 0.5])
+            p1, p2 = np.array([p[0], p[1], p[1], p[0]]), np.array([p[0], p[0], p[1], p[1]])
+        else:
+            p1, p2 = np.meshgrid(np.arange(1, self.cell + 1, dtype=float),
+                                 np.arange(1, self.cell + 1, dtype=float))
+        return coverage.car_pix2world(cards, p1, p2)
+
+    def cells_of_tile(self, tile):
+        """
+        Returns the (row, col) of the cells of the highest order which a
+        tile overlaps.
+
+        """
+        lon, lat = self._outlines(tile)
+        lon = self.lon_ref + coverage._unwrap(lon, self.lon_ref)
+        col0 = int((self.lon0 - lon.max()) / self.resolution) // self.cell
+        col1 = int((self.lon0 - lon.min()) / self.resolution) // self.cell
+        row0 = int((lat.min() - self.lat0) / self.resolution) // self.cell
+        row1 = int((lat.max() - self.lat0) / self.resolution) // self.cell
+        rows, cols = self.shape(self.max_order)
+        return [(row, col) for row in range(max(0, row0), min(rows - 1, row1) + 1)
+                           for col in range(max(0, col0), min(cols - 1, col1) + 1)]
+
+    def tiles_of_cell(self, row, col):
+        """
+        Returns the tiles which overlap a cell of the highest order.
+
+        """
+        lon, lat = self._cell_world(self.max_order, row, col, edges=True)
+        return self.grid.overlapping(lon, lat)
+
+    def _weight(self, x, y):
+        """
+        Blending weight of the tile pixels at (x, y), 1 away from the overlaps.
+
+        """
+        w = np.ones(x.shape)
+        for p, n, ramp in [(x, self.grid.naxis1, self._ramp[0]),
+                           (y, self.grid.naxis2, self._ramp[1])]:
+            distance = np.minimum(p - 0.5, int(n) + 0.5 - p)
+            if ramp > 0:
+                w *= np.clip(distance / ramp, 0., 1.)
+            else:
+                w *= distance > 0
+        return w
+
+    def render_cell(self, row, col):
+        """
+        Resamples the tiles which overlap a cell of the highest order.
+
+        Returns the cell image (NaN where no tile has data.)
+        """
+        lon, lat = self._cell_world(self.max_order, row, col)
+        flux = np.zeros(lon.shape)
+        weights = np.zeros(lon.shape)
+        for tile in self.tiles_of_cell(row, col):
+            filename = self.pattern % tile
+            if not os.path.exists(filename):
+                continue
+            cards = dict((k, v[0, 0] if isinstance(v, np.ndarray) else v)
+                         for k, v in self._tile_cards(tile).items())
+            x, y = coverage.car_world2pix(cards, lon, lat)
+            w = self._weight(x, y)
+            inside = w > 0
+            if not inside.any():
+                continue
+            hdulist = pyfits.open(filename, memmap=True)
+            values = _bilinear(hdulist[0].data, x[inside] - 1, y[inside] - 1)
+            hdulist.close()
+            good = np.isfinite(values)
+            target = tuple(index[good] for index in np.nonzero(inside))
+            flux[target] += w[inside][good] * values[good]
+            weights[target] += w[inside][good]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weights > 0, flux / weights, np.nan)
+
+    def render_parent(self, order, row, col):
+        """
+        Averages the four children of a cell, at the next order, 2x2.
+
+        """
+        children = np.empty((2 * self.cell, 2 * self.cell))
+        children.fill(np.nan)
+        for i in range(2):
+            for j in range(2):
+                filename = self.filename(order + 1, 2 * row + i, 2 * col + j)
+                if os.path.exists(filename):
+                    children[i*self.cell:(i+1)*self.cell,
+                             j*self.cell:(j+1)*self.cell] = pyfits.getdata(filename)
+        blocks = children.reshape(self.cell, 2, self.cell, 2)
+        finite = np.isfinite(blocks)
+        sums = np.where(finite, blocks, 0.).sum(axis=(1, 3))
+        counts = finite.sum(axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def _write(self, order, row, col, data):
+        """
+        Writes a cell as FITS and PNG; empty cells are removed instead.
+
+        """
+        fits, png = self.filename(order, row, col), self.filename(order, row, col, 'png')
+        if not np.isfinite(data).any():
+            for filename in [fits, png]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            return
+        directory = os.path.dirname(fits)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        hdr = pyfits.Header()
+        for key, value in sorted(self.cell_cards(order, row, col).items()):
+            if not key.startswith('NAXIS'):
+                hdr.update(key, value)
+        hdr.update('EQUINOX', 2000.)
+        # Write to temporary files first, the pyramid may be browsed meanwhile
+        pyfits.PrimaryHDU(data.astype(np.float32), hdr).writeto(fits + '.tmp',
+                                                                clobber=True)
+        os.rename(fits + '.tmp', fits)
+        quicklook.write_png(png + '.tmp', quicklook.scale(data, self.vmin,
+                                                          self.vmax, self.stretch))
+        os.rename(png + '.tmp', png)
+
+    def _state(self):
+        """
+        Returns the frame of the pyramid and the state of the tile files.
+
+        """
+        tiles = {}
+        for tile in self.grid.tile:
+            filename = self.pattern % tile
+            if os.path.exists(filename):
+                st = os.stat(filename)
+                tiles['%d' % tile] = [st.st_size, st.st_mtime]
+        frame = {'cell': self.cell, 'max_order': self.max_order,
+                 'resolution': self.resolution, 'lon0': self.lon0,
+                 'lat0': self.lat0, 'width': self.width, 'height': self.height,
+                 'ramp': list(self._ramp), 'pattern': self.pattern,
+                 'stretch': [self.vmin, self.vmax, self.stretch]}
+        return {'frame': frame, 'tiles': tiles}
+
+    def update(self, tiles=None):
+        """
+        Brings the pyramid up to date with the tile files.
+
+        :param tiles:
+        Tiles to recompute (default: those whose file changed since the
+        last update, or all of them if the frame changed.)
+
+        Returns the number of cells written or removed.
+        """
+        state_file = self.root + '/pyramid.json'
+        state = self._state()
+        previous = {'frame': None, 'tiles': {}}
+        if os.path.exists(state_file):
+            previous = json.load(open(state_file, 'r'))
+        if tiles is None:
+            if previous['frame'] != state['frame']:
+                tiles = self.grid.tile
+            else:
+                names = set(state['tiles']) | set(previous['tiles'])
+                tiles = [int(t) for t in names
+                         if state['tiles'].get(t) != previous['tiles'].get(t)]
+
+        dirty = set()
+        for tile in tiles:
+            dirty.update(self.cells_of_tile(tile))
+        self.log.info('Pyramid %s: %d tiles changed, %d cells to render'
+                      % (self.root, len(tiles), len(dirty)))
+        count = 0
+        for order in range(self.max_order, -1, -1):
+            for row, col in sorted(dirty):
+                if order == self.max_order:
+                    data = self.render_cell(row, col)
+                else:
+                    data = self.render_parent(order, row, col)
+                self._write(order, row, col, data)
+                count += 1
+            dirty = set((row // 2, col // 2) for row, col in dirty)
+
+        # Record the state once all the cells are written
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        output = open(state_file + '.tmp', 'w')
+        json.dump(state, output, indent=1, sort_keys=True)
+        output.close()
+        os.rename(state_file + '.tmp', state_file)
+        return count
+
+
+def _bilinear(data, x, y):
+    """
+    Interpolates an image at 0-based pixel coordinates, ignoring blank
+    neighbours; only the rows and columns around the points are read.
+
+    """
+    ny, nx = data.shape
+    x0 = np.floor(x).astype(int)
+    y0 = np.floor(y).astype(int)
+    fx, fy = x - x0, y - y0
+    xmin, xmax = max(0, x0.min()), min(nx - 1, x0.max() + 1)
+    ymin, ymax = max(0, y0.min()), min(ny - 1, y0.max() + 1)
+    block = np.array(data[ymin:ymax + 1, xmin:xmax + 1], dtype=np.float64)
+    total = np.zeros(x.shape)
+    weights = np.zeros(x.shape)
+    for dx, dy, w in [(0, 0, (1 - fx) * (1 - fy)), (1, 0, fx * (1 - fy)),
+                      (0, 1, (1 - fx) * fy), (1, 1, fx * fy)]:
+        xi, yi = x0 + dx, y0 + dy
+        valid = (xi >= xmin) & (xi <= xmax) & (yi >= ymin) & (yi <= ymax)
+        v = np.zeros(x.shape)
+        v[valid] = block[yi[valid] - ymin, xi[valid] - xmin]
+        valid &= np.isfinite(v) & (w > 0)
+        total[valid] += w[valid] * v[valid]
+        weights[valid] += w[valid]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weights > 0, total / weights, np.nan)
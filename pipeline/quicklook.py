@@ -0,0 +1,219 @@
+"""
+Quicklook previews of mosaics, replacing 'mJPEG -gray <image> 20 200 log'.
+
+The image is block-averaged while it is read (or while it is co-added),
+such that only the downsampled preview is held in memory; the stretch is
+applied to the preview and written as JPEG (which requires PIL) or PNG
+at several zoom levels. The finest level keeps the name mJPEG gave the
+quicklook, '<image>.jpg'.
+"""
+
+import struct
+import zlib
+import numpy as np
+import pyfits
+
+
+class Preview(object):
+    """
+    Accumulates a block-averaged copy of an image fed row by row.
+
+    :param naxis1:
+    Width of the full-resolution image.
+
+    :param factors:
+    Downsampling factors of the zoom levels, each a multiple of the first.
+    """
+
+    def __init__(self, naxis1, factors=(4, 16, 64)):
+        self.factors = sorted(factors)
+        self.factor = self.factors[0]
+        for f in self.factors:
+            if f % self.factor != 0:
+                raise Exception('Zoom factors must be multiples of %d' % self.factor)
+        self.naxis1 = naxis1
+        self._width = (naxis1 + self.factor - 1) // self.factor
+        self._sums = []      # Rows of block sums at the finest zoom level
+        self._counts = []    # Rows of the number of finite pixels summed
+        self._pending = []   # Rows not yet making up a whole block
+
+    def _reduce(self, rows):
+        # Pad to whole blocks, then sum the blocks through a reshaped view
+        n = rows.shape[0]
+        padded = np.empty((self.factor, self._width * self.factor))
+        padded.fill(np.nan)
+        padded[:n, :self.naxis1] = rows
+        blocks = padded.reshape(self.factor, self._width, self.factor)
+        finite = np.isfinite(blocks)
+        self._sums.append(np.where(finite, blocks, 0.).sum(axis=(0, 2)))
+        self._counts.append(finite.sum(axis=(0, 2)))
+
+    def add(self, rows):
+        """
+        Adds the next rows of the image (a 2D array, bottom row first).
+
+        """
+        rows = np.asarray(rows, dtype=np.float64)
+        if self._pending:
+            rows = np.vstack(self._pending + [rows])
+            self._pending = []
+        whole = rows.shape[0] // self.factor * self.factor
+        for y in range(0, whole, self.factor):
+            self._reduce(rows[y:y + self.factor])
+        if whole < rows.shape[0]:
+            self._pending = [rows[whole:]]
+
+    def levels(self):
+        """
+        Returns {factor: block-averaged image} for all zoom levels.
+
+        """
+        if self._pending:
+            self._reduce(self._pending[0])
+            self._pending = []
+        sums, counts = np.array(self._sums), np.array(self._counts)
+        result = {}
+        for f in self.factors:
+            k = f // self.factor
+            ny = (sums.shape[0] + k - 1) // k
+            nx = (sums.shape[1] + k - 1) // k
+            s = np.zeros((ny * k, nx * k))
+            c = np.zeros((ny * k, nx * k))
+            s[:sums.shape[0], :sums.shape[1]] = sums
+            c[:counts.shape[0], :counts.shape[1]] = counts
+            s = s.reshape(ny, k, nx, k).sum(axis=(1, 3))
+            c = c.reshape(ny, k, nx, k).sum(axis=(1, 3))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[f] = np.where(c > 0, s / c, np.nan)
+        return result
+
+    def write(self, prefix, vmin='20', vmax='200', stretch='log', fmt='jpg'):
+        """
+        Writes the finest zoom level to '<prefix>.<fmt>' and the others to
+        '<prefix>.x<factor>.<fmt>'.
+
+        Returns the list of files written.
+        """
+        filenames = []
+        for f, image in sorted(self.levels().items()):
+            if f == self.factor:
+                filename = '%s.%s' % (prefix, fmt)
+            else:
+                filename = '%s.x%d.%s' % (prefix, f, fmt)
+            pixels = scale(image, vmin, vmax, stretch)
+            if fmt == 'png':
+                write_png(filename, pixels)
+            elif fmt in ['jpg', 'jpeg']:
+                write_jpeg(filename, pixels)
+            else:
+                raise Exception('Unknown quicklook format: %s' % fmt)
+            filenames.append(filename)
+        return filenames
+
+
+def _limit(image, value):
+    """
+    Interprets a range limit like mJPEG: '99.5%' is a percentile of the
+    finite pixels, '2s' the median plus two standard deviations (estimated
+    from the 15.87 and 84.13 percentiles), anything else a pixel value.
+
+    """
+    value = str(value).strip()
+    if value.endswith('%') or value.endswith('s'):
+        finite = image[np.isfinite(image)]
+        if len(finite) == 0:
+            return 0.
+        if value.endswith('%'):
+            return float(np.percentile(finite, float(value[:-1])))
+        lo, median, hi = np.percentile(finite, [15.87, 50., 84.13])
+        return float(median + float(value[:-1]) * (hi - lo) / 2.)
+    try:
+        return float(value)
+    except ValueError:
+        raise Exception('Unsupported quicklook range: %s' % value)
+
+
+def scale(image, vmin='20', vmax='200', stretch='log'):
+    """
+    Maps an image onto 8-bit grey levels, top row first; blank pixels are black.
+
+    :param stretch:
+    'linear', 'sqrt' or 'log'.
+    """
+    lo, hi = _limit(image, vmin), _limit(image, vmax)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.clip((image - lo) / max(hi - lo, 1e-30), 0., 1.)
+    if stretch == 'log':
+        t = np.log10(1. + 999. * t) / 3.
+    elif stretch == 'sqrt':
+        t = np.sqrt(t)
+    elif stretch != 'linear':
+        raise Exception('Unknown stretch: %s' % stretch)
+    t[~np.isfinite(t)] = 0.
+    # FITS images start with the bottom row
+    return (t[::-1] * 255. + 0.5).astype(np.uint8)
+
+
+def write_png(filename, pixels):
+    """
+    Writes 8-bit grey levels as a PNG file.
+
+    """
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    height, width = pixels.shape
+    # Every row is preceded by its filter type (0: none)
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels
+    output = open(filename, 'wb')
+    output.write(b'\x89PNG\r\n\x1a\n')
+    output.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+    output.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+    output.write(chunk(b'IEND', b''))
+    output.close()
+
+
+def jpeg_available():
+    """
+    Can JPEG files be written, i.e. is PIL installed?
+
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return False
+    return True
+
+
+def write_jpeg(filename, pixels, quality=90):
+    """
+    Writes 8-bit grey levels as a JPEG file (requires PIL).
+
+    """
+    from PIL import Image
+    Image.fromarray(pixels, 'L').save(filename, quality=quality)
+
+
+def render(filename, prefix=None, factors=(4, 16, 64), vmin='20', vmax='200',
+           stretch='log', fmt='jpg', max_bytes=64*1024**2):
+    """
+    Writes the quicklooks of a FITS image, reading it memory-mapped in
+    blocks of rows of at most 'max_bytes'.
+
+    :param prefix:
+    Prefix of the files written (default: the FITS filename.)
+
+    Returns the list of files written.
+    """
+    if prefix is None:
+        prefix = filename
+    hdulist = pyfits.open(filename, memmap=True)
+    data = hdulist[0].data
+    preview = Preview(data.shape[1], factors)
+    block = int(max(1, max_bytes // (data.shape[1] * 8)))
+    block = max(preview.factor, block // preview.factor * preview.factor)
+    for y in range(0, data.shape[0], block):
+        preview.add(data[y:y + block])
+    hdulist.close()
+    return preview.write(prefix, vmin, vmax, stretch, fmt)
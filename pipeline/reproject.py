@@ -0,0 +1,460 @@
+"""
+In-process reprojection onto the CAR tile frames, as an alternative to mProject.
+
+mProject computes the exact spherical overlap of every input pixel with
+every output pixel, which is slow. The tile frames are plate carree grids
+with identity PC matrices, and the input images have zenithal (TAN or ZPN)
+projections, so the pixel-to-sky-to-pixel transforms are evaluated in
+closed form on whole blocks of pixels with numpy instead:
+
+- 'bilinear' maps every output pixel into the input image and interpolates
+  the weighted flux and the weight;
+- 'drizzle' splits every input pixel into subsample x subsample cells,
+  maps their corners onto the tile and adds each cell's flux to the output
+  pixel under its centre, weighted by its area; this conserves flux and
+  approaches the exact overlaps as the subsampling grows.
+
+As with mProject, input pixels whose weight is below the threshold are
+ignored, output pixels hold the weighted mean and the area map holds the
+solid angle (sr) times the weight.
+"""
+
+import logging
+import os
+import threading
+import numpy as np
+import pyfits
+
+import coverage
+import executor
+from coadd import template_to_header
+from montage import read_template, montage_names
+
+
+class ZenithalWCS(object):
+    """
+    World coordinate system of an input image: a TAN or ZPN projection
+    with a CD (or PC/CDELT) matrix, as written by CASUtools.
+
+    :param header:
+    pyfits header of the image HDU.
+    """
+
+    def __init__(self, header):
+        ctype1 = header['CTYPE1']
+        self.projection = ctype1[-3:]
+        if self.projection not in ['TAN', 'ZPN']:
+            raise Exception('Unsupported projection for the native '
+                            'reprojection: %s' % ctype1)
+        self.equatorial = ctype1.startswith('RA')
+        self.crpix = np.array([header['CRPIX1'], header['CRPIX2']], dtype=float)
+        self.crval = np.array([header['CRVAL1'], header['CRVAL2']], dtype=float)
+        if 'CD1_1' in header:
+            cd = [[header.get('CD1_1', 0.), header.get('CD1_2', 0.)],
+                  [header.get('CD2_1', 0.), header.get('CD2_2', 0.)]]
+        else:
+            cdelt = [header.get('CDELT1', 1.), header.get('CDELT2', 1.)]
+            cd = [[cdelt[i] * header.get('PC%d_%d' % (i+1, j+1), float(i == j))
+                   for j in range(2)] for i in range(2)]
+        self.cd = np.array(cd, dtype=float)
+        self.cd_inverse = np.linalg.inv(self.cd)
+        self.lonpole = np.radians(header.get('LONPOLE', 180.))
+        # ZPN polynomial coefficients; older headers use PROJPn
+        pv = [header.get('PV2_%d' % m, header.get('PROJP%d' % m, 0.))
+              for m in range(21)]
+        if self.projection == 'ZPN' and not any(pv):
+            pv[1] = 1.
+        while len(pv) > 2 and pv[-1] == 0:
+            pv.pop()
+        self.pv = np.array(pv, dtype=float)
+
+    def _r(self, theta):
+        """
+        Radius (degrees) in the plane of projection of native latitude
+        'theta' (radians).
+
+        """
+        if self.projection == 'TAN':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.degrees(np.cos(theta) / np.sin(theta))
+        u = np.pi / 2 - theta
+        return np.degrees(np.polyval(self.pv[::-1], u))
+
+    def _theta(self, r):
+        """
+        Native latitude (radians) of the radius 'r' (degrees); the inverse
+        of _r, solved by Newton iterations for ZPN.
+
+        """
+        r = np.radians(r)
+        if self.projection == 'TAN':
+            return np.arctan2(1., r)
+        derivative = (self.pv * np.arange(len(self.pv)))[1:]
+        u = r / self.pv[1] if self.pv[1] != 0 else r
+        for iteration in range(20):
+            step = (np.polyval(self.pv[::-1], u) - r) / np.polyval(derivative[::-1], u)
+            u = u - step
+            if np.all(np.abs(step) < 1e-12):
+                break
+        return np.pi / 2 - u
+
+    def pix2world(self, p1, p2):
+        """
+        Converts (1-based) pixel coordinates to world coordinates (degrees).
+
+        """
+        d1 = np.asarray(p1, dtype=float) - self.crpix[0]
+        d2 = np.asarray(p2, dtype=float) - self.crpix[1]
+        x = self.cd[0, 0] * d1 + self.cd[0, 1] * d2
+        y = self.cd[1, 0] * d1 + self.cd[1, 1] * d2
+        phi = np.arctan2(x, -y)
+        theta = self._theta(np.hypot(x, y))
+        # Native to celestial coordinates, the reference point at the pole
+        lat_p = np.radians(self.crval[1])
+        dphi = phi - self.lonpole
+        lat = np.arcsin(np.clip(np.sin(theta) * np.sin(lat_p)
+                        + np.cos(theta) * np.cos(lat_p) * np.cos(dphi), -1, 1))
+        lon = self.crval[0] + np.degrees(np.arctan2(
+                    -np.cos(theta) * np.sin(dphi),
+                    np.sin(theta) * np.cos(lat_p)
+                    - np.cos(theta) * np.sin(lat_p) * np.cos(dphi)))
+        return lon % 360., np.degrees(lat)
+
+    def world2pix(self, lon, lat):
+        """
+        Converts world coordinates (degrees) to (1-based) pixel coordinates.
+
+        """
+        lat_p = np.radians(self.crval[1])
+        lat = np.radians(np.asarray(lat, dtype=float))
+        dlon = np.radians(np.asarray(lon, dtype=float) - self.crval[0])
+        theta = np.arcsin(np.clip(np.sin(lat) * np.sin(lat_p)
+                          + np.cos(lat) * np.cos(lat_p) * np.cos(dlon), -1, 1))
+        phi = self.lonpole + np.arctan2(-np.cos(lat) * np.sin(dlon),
+                                        np.sin(lat) * np.cos(lat_p)
+                                        - np.cos(lat) * np.sin(lat_p) * np.cos(dlon))
+        r = self._r(theta)
+        x, y = r * np.sin(phi), -r * np.cos(phi)
+        # Points in the far hemisphere have no pixel coordinates
+        x = np.where(theta > 0, x, np.nan)
+        return (self.cd_inverse[0, 0] * x + self.cd_inverse[0, 1] * y + self.crpix[0],
+                self.cd_inverse[1, 0] * x + self.cd_inverse[1, 1] * y + self.crpix[1])
+
+
+class _Frame(object):
+    """
+    The CAR frame of a template header, and the conversions between its
+    world coordinates and those of an input image.
+
+    """
+
+    def __init__(self, template, wcs):
+        self.cards = dict(read_template(template))
+        self.naxis1 = int(self.cards['NAXIS1'])
+        self.naxis2 = int(self.cards['NAXIS2'])
+        self.cdelt1 = float(self.cards['CDELT1'])
+        self.cdelt2 = float(self.cards['CDELT2'])
+        self.crpix2 = float(self.cards['CRPIX2'])
+        self.equatorial = self.cards['CTYPE1'].startswith('RA')
+        self.wcs = wcs
+
+    def to_image(self, p1, p2):
+        """Tile pixel coordinates to image pixel coordinates"""
+        lon, lat = coverage.car_pix2world(self.cards, p1, p2)
+        if self.wcs.equatorial and not self.equatorial:
+            lon, lat = coverage.galactic_to_equatorial(lon, lat)
+        elif self.equatorial and not self.wcs.equatorial:
+            lon, lat = coverage.equatorial_to_galactic(lon, lat)
+        return self.wcs.world2pix(lon, lat)
+
+    def from_image(self, p1, p2):
+        """Image pixel coordinates to tile pixel coordinates"""
+        lon, lat = self.wcs.pix2world(p1, p2)
+        if self.wcs.equatorial and not self.equatorial:
+            lon, lat = coverage.equatorial_to_galactic(lon, lat)
+        elif self.equatorial and not self.wcs.equatorial:
+            lon, lat = coverage.galactic_to_equatorial(lon, lat)
+        return coverage.car_world2pix(self.cards, lon, lat)
+
+    def solid_angle(self, p2):
+        """Solid angle (sr) of the tile pixels in row(s) p2"""
+        theta = np.radians(self.cdelt2 * (np.asarray(p2, dtype=float) - self.crpix2))
+        return abs(self.cdelt1 * self.cdelt2) * (np.pi / 180.)**2 * np.cos(theta)
+
+
+# Decoded weight maps, most recently used last: the images of a tile share
+# a few confidence maps (one master map per band without CASUtools mosaic)
+_weights = []
+_weights_lock = threading.Lock()
+WEIGHT_CACHE_SIZE = 4  # Number of decoded weight maps kept in memory (one per HDU)
+
+
+def _read_weight(filename, hdu, shape):
+    """
+    Returns a copy of the weight map of an image, decoded once per file,
+    HDU and shape (see _decode_weight).
+
+    """
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime, hdu, shape)
+    with _weights_lock:
+        for i, (k, w) in enumerate(_weights):
+            if k == key:
+                _weights.append(_weights.pop(i))
+                return w.copy()
+    w = _decode_weight(filename, hdu, shape)
+    with _weights_lock:
+        if key not in [k for k, v in _weights]:
+            _weights.append( (key, w) )
+            del _weights[:-WEIGHT_CACHE_SIZE]
+    return w.copy()
+
+
+def _decode_weight(filename, hdu, shape):
+    """
+    Reads the weight map of an image: the HDU with the same number as the
+    image if it matches its shape (multi-extension confidence maps), the
+    first HDU that does otherwise.
+
+    """
+    hdulist = pyfits.open(filename)
+    try:
+        candidates = [hdu] + list(range(len(hdulist)))
+        for i in candidates:
+            if i < len(hdulist) and hdulist[i].data is not None \
+                    and hdulist[i].data.shape == shape:
+                return np.array(hdulist[i].data, dtype=np.float64)
+    finally:
+        hdulist.close()
+    raise Exception('No weight map of shape %s in %s' % (shape, filename))
+
+
+def _bounds(frame, naxis1, naxis2, samples=64):
+    """
+    Returns the (x0, x1, y0, y1) range of tile pixels (0-based, end
+    exclusive) touched by an image, or None if they do not overlap.
+
+    """
+    t = np.linspace(0, 1, samples)
+    p1 = np.concatenate([0.5 + t*naxis1, np.repeat(naxis1+0.5, samples),
+                         0.5 + t*naxis1, np.repeat(0.5, samples)])
+    p2 = np.concatenate([np.repeat(0.5, samples), 0.5 + t*naxis2,
+                         np.repeat(naxis2+0.5, samples), 0.5 + t*naxis2])
+    x, y = frame.from_image(p1, p2)
+    # One pixel of margin for the curvature between the samples
+    x0 = max(0, int(np.floor(x.min() - 0.5)) - 1)
+    x1 = min(frame.naxis1, int(np.ceil(x.max() + 0.5)) + 1)
+    y0 = max(0, int(np.floor(y.min() - 0.5)) - 1)
+    y1 = min(frame.naxis2, int(np.ceil(y.max() + 0.5)) + 1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, x1, y0, y1
+
+
+def _bilinear(frame, flux, weight, bounds, y0, y1):
+    """
+    Interpolates rows y0:y1 (0-based) of the tile. Returns (sum of the
+    weighted flux, sum of the weights) for those rows within the bounds.
+
+    """
+    bx0, bx1 = bounds[0], bounds[1]
+    p2, p1 = np.mgrid[y0:y1, bx0:bx1] + 1.
+    x, y = frame.to_image(p1, p2)
+    n2, n1 = flux.shape
+    # 0-based coordinates in the image; its pixels extend 0.5 beyond centres
+    x, y = x - 1, y - 1
+    inside = (x > -0.5) & (x < n1 - 0.5) & (y > -0.5) & (y < n2 - 0.5)
+    x = np.clip(np.where(inside, x, 0.), 0, n1 - 1)
+    y = np.clip(np.where(inside, y, 0.), 0, n2 - 1)
+    i = np.minimum(x.astype(int), max(n1 - 2, 0))
+    j = np.minimum(y.astype(int), max(n2 - 2, 0))
+    tx, ty = x - i, y - j
+    i1, j1 = np.minimum(i + 1, n1 - 1), np.minimum(j + 1, n2 - 1)
+    corners = [(j, i, (1-tx) * (1-ty)), (j, i1, tx * (1-ty)),
+               (j1, i, (1-tx) * ty), (j1, i1, tx * ty)]
+    num = np.zeros(x.shape)
+    den = np.zeros(x.shape)
+    for jj, ii, b in corners:
+        num += b * flux[jj, ii]
+        den += b * weight[jj, ii]
+    num[~inside] = 0.
+    den[~inside] = 0.
+    return num, den
+
+
+def _drizzle(frame, flux, weight, bounds, r0, r1, subsample):
+    """
+    Drizzles image rows r0:r1 (0-based) onto the tile. Returns (row offset
+    within the bounds, sum of the weighted flux times area, sum of the
+    weights times area) for the tile rows touched.
+
+    """
+    bx0, bx1, by0, by1 = bounds
+    n1 = flux.shape[1]
+    s = subsample
+    # Corners of the cells, in (1-based) image pixel coordinates
+    c2, c1 = np.mgrid[0:(r1 - r0) * s + 1, 0:n1 * s + 1]
+    x, y = frame.from_image(0.5 + c1 / float(s), r0 + 0.5 + c2 / float(s))
+    # Area of the cells in tile pixels, from their diagonals
+    area = 0.5 * np.abs((x[1:, 1:] - x[:-1, :-1]) * (y[:-1, 1:] - y[1:, :-1])
+                        - (x[:-1, 1:] - x[1:, :-1]) * (y[1:, 1:] - y[:-1, :-1]))
+    xc = 0.25 * (x[1:, 1:] + x[:-1, :-1] + x[:-1, 1:] + x[1:, :-1])
+    yc = 0.25 * (y[1:, 1:] + y[:-1, :-1] + y[:-1, 1:] + y[1:, :-1])
+    del x, y
+    area *= frame.solid_angle(yc)
+    w = np.repeat(np.repeat(weight[r0:r1], s, axis=0), s, axis=1) * area
+    f = np.repeat(np.repeat(flux[r0:r1], s, axis=0), s, axis=1) * area
+    # Output pixel under the centre of each cell, 0-based within the bounds
+    ix = np.round(xc).astype(int) - 1 - bx0
+    iy = np.round(yc).astype(int) - 1 - by0
+    keep = ((w > 0) & (ix >= 0) & (ix < bx1 - bx0)
+            & (iy >= 0) & (iy < by1 - by0))
+    if not keep.any():
+        return 0, np.zeros((0, bx1 - bx0)), np.zeros((0, bx1 - bx0))
+    ix, iy = ix[keep], iy[keep]
+    lo, hi = iy.min(), iy.max() + 1
+    index = (iy - lo) * (bx1 - bx0) + ix
+    size = (hi - lo) * (bx1 - bx0)
+    num = np.bincount(index, weights=f[keep], minlength=size)
+    den = np.bincount(index, weights=w[keep], minlength=size)
+    return lo, num.reshape(hi - lo, -1), den.reshape(hi - lo, -1)
+
+
+def reproject(image, output, template, hdu=0, weight=None, threshold=0.,
+              method='bilinear', subsample=4, workers=1,
+              max_bytes=64*1024**2, log=logging):
+    """
+    Reprojects one HDU of an image onto a CAR template, like
+    'mProject -w <weight> -t <threshold> -h <hdu> <image> <output> <template>'.
+
+    The output is cropped to the pixels the image touches; the area map is
+    written to '<output>_area.fits' (see montage.montage_names).
+
+    :param method:
+    'bilinear' or 'drizzle'.
+
+    :param subsample:
+    Cells per pixel side in 'drizzle' mode.
+
+    :param workers:
+    Number of threads working on blocks of rows.
+
+    :param max_bytes:
+    Approximate memory used by the coordinate arrays of a block of rows.
+
+    Returns True; raises an exception if the image misses the template.
+    """
+    hdulist = pyfits.open(image)
+    data = np.array(hdulist[hdu].data, dtype=np.float64)
+    wcs = ZenithalWCS(hdulist[hdu].header)
+    hdulist.close()
+    if weight is None:
+        w = np.ones(data.shape)
+    else:
+        w = _read_weight(weight, hdu, data.shape)
+    w[~(w >= threshold) | ~np.isfinite(data)] = 0.
+    flux = np.where(w > 0, data * w, 0.)
+    del data
+
+    frame = _Frame(template, wcs)
+    bounds = _bounds(frame, flux.shape[1], flux.shape[0])
+    if bounds is None:
+        raise Exception('%s (hdu %d) does not overlap %s' % (image, hdu, template))
+    bx0, bx1, by0, by1 = bounds
+    num = np.zeros((by1 - by0, bx1 - bx0))
+    den = np.zeros((by1 - by0, bx1 - bx0))
+
+    # Blocks of rows, each needing about 20 temporary arrays of doubles
+    if method == 'bilinear':
+        rows = int(max(1, max_bytes // (20 * 8 * (bx1 - bx0))))
+        blocks = [(y, min(y + rows, by1)) for y in range(by0, by1, rows)]
+
+        def task(block):
+            return block[0], _bilinear(frame, flux, w, bounds, block[0], block[1])
+
+        def add(i, success, result):
+            if success:
+                y, (n, d) = result
+                num[y - by0:y - by0 + n.shape[0]] += n
+                den[y - by0:y - by0 + d.shape[0]] += d
+    elif method == 'drizzle':
+        rows = int(max(1, max_bytes // (20 * 8 * (flux.shape[1] * subsample + 1)
+                                        * subsample)))
+        blocks = [(r, min(r + rows, flux.shape[0]))
+                  for r in range(0, flux.shape[0], rows)]
+
+        def task(block):
+            return _drizzle(frame, flux, w, bounds, block[0], block[1], subsample)
+
+        def add(i, success, result):
+            if success:
+                lo, n, d = result
+                num[lo:lo + n.shape[0]] += n
+                den[lo:lo + d.shape[0]] += d
+    else:
+        raise Exception('Unknown reprojection method: %s' % method)
+
+    # The callback runs under the backend's lock, one block at a time
+    results = executor.ThreadBackend(workers).map(task, blocks, add)
+    failed = [result for success, result in results if not success]
+    if failed:
+        raise Exception('Reprojection of %s failed: %s' % (image, failed[0]))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        image_out = np.where(den > 0, num / den, np.nan)
+    if method == 'bilinear':
+        # Interpolated weights times the solid angle of the tile pixels
+        den *= frame.solid_angle(np.arange(by0, by1) + 1.)[:, np.newaxis]
+
+    header = template_to_header(template)
+    header.update('NAXIS1', bx1 - bx0)
+    header.update('NAXIS2', by1 - by0)
+    header.update('CRPIX1', float(header['CRPIX1']) - bx0)
+    header.update('CRPIX2', float(header['CRPIX2']) - by0)
+    for data, filename in zip([image_out, den], montage_names(output)):
+        pyfits.PrimaryHDU(data, header).writeto(filename, clobber=True)
+    log.debug('Reprojected %s (hdu %d, %s) into %dx%d pixels'
+              % (image, hdu, method, bx1 - bx0, by1 - by0))
+    return True
+
+
+def compare(filename_a, filename_b):
+    """
+    Compares two projections of an image onto the same frame, e.g. to
+    validate reproject() against mProject; they may be cropped differently.
+
+    Returns a dict with the number of pixels covered by both, the number
+    covered by only one of them, the median and maximum relative flux
+    difference, and the ratio of the total areas.
+    """
+    def read(filename):
+        image, area = [pyfits.open(f) for f in montage_names(filename)]
+        result = (image[0].data.astype(np.float64), area[0].data.astype(np.float64),
+                  float(image[0].header['CRPIX1']), float(image[0].header['CRPIX2']))
+        image.close()
+        area.close()
+        return result
+    fa, aa, x_a, y_a = read(filename_a)
+    fb, ab, x_b, y_b = read(filename_b)
+    # Offset of b's first pixel within a
+    dx, dy = int(round(x_a - x_b)), int(round(y_a - y_b))
+    xa0, ya0 = max(0, dx), max(0, dy)
+    xa1 = min(fa.shape[1], dx + fb.shape[1])
+    ya1 = min(fa.shape[0], dy + fb.shape[0])
+    sa = (slice(ya0, ya1), slice(xa0, xa1))
+    sb = (slice(ya0 - dy, ya1 - dy), slice(xa0 - dx, xa1 - dx))
+    ca, cb = aa[sa] > 0, ab[sb] > 0
+    both = ca & cb
+    result = {'pixels': int(both.sum()),
+              'coverage_differs': int((aa > 0).sum() + (ab > 0).sum()
+                                      - 2 * both.sum()),
+              'median_rel_diff': 0., 'max_rel_diff': 0.,
+              'area_ratio': aa.sum() / ab.sum() if ab.sum() > 0 else np.nan}
+    if both.any():
+        a, b = fa[sa][both], fb[sb][both]
+        scale = np.median(np.abs(b))
+        if scale > 0:
+            rel = np.abs(a - b) / scale
+            result['median_rel_diff'] = float(np.median(rel))
+            result['max_rel_diff'] = float(rel.max())
+    return result
@@ -0,0 +1,232 @@
+"""
+Runs many tile/band mosaics concurrently on a single machine.
+
+"""
+
+import logging
+import os
+import time
+import multiprocessing
+
+
+def available_memory():
+    """
+    Returns the number of bytes of memory available for new processes.
+
+    """
+    try:
+        for line in open('/proc/meminfo', 'r'):
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def available_disk(path):
+    """
+    Returns the number of bytes available to non-root users at 'path'.
+
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def _run_job(function, tile, band):
+    """
+    Executes a single job in a worker process and reports the outcome.
+
+    """
+    try:
+        function(tile, band)
+        return (tile, band, True, '')
+    except Exception as e:
+        logging.exception('tile %03d-%s failed' % (tile, band))
+        return (tile, band, False, str(e))
+
+
+class TileScheduler(object):
+    """
+    Runs a mosaic job for every tile and band of a tile grid.
+
+    :param grid:
+    mosaic.TileGrid object describing the tiles.
+
+    :param bands:
+    List of filters to mosaic (e.g. ['ha', 'r', 'i']).
+
+    :param function:
+    Function called as function(tile, band) in a worker process to create
+    a single mosaic; it should raise an exception on failure.
+
+    :param scratchdir:
+    Scratch directory used by the jobs (to monitor free disk space).
+
+    :param workers:
+    Maximum number of concurrent jobs (default: number of cores).
+
+    :param memory_per_job: (bytes)
+    Peak memory required by a single job.
+
+    :param scratch_per_job: (bytes)
+    Scratch disk space required by a single job.
+
+    :param scratch_manager:
+    Optional scratch.ScratchManager; no job is started while it reports
+    too little free space or an exceeded quota.
+
+    When no job can be started for lack of scratch space although none is
+    running, the scheduler waits for up to 'max_wait' seconds for space to
+    be freed, then fails the jobs which are left.
+    """
+
+    def __init__(self, grid, bands, function, scratchdir,
+            workers=None, memory_per_job=2*1024**3,
+            scratch_per_job=20*1024**3, scratch_manager=None):
+        self._grid = grid
+        self._bands = bands
+        self._function = function
+        self._scratchdir = scratchdir
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._workers = workers
+        self._memory_per_job = memory_per_job
+        self._scratch_per_job = scratch_per_job
+        self._scratch_manager = scratch_manager
+        self.poll_interval = 10  # Seconds between checks on running jobs
+        self.max_wait = 3600  # Seconds to wait for scratch space with no job running
+        self.failed = []  # (tile, band, message) of failed jobs
+
+    def order(self, tiles=None):
+        """
+        Returns the list of (tile, band) jobs in the order of execution.
+
+        Tiles are visited column by column in a serpentine path, such that
+        consecutive jobs are neighbours which share many input exposures.
+
+        :param tiles:
+        Tile numbers to consider (default: all tiles in the grid), or a
+        dict {band: tile numbers} to mosaic different tiles in each band.
+        """
+        tiles_y = self._grid.tiles_y
+        if tiles is None:
+            tiles = range(len(self._grid))
+        if not isinstance(tiles, dict):
+            tiles = dict((band, tiles) for band in self._bands)
+
+        def position(tile):
+            x, y = self._grid.x[tile], self._grid.y[tile]
+            # Walk up the odd columns and down the even ones
+            if x % 2 == 1:
+                y = tiles_y - 1 - y
+            return (x, y)
+
+        return [(tile, band) for band in self._bands
+                for tile in sorted(tiles.get(band, []), key=position)]
+
+    def slots(self):
+        """
+        Returns the number of jobs which fit in the memory and disk budget.
+
+        """
+        by_memory = available_memory() // self._memory_per_job
+        by_disk = available_disk(self._scratchdir) // self._scratch_per_job
+        slots = int(max(1, min(self._workers, by_memory, by_disk)))
+        logging.info(('Scheduler slots: %d (cores=%d memory=%d disk=%d)')
+                     % (slots, self._workers, by_memory, by_disk))
+        return slots
+
+    def _admit(self, running):
+        """
+        Can another job be started next to 'running' ones?
+
+        Jobs which have just started have not used their scratch space yet,
+        hence the free space must cover the new job and all running ones.
+        """
+        min_free = 0
+        if self._scratch_manager is not None:
+            if not self._scratch_manager.admit():
+                return False
+            min_free = self._scratch_manager.min_free
+        return (available_disk(self._scratchdir) - min_free
+                >= (running + 1) * self._scratch_per_job)
+
+    def run(self, tiles=None):
+        """
+        Runs all jobs and returns True if none of them failed.
+
+        :param tiles:
+        Tile numbers to mosaic (default: all tiles in the grid), or a
+        dict {band: tile numbers}.
+        """
+        queue = self.order(tiles)
+        total = len(queue)
+        slots = self.slots()
+        pool = multiprocessing.Pool(slots, maxtasksperchild=1)
+
+        running = []
+        done = 0
+        self.failed = []
+        start = time.time()
+        waiting = None  # Since when no job could be started at all
+        try:
+            while queue or running:
+                # Start new jobs while the budget allows
+                while queue and len(running) < slots and self._admit(len(running)):
+                    tile, band = queue.pop(0)
+                    logging.info('Starting tile %03d-%s' % (tile, band))
+                    running.append(pool.apply_async(_run_job,
+                                        (self._function, tile, band)))
+
+                # No running job will free any space: wait for a while for
+                # the space to be freed otherwise, then give up
+                if queue and not running:
+                    if waiting is None:
+                        waiting = time.time()
+                    elif time.time() - waiting > self.max_wait:
+                        message = 'not enough scratch space in %s' % self._scratchdir
+                        logging.error('%d jobs not started: %s' % (len(queue), message))
+                        while queue:
+                            tile, band = queue.pop(0)
+                            done += 1
+                            self.failed.append((tile, band, message))
+                            self._report(tile, band, False, done, total, start)
+                        continue
+                else:
+                    waiting = None
+
+                time.sleep(self.poll_interval)
+
+                # Collect finished jobs
+                for result in [r for r in running if r.ready()]:
+                    running.remove(result)
+                    tile, band, success, message = result.get()
+                    done += 1
+                    if not success:
+                        self.failed.append((tile, band, message))
+                    self._report(tile, band, success, done, total, start)
+        finally:
+            pool.close()
+            pool.join()
+
+        logging.info('Scheduler finished: %d jobs, %d failed'
+                     % (total, len(self.failed)))
+        if self._scratch_manager is not None:
+            self._scratch_manager.report()
+        return len(self.failed) == 0
+
+    def _report(self, tile, band, success, done, total, start):
+        """
+        Logs progress and throughput.
+
+        """
+        hours = (time.time() - start) / 3600.
+        rate = done / hours if hours > 0 else 0.
+        if rate > 0:
+            eta = '%.1fh' % ((total - done) / rate)
+        else:
+            eta = 'unknown'
+        logging.info(('tile %03d-%s %s: %d/%d done (%.0f%%), '
+                      + '%.2f tiles/hour, ETA %s') % (
+                        tile, band, 'finished' if success else 'FAILED',
+                        done, total, 100. * done / total, rate, eta))
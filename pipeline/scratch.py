@@ -0,0 +1,190 @@
+"""
+Lifecycle of the scratch space used by the tile mosaics.
+
+Every tile records the bytes its work directory uses after each stage,
+and the bytes freed by deleting the intermediates which later stages
+have consumed. The records are kept per tile, such that concurrent jobs
+never write the same file, and are added up to decide whether the
+scheduler may start another job.
+"""
+
+import json
+import logging
+import os
+import shutil
+
+from scheduler import available_disk
+
+
+def disk_usage(path):
+    """
+    Returns the bytes allocated on disk to a file or directory tree.
+
+    Files with several hard links are only counted once.
+    """
+    total = 0
+    seen = set()
+    if not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.stat(path).st_blocks * 512
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue  # Deleted meanwhile
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add( (st.st_dev, st.st_ino) )
+            total += st.st_blocks * 512
+    return total
+
+
+def clear(path):
+    """
+    Deletes the contents of a directory, keeping the directory itself.
+
+    Returns the number of bytes freed.
+    """
+    if not os.path.isdir(path):
+        return 0
+    freed = disk_usage(path)
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        if os.path.isdir(filename) and not os.path.islink(filename):
+            shutil.rmtree(filename)
+        else:
+            os.remove(filename)
+    return freed
+
+
+class ScratchManager(object):
+    """
+    Tracks and limits the scratch space used by the tiles.
+
+    :param scratchdir:
+    Scratch directory holding the work directories of the tiles.
+
+    :param quota:
+    Bytes which the tiles may use together; no job is admitted while the
+    recorded usage exceeds it (None: no quota.)
+
+    :param min_free:
+    Bytes of free disk below which no job is admitted.
+
+    :param log:
+    Logger to report to.
+    """
+
+    def __init__(self, scratchdir, quota=None, min_free=0, log=logging):
+        self.scratchdir = scratchdir
+        self.quota = quota
+        self.min_free = min_free
+        self.log = log
+
+    def _record_file(self, workdir):
+        return '%s/scratch.json' % workdir
+
+    def _read(self, workdir):
+        filename = self._record_file(workdir)
+        if not os.path.exists(filename):
+            return {}
+        try:
+            return json.load(open(filename, 'r'))
+        except ValueError:
+            return {}  # Being written
+
+    def record(self, workdir, stage, freed=0):
+        """
+        Records the bytes used by a work directory after a stage, and the
+        bytes freed by deleting the intermediates of that stage.
+
+        Returns the bytes used.
+        """
+        used = disk_usage(workdir)
+        records = self._read(workdir)
+        records[stage] = {'bytes': used, 'freed': freed}
+        records['_current'] = used
+        filename = self._record_file(workdir)
+        output = open(filename + '.tmp', 'w')
+        json.dump(records, output, indent=1, sort_keys=True)
+        output.close()
+        os.rename(filename + '.tmp', filename)
+        self.log.info('Scratch: %s uses %.1f MB after stage %s, %.1f MB freed'
+                      % (os.path.basename(workdir), used / 1024.**2, stage,
+                         freed / 1024.**2))
+        return used
+
+    def release(self, workdir, stage, paths):
+        """
+        Deletes the contents of directories which have been consumed, and
+        records the usage of the work directory.
+
+        Returns the bytes freed.
+        """
+        freed = 0
+        for path in paths:
+            freed += clear(path)
+        self.record(workdir, stage, freed)
+        return freed
+
+    def usage(self):
+        """
+        Returns {tile name: {stage: {'bytes':, 'freed':}}} for all work
+        directories with records.
+
+        """
+        result = {}
+        if not os.path.isdir(self.scratchdir):
+            return result
+        for name in sorted(os.listdir(self.scratchdir)):
+            workdir = os.path.join(self.scratchdir, name)
+            if os.path.exists(self._record_file(workdir)):
+                result[name] = self._read(workdir)
+        return result
+
+    def used(self):
+        """
+        Returns the bytes currently used by all tiles, as last recorded.
+
+        """
+        return sum([records.get('_current', 0) for records in self.usage().values()])
+
+    def admit(self):
+        """
+        May another job be started? False if the free disk space is below
+        'min_free' or the tiles use more than their quota.
+
+        """
+        free = available_disk(self.scratchdir)
+        if free < self.min_free:
+            self.log.info('Scratch: %.1f GB free, below %.1f GB; holding jobs back'
+                          % (free / 1024.**3, self.min_free / 1024.**3))
+            return False
+        if self.quota is not None:
+            used = self.used()
+            if used >= self.quota:
+                self.log.info('Scratch: %.1f GB used, quota %.1f GB; holding jobs back'
+                              % (used / 1024.**3, self.quota / 1024.**3))
+                return False
+        return True
+
+    def report(self):
+        """
+        Logs the bytes used and freed per stage, summed over all tiles.
+
+        """
+        stages = {}
+        for records in self.usage().values():
+            for stage, record in records.items():
+                if stage.startswith('_'):
+                    continue
+                total = stages.setdefault(stage, [0, 0, 0])
+                total[0] += 1
+                total[1] += record['bytes']
+                total[2] += record['freed']
+        for stage, (n, used, freed) in sorted(stages.items()):
+            self.log.info('Scratch after %s: %d tiles, %.1f GB used, %.1f GB freed'
+                          % (stage, n, used / 1024.**3, freed / 1024.**3))
@@ -0,0 +1,179 @@
+"""
+Asynchronous staging of input files onto node-local scratch space.
+
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+
+
+def copy(source, destination):
+    """
+    Default staging operation: a plain file copy.
+
+    """
+    shutil.copyfile(source, destination)
+
+
+class Prefetcher(object):
+    """
+    Copies the next few input files to local scratch in background threads,
+    while the current one is being processed.
+
+    Iterating over a Prefetcher yields (source, staged) tuples in order,
+    waiting only if a file has not been staged yet. Staged files count
+    against the disk budget until they are released.
+
+    :param sources:
+    List of files to stage.
+
+    :param stagedir:
+    Node-local directory to stage the files to.
+
+    :param max_bytes:
+    Disk budget for the staged files which have not been released.
+
+    :param lookahead:
+    Maximum number of files staged ahead of the one being processed.
+
+    :param threads:
+    Number of concurrent staging threads.
+
+    :param stage:
+    Function called as stage(source, destination) to stage a file; the
+    default copies it, but it may e.g. decompress it instead.
+
+    :param log:
+    Logger to report to.
+    """
+
+    def __init__(self, sources, stagedir, max_bytes=10*1024**3,
+                 lookahead=4, threads=2, stage=copy, log=logging):
+        self._sources = list(sources)
+        self._stagedir = stagedir
+        self._max_bytes = max_bytes
+        self._lookahead = max(1, lookahead)
+        self._stage = stage
+        self.log = log
+        if not os.path.exists(stagedir):
+            os.makedirs(stagedir)
+
+        self._cond = threading.Condition()
+        self._next = 0        # Next index to be staged
+        self._consumed = 0    # Number of items handed out
+        self._ready = {}      # index -> staged filename (or None on failure)
+        self._sizes = {}      # staged filename -> bytes
+        self._used = 0
+        self._closed = False
+        # Statistics
+        self.bytes_staged = 0
+        self.seconds_staging = 0.
+        self.seconds_waiting = 0.
+        self._start = time.time()
+
+        self._threads = [threading.Thread(target=self._work)
+                         for i in range(max(1, threads))]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _destination(self, index, source):
+        return '%s/%05d_%s' % (self._stagedir, index, os.path.basename(source))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                # Wait for a slot within the lookahead window and the budget
+                while not self._closed and self._next < len(self._sources) and (
+                        self._next >= self._consumed + self._lookahead
+                        or (self._used > 0 and self._used + self._size(self._next)
+                            > self._max_bytes)):
+                    self._cond.wait()
+                if self._closed or self._next >= len(self._sources):
+                    return
+                index = self._next
+                self._next += 1
+                source = self._sources[index]
+                size = self._size(index)
+                self._used += size
+
+            destination = self._destination(index, source)
+            start = time.time()
+            try:
+                self._stage(source, destination)
+                size_staged = os.path.getsize(destination)
+            except Exception as e:
+                self.log.error('Staging %s failed: %s' % (source, e))
+                destination, size_staged = None, 0
+            elapsed = time.time() - start
+
+            with self._cond:
+                # Account for the actual size (e.g. after decompression)
+                self._used += size_staged - size
+                if destination is not None:
+                    self._sizes[destination] = size_staged
+                self._ready[index] = destination
+                self.bytes_staged += size_staged
+                self.seconds_staging += elapsed
+                self._cond.notify_all()
+
+    def _size(self, index):
+        try:
+            return os.path.getsize(self._sources[index])
+        except OSError:
+            return 0
+
+    def __iter__(self):
+        for index, source in enumerate(self._sources):
+            start = time.time()
+            with self._cond:
+                while index not in self._ready:
+                    self._cond.wait()
+                staged = self._ready.pop(index)
+                self._consumed = index + 1
+                self._cond.notify_all()
+            self.seconds_waiting += time.time() - start
+            yield source, staged
+
+    def release(self, staged):
+        """
+        Deletes a staged file once it has been used.
+
+        """
+        if staged is None:
+            return
+        if os.path.exists(staged):
+            os.remove(staged)
+        with self._cond:
+            self._used -= self._sizes.pop(staged, 0)
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Stops staging and removes the files which were never handed out.
+
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        for staged in list(self._ready.values()):
+            self.release(staged)
+        self._ready = {}
+
+    def report(self):
+        """
+        Logs the I/O throughput achieved and the time spent waiting for it.
+
+        """
+        elapsed = max(time.time() - self._start, 1e-9)
+        mb = self.bytes_staged / 1024.**2
+        self.log.info(('Staged %.1f MB at %.1f MB/s per thread, %.1f MB/s overall; '
+                       + 'waited %.1fs of %.1fs (%.0f%%) for input')
+                      % (mb, mb / max(self.seconds_staging, 1e-9), mb / elapsed,
+                         self.seconds_waiting, elapsed,
+                         100. * self.seconds_waiting / elapsed))
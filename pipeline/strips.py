@@ -0,0 +1,178 @@
+"""
+Co-addition of very large tiles in horizontal strips.
+
+mAdd keeps a whole output image in memory, which does not fit on nodes
+with 1 GB per core once tiles are large or the resolution is high. The
+tile is therefore split into strips of rows, which are co-added
+independently from the images overlapping them and stitched together.
+"""
+
+import logging
+import os
+import numpy as np
+import pyfits
+
+from catalogue import Catalogue
+from coadd import template_to_header
+from montage import read_template, write_template, montage_names
+
+
+class Strip(object):
+    """
+    A horizontal strip of a tile.
+
+    :param index:
+    Number of the strip, counting from the bottom of the tile.
+
+    :param y0, y1:
+    Rows (0-based, end exclusive) of the tile taken from this strip.
+
+    :param lo, hi:
+    Rows of the tile co-added in this strip, i.e. including the overlap
+    with its neighbours.
+    """
+
+    def __init__(self, index, y0, y1, lo, hi):
+        self.index = index
+        self.y0 = y0
+        self.y1 = y1
+        self.lo = lo
+        self.hi = hi
+        self.filename = None  # Co-added strip (None: no images overlap it)
+
+
+def split(template, rows, overlap=0):
+    """
+    Splits the tile described by a Montage template into strips.
+
+    :param rows:
+    Number of rows taken from each strip.
+
+    :param overlap:
+    Number of rows co-added on either side of a strip in addition.
+    """
+    naxis2 = int(dict(read_template(template))['NAXIS2'])
+    rows = max(1, int(rows))
+    strips = []
+    for y0 in range(0, naxis2, rows):
+        y1 = min(y0 + rows, naxis2)
+        strips.append(Strip(len(strips), y0, y1,
+                            max(0, y0 - overlap), min(naxis2, y1 + overlap)))
+    return strips
+
+
+def write_strip_template(template, strip, filename):
+    """
+    Writes the template header of a strip: same frame, fewer rows.
+
+    """
+    cards = []
+    for key, value in read_template(template):
+        if key == 'NAXIS2':
+            value = '%d' % (strip.hi - strip.lo)
+        elif key == 'CRPIX2':
+            value = repr(float(value) - strip.lo)
+        cards.append( (key, value) )
+    write_template(filename, cards)
+
+
+def write_strip_table(tbl, template, strip, filename):
+    """
+    Writes the subset of an image table which overlaps a strip.
+
+    Returns the number of images written.
+    """
+    crpix2 = float(dict(read_template(template))['CRPIX2'])
+    images = Catalogue.read_tbl(tbl)
+    # First row of each image in the frame of the tile
+    first = np.round(crpix2 - images['crpix2']).astype(int)
+    rows = np.nonzero((first < strip.hi)
+                      & (first + images['naxis2'] > strip.lo))[0]
+    if len(rows) > 0:
+        images.write_tbl(filename, rows)
+    return len(rows)
+
+
+def stitch(strips, template, output, max_bytes=256*1024**2, log=logging):
+    """
+    Stitches co-added strips (and their area maps) into the tile.
+
+    Only 'max_bytes' worth of rows are held in memory at any time. If the
+    strips overlap (see split), the rows co-added by two neighbouring
+    strips are compared, as they should be identical: a difference
+    indicates an image missing from a strip.
+
+    Returns the maximum absolute difference found in the overlaps (zero
+    if the strips do not overlap).
+    """
+    header = template_to_header(template)
+    naxis1 = int(header['NAXIS1'])
+    block = int(max(1, max_bytes // (naxis1 * 8 * 2)))
+    streams = [pyfits.StreamingHDU(filename, header)
+               for filename in montage_names(output)]
+    max_diff = 0.
+    previous = None  # (strip, hdulists) of the strip below
+    for strip in strips:
+        hdulists = None
+        if strip.filename is not None:
+            hdulists = [pyfits.open(f, memmap=True)
+                        for f in montage_names(strip.filename)]
+        for y in range(strip.y0, strip.y1, block):
+            n = min(block, strip.y1 - y)
+            for k, stream in enumerate(streams):
+                if hdulists is None:
+                    # No image overlaps: blank flux, zero area
+                    rows = np.zeros((n, naxis1)) + (np.nan if k == 0 else 0.)
+                else:
+                    start = y - strip.lo
+                    rows = np.array(hdulists[k][0].data[start:start + n],
+                                    dtype=np.float64)
+                stream.write(rows)
+        if previous is not None and previous[1] is not None \
+                and hdulists is not None:
+            max_diff = max(max_diff, _overlap_difference(
+                                previous[0], previous[1][0], strip, hdulists[0]))
+        if previous is not None and previous[1] is not None:
+            _close(previous[1])
+        previous = (strip, hdulists)
+    if previous is not None and previous[1] is not None:
+        _close(previous[1])
+    for stream in streams:
+        stream.close()
+    log.debug('Stitched %d strips into %s, max difference in the overlaps %g'
+              % (len(strips), output, max_diff))
+    return max_diff
+
+
+def _overlap_difference(below, hdulist_below, above, hdulist_above):
+    """
+    Maximum absolute difference between the rows two strips have in common.
+
+    """
+    lo, hi = max(below.lo, above.lo), min(below.hi, above.hi)
+    if lo >= hi:
+        return 0.
+    a = np.array(hdulist_below[0].data[lo - below.lo:hi - below.lo], dtype=np.float64)
+    b = np.array(hdulist_above[0].data[lo - above.lo:hi - above.lo], dtype=np.float64)
+    both = np.isfinite(a) & np.isfinite(b)
+    if not both.any():
+        return 0.
+    return float(np.abs(a[both] - b[both]).max())
+
+
+def _close(hdulists):
+    for hdulist in hdulists:
+        hdulist.close()
+
+
+def remove(strips):
+    """
+    Deletes the co-added strips and their area maps.
+
+    """
+    for strip in strips:
+        if strip.filename is None:
+            continue
+        for filename in montage_names(strip.filename):
+            if os.path.exists(filename):
+                os.remove(filename)